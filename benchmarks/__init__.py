@@ -0,0 +1,14 @@
+"""Benchmarks of the collector and the annotation on synthetic trees
+
+The benchmarks run offline: the trees are generated with empty image files
+and `import_candidates` is replaced by a stub treating each file as a
+fileset, so that only impomero's own code is measured. The annotation
+runs against the in-memory server of :mod:`impomero.testing`.
+
+Run them with::
+
+    python -m benchmarks run --sizes 1000 10000
+    python -m benchmarks compare benchmarks/results/old.json \\
+        benchmarks/results/new.json
+
+"""
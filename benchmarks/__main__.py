@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""Runs or compares the benchmarks
+"""
+import argparse
+import logging
+import sys
+import tempfile
+from pathlib import Path
+
+from .suite import (
+    DEFAULT_REPEATS,
+    DEFAULT_SIZES,
+    DEFAULT_THRESHOLD,
+    compare,
+    format_comparison,
+    load_results,
+    run_suite,
+    save_results,
+)
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+parser = argparse.ArgumentParser(prog="python -m benchmarks")
+commands = parser.add_subparsers(dest="command", required=True)
+
+run = commands.add_parser("run", help="run the benchmarks")
+run.add_argument(
+    "--sizes",
+    help="approximate number of files of the trees (default "
+    f"{' '.join(map(str, DEFAULT_SIZES))})",
+    type=int,
+    nargs="+",
+    default=DEFAULT_SIZES,
+)
+run.add_argument(
+    "--repeats",
+    help=f"number of runs of each benchmark (default {DEFAULT_REPEATS})",
+    type=int,
+    default=DEFAULT_REPEATS,
+)
+run.add_argument(
+    "--cards",
+    help="number of cards in each tree (default one per top level directory)",
+    type=int,
+    default=None,
+)
+run.add_argument(
+    "--latency",
+    help="seconds per round-trip of the fake server used by the annotation "
+    "benchmarks (default 0)",
+    type=float,
+    default=0.0,
+)
+run.add_argument(
+    "--work_dir",
+    help="where the trees are written, and kept for the next runs "
+    "(default in the temporary directory)",
+    default=Path(tempfile.gettempdir()) / "impomero-benchmarks",
+)
+run.add_argument(
+    "-o",
+    "--output",
+    help=f"results file (default {RESULTS_DIR}/<commit>.json)",
+    default=None,
+)
+
+comp = commands.add_parser("compare", help="compare the results of two runs")
+comp.add_argument("reference", help="results of the reference run")
+comp.add_argument("current", help="results of the run to check")
+comp.add_argument(
+    "--threshold",
+    help="ratio of the best times above which a benchmark is a regression "
+    f"(default {DEFAULT_THRESHOLD})",
+    type=float,
+    default=DEFAULT_THRESHOLD,
+)
+
+args = parser.parse_args()
+logging.basicConfig(level="WARNING", format="%(message)s")
+logging.getLogger("benchmarks").setLevel("INFO")
+
+if args.command == "run":
+    results = run_suite(
+        args.work_dir,
+        sizes=args.sizes,
+        repeats=args.repeats,
+        n_cards=args.cards,
+        latency=args.latency,
+    )
+    output = args.output or RESULTS_DIR / f"{results['meta']['commit']}.json"
+    save_results(results, output)
+    print(f"Results written to {output}")
+else:
+    rows = compare(
+        load_results(args.reference), load_results(args.current), args.threshold
+    )
+    print(format_comparison(rows))
+    if any(row["regression"] for row in rows):
+        sys.exit(1)
@@ -0,0 +1,317 @@
+"""Timed benchmarks of the collector hot paths and of the annotation,
+and their comparison
+
+The annotation benchmarks run against an in-memory server (see
+:mod:`impomero.testing`), and also record the number of server round-trips
+of their last run.
+
+The results of a run are stored as JSON::
+
+    {
+        "meta": {"commit": ..., "version": ..., "python": ..., ...},
+        "results": {
+            "collect_annotations[1000]": {
+                "benchmark": "collect_annotations",
+                "files": 1000,
+                "best": 0.012,
+                "times": [0.013, 0.012, 0.012]
+            },
+            ...
+        }
+    }
+
+and two runs are compared benchmark by benchmark on their best time.
+"""
+import contextlib
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import time
+from pathlib import Path
+from typing import Callable, NamedTuple
+
+from impomero import collector
+from impomero.annotation_job import annotate_dataset, auto_annotate
+from impomero.cards import card_cache
+from impomero.testing import FakeGateway, FakeServer
+
+from .tree import make_tree, tree_shape
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SIZES = (10**3, 10**4)
+DEFAULT_REPEATS = 3
+# a benchmark slower than threshold times its reference is a regression
+DEFAULT_THRESHOLD = 1.2
+IMAGE_SUFFIXES = (".tif",)
+
+
+class StubCandidates:
+    """Stands for `omero.util.import_candidates`, without Bio-Formats
+
+    Each image file is its own fileset.
+    """
+
+    def __init__(self, suffixes=IMAGE_SUFFIXES):
+        self.suffixes = suffixes
+        self.calls = 0
+
+    def as_dictionary(self, paths):
+        self.calls += 1
+        found = {}
+        for path in paths:
+            if not os.path.isdir(path):
+                if path.endswith(self.suffixes):
+                    found[path] = [path]
+                continue
+            for dirpath, _, names in os.walk(path):
+                for name in names:
+                    if name.endswith(self.suffixes):
+                        found[os.path.join(dirpath, name)] = [
+                            os.path.join(dirpath, name)
+                        ]
+        return found
+
+
+@contextlib.contextmanager
+def stubbed_candidates(stub=None):
+    """Replaces the collector's import_candidates by a stub"""
+    original = collector.import_candidates
+    collector.import_candidates = stub or StubCandidates()
+    try:
+        yield collector.import_candidates
+    finally:
+        collector.import_candidates = original
+
+
+class Benchmark(NamedTuple):
+    """A timed function
+
+    setup(root, latency) is called once per tree and returns the arguments
+    of run, which is timed. before(*args) is called before each run, and
+    stats(*args) after the last one, returning a dictionnary of values
+    stored with the timings.
+    """
+
+    name: str
+    setup: Callable
+    run: Callable
+    before: Callable = None
+    stats: Callable = None
+
+
+def _parse_pairs(candidates, base_dir):
+    for candidate, annotation in candidates.items():
+        collector.parse_pair(candidate, annotation, base_dir)
+
+
+def _clear_cards(*args):
+    card_cache.clear()
+
+
+def _fake_import(root, latency):
+    """Creates the images of the tree at root on a fake server, returns
+    a root connection to it and the import table with the image ids
+    """
+    import_table = collector.create_import_table(root)
+    server = FakeServer()
+    dataset_ids = {}
+    image_ids = []
+    for dataset, project, user, fileset in import_table[
+        ["dataset", "project", "user", "fileset"]
+    ].values:
+        if dataset not in dataset_ids:
+            dataset_ids[dataset] = server.add_dataset(dataset, project, owner=user)
+        image_ids.append([server.add_image(fileset, dataset_ids[dataset])])
+    import_table["image_ids"] = image_ids
+    server.latency = latency
+    return FakeGateway(server), import_table
+
+
+def _dataset_setup(root, latency):
+    conn, import_table = _fake_import(root, latency)
+    card = import_table.iloc[0].to_dict()
+    image_ids = [img_id for ids in import_table["image_ids"] for img_id in ids]
+    return conn.suConn(card["user"]), image_ids, card
+
+
+def _reset_counts(conn, *args):
+    conn.server.reset_counts()
+
+
+def _round_trips(conn, *args):
+    return {"round_trips": conn.server.round_trips}
+
+
+BENCHMARKS = (
+    Benchmark(
+        "collect_annotations",
+        lambda root, latency: (root,),
+        collector.collect_annotations,
+        before=_clear_cards,
+    ),
+    Benchmark(
+        "collect_candidates",
+        lambda root, latency: (root, collector.collect_annotations(root)),
+        collector.collect_candidates,
+    ),
+    Benchmark(
+        "parse_pair",
+        lambda root, latency: (collector.collect_candidates(root), root),
+        _parse_pairs,
+    ),
+    Benchmark(
+        "create_import_table",
+        lambda root, latency: (root,),
+        collector.create_import_table,
+        before=_clear_cards,
+    ),
+    Benchmark(
+        "annotate_dataset",
+        _dataset_setup,
+        annotate_dataset,
+        before=_reset_counts,
+        stats=_round_trips,
+    ),
+    Benchmark(
+        "auto_annotate",
+        _fake_import,
+        auto_annotate,
+        before=_reset_counts,
+        stats=_round_trips,
+    ),
+)
+
+
+def time_benchmark(benchmark, root, repeats=DEFAULT_REPEATS, latency=0.0):
+    """Returns the durations of repeats runs of benchmark on the tree at root,
+    and its stats
+    """
+    args = benchmark.setup(root, latency)
+    times = []
+    for _ in range(repeats):
+        if benchmark.before is not None:
+            benchmark.before(*args)
+        start = time.perf_counter()
+        benchmark.run(*args)
+        times.append(time.perf_counter() - start)
+    stats = benchmark.stats(*args) if benchmark.stats is not None else {}
+    return times, stats
+
+
+def run_suite(
+    work_dir,
+    sizes=DEFAULT_SIZES,
+    repeats=DEFAULT_REPEATS,
+    benchmarks=BENCHMARKS,
+    n_cards=None,
+    latency=0.0,
+):
+    """Runs the benchmarks on trees of about each size
+
+    The trees are written in work_dir, and kept there for the next runs.
+    The fake server of the annotation benchmarks waits latency seconds
+    at each round-trip.
+
+    Returns
+    -------
+    results : dict
+        the results in the format described in the module documentation
+    """
+    work_dir = Path(work_dir)
+    results = {}
+    with stubbed_candidates():
+        for size in sizes:
+            root = (work_dir / f"tree-{size}").resolve()
+            tree = make_tree(root, depth=tree_shape(size), n_cards=n_cards)
+            for benchmark in benchmarks:
+                times, stats = time_benchmark(benchmark, root, repeats, latency)
+                key = f"{benchmark.name}[{size}]"
+                results[key] = {
+                    "benchmark": benchmark.name,
+                    "files": tree["files"],
+                    "cards": tree["n_cards"],
+                    "best": min(times),
+                    "times": times,
+                    **stats,
+                }
+                log.info("%s: %.4f s", key, min(times))
+    return {"meta": dict(run_metadata(), latency=latency), "results": results}
+
+
+def run_metadata():
+    """Describes the code and machine of the run"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = "unknown"
+    try:
+        from importlib.metadata import version
+
+        impomero_version = version("impomero")
+    except Exception:
+        impomero_version = "unknown"
+    return {
+        "commit": commit,
+        "version": impomero_version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def save_results(results, out_file):
+    out_file = Path(out_file)
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+    out_file.write_text(json.dumps(results, indent=2))
+
+
+def load_results(in_file):
+    return json.loads(Path(in_file).read_text())
+
+
+def compare(reference, current, threshold=DEFAULT_THRESHOLD):
+    """Compares the best times of two runs
+
+    Returns
+    -------
+    rows : list of dicts
+        for each benchmark of both runs, its "name", "reference" and "current"
+        best times, their "ratio" and whether it is a "regression"
+    """
+    rows = []
+    for name, result in current["results"].items():
+        if name not in reference["results"]:
+            continue
+        ref_best = reference["results"][name]["best"]
+        ratio = result["best"] / ref_best if ref_best else float("inf")
+        rows.append(
+            {
+                "name": name,
+                "reference": ref_best,
+                "current": result["best"],
+                "ratio": ratio,
+                "regression": ratio > threshold,
+            }
+        )
+    return rows
+
+
+def format_comparison(rows):
+    lines = [f"{'benchmark':<32} {'reference':>10} {'current':>10} {'ratio':>7}"]
+    for row in rows:
+        flag = "  REGRESSION" if row["regression"] else ""
+        lines.append(
+            f"{row['name']:<32} {row['reference']:>10.4f} "
+            f"{row['current']:>10.4f} {row['ratio']:>7.2f}{flag}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,107 @@
+"""Synthetic directory trees
+
+A tree has `depth` levels of `fanout` sub-directories, the leaf directories
+holding `files_per_dir` empty image files each. Cards are written in the
+first `n_cards` directories below the root met breadth first, so with more
+cards than top level directories, some cards annotate sub-directories of
+others.
+"""
+import json
+import logging
+import math
+import shutil
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+CARD = """# omero annotation file
+title = "Benchmark {index}"
+created = 2021-04-26T07:58:50.254758
+accessed = "2021-04-26 10:23:09.698404"
+project = "Benchmark project {index}"
+user = "bench"
+tags = ["benchmark", "card-{index}"]
+comment = "synthetic card {index}"
+
+[kv_pairs]
+index = "{index}"
+"""
+
+FILES_PER_DIR = 100
+FANOUT = 10
+# changes when the content of the trees changes, so they are written again
+TREE_VERSION = 1
+
+
+def tree_shape(n_files, files_per_dir=FILES_PER_DIR, fanout=FANOUT):
+    """Returns the depth of the tree holding about n_files files"""
+    n_dirs = max(n_files / files_per_dir, 1)
+    return max(round(math.log(n_dirs, fanout)), 1)
+
+
+def make_tree(
+    root,
+    depth: int = 2,
+    fanout: int = FANOUT,
+    files_per_dir: int = FILES_PER_DIR,
+    n_cards: int = None,
+):
+    """Writes a synthetic tree below root
+
+    The tree is only written once for a given set of parameters, its
+    description is stored in a `tree.json` file at its root.
+
+    Parameters
+    ----------
+    root : str or Path
+        the directory of the tree, emptied if it holds another tree
+    depth : int
+        number of directory levels below root
+    fanout : int
+        number of sub-directories of each directory
+    files_per_dir : int
+        number of image files in each leaf directory
+    n_cards : int, optional
+        number of annotation cards, by default one per top level directory
+
+    Returns
+    -------
+    description : dict
+        the parameters of the tree, with its number of "files" and "dirs"
+    """
+    root = Path(root)
+    if n_cards is None:
+        n_cards = fanout
+    description = {
+        "version": TREE_VERSION,
+        "depth": depth,
+        "fanout": fanout,
+        "files_per_dir": files_per_dir,
+        "n_cards": n_cards,
+        "files": files_per_dir * fanout**depth,
+        "dirs": sum(fanout**level for level in range(depth + 1)),
+    }
+    marker = root / "tree.json"
+    if marker.exists() and json.loads(marker.read_text()) == description:
+        return description
+    if root.exists():
+        shutil.rmtree(root)
+
+    log.info("Writing a %d files tree in %s", description["files"], root)
+    level = [root]
+    cards = 0
+    for depth_ in range(depth + 1):
+        next_level = []
+        for directory in level:
+            directory.mkdir(parents=True, exist_ok=True)
+            if depth_ and cards < n_cards:
+                (directory / "card.toml").write_text(CARD.format(index=cards))
+                cards += 1
+            if depth_ == depth:
+                for i in range(files_per_dir):
+                    (directory / f"img{i:04d}.tif").touch()
+            else:
+                next_level.extend(directory / f"d{i:03d}" for i in range(fanout))
+        level = next_level
+    marker.write_text(json.dumps(description))
+    return description
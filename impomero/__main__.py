@@ -2,12 +2,31 @@
 """Auto import script from a user directory
 """
 import argparse
+import logging
 import os
 
+from .coalescer import DEFAULT_QUIET_PERIOD
+from .collector import DEDUP_MODES
+from .db import DEFAULT_JOURNAL_MODE
+from .jobs import DEFAULT_LEASE
 from .monitor import start_toml_observer
+from .observer import DEFAULT_INTERVAL
+from .roots import load_roots
+from .tracing import configure_tracing
 
 parser = argparse.ArgumentParser()
-parser.add_argument("path", help="path to the directory you want to import into omero")
+parser.add_argument(
+    "path",
+    help="paths to the directories you want to import into omero",
+    nargs="*",
+)
+parser.add_argument(
+    "-c",
+    "--config",
+    help="toml file listing the directories to watch, "
+    "with their polling intervals (see impomero.roots)",
+    default=None,
+)
 parser.add_argument(
     "-d",
     "--dry_run",
@@ -21,13 +40,107 @@ parser.add_argument(
     help="Use symbolic links to raw data",
     action="store_true",
 )
+parser.add_argument(
+    "-i",
+    "--interval",
+    help=f"default polling interval in seconds (default {DEFAULT_INTERVAL})",
+    type=float,
+    default=DEFAULT_INTERVAL,
+)
+parser.add_argument(
+    "-q",
+    "--quiet_period",
+    help="seconds without events on a card before it is processed "
+    f"(default {DEFAULT_QUIET_PERIOD})",
+    type=float,
+    default=DEFAULT_QUIET_PERIOD,
+)
+parser.add_argument(
+    "-w",
+    "--workers",
+    help="number of (user, group) batches imported concurrently (default 1)",
+    type=int,
+    default=1,
+)
+parser.add_argument(
+    "--max_jobs",
+    help="number of directories processed concurrently (default 1)",
+    type=int,
+    default=1,
+)
+parser.add_argument(
+    "--lease",
+    help="seconds a job stays leased to this process without renewal, "
+    "before other processes sharing the DB can take it over "
+    f"(default {DEFAULT_LEASE:g})",
+    type=float,
+    default=DEFAULT_LEASE,
+)
+parser.add_argument(
+    "-j",
+    "--journal_mode",
+    help="journal mode of the sqlite DB, 'delete' is needed if the DB is on a "
+    "network file system, e.g. shared by several hosts (default "
+    f"{DEFAULT_JOURNAL_MODE}: 'delete' on a network file system, else 'wal')",
+    default=DEFAULT_JOURNAL_MODE,
+)
+parser.add_argument(
+    "-s",
+    "--stream",
+    help="import new directories by batches while they are walked",
+    action="store_true",
+)
+parser.add_argument(
+    "--dedup",
+    help="what to do with the files whose content was already imported: "
+    "flag them, drop them or link the existing images to the new dataset "
+    "(by default the content is not checked)",
+    choices=DEDUP_MODES,
+    default=None,
+)
+parser.add_argument(
+    "--log_file",
+    help="file where the logs are written",
+    default="auto_importer.log",
+)
+parser.add_argument(
+    "--trace",
+    help="file where the timings of the pipeline stages are written as JSON lines",
+    default=None,
+)
 
 
 args = parser.parse_args()
+logging.basicConfig(
+    handlers=[logging.FileHandler(args.log_file, encoding="utf-8")],
+    level=logging.INFO,
+    format="%(asctime)s %(name)s %(levelname)s %(message)s",
+)
+if args.trace is not None:
+    configure_tracing(args.trace)
 transfer = "ln_s" if args.link else None
 
 db = os.environ.get("IMPOMERO_DB")
 if db is None:
-    db = os.path.join(os.environ.get("HOME", "impomero.sql"))
+    db = os.path.join(os.environ.get("HOME", ""), "impomero.sql")
+
+roots = list(args.path)
+if args.config is not None:
+    roots.extend(load_roots(args.config, args.interval))
+if not roots:
+    parser.error("no directory to watch, pass paths or a --config file")
 
-start_toml_observer(args.path, transfer=transfer, dry_run=args.dry_run, import_db=db)
+start_toml_observer(
+    roots,
+    transfer=transfer,
+    dry_run=args.dry_run,
+    import_db=db,
+    interval=args.interval,
+    quiet_period=args.quiet_period,
+    import_workers=args.workers,
+    journal_mode=args.journal_mode,
+    stream=args.stream,
+    dedup=args.dedup,
+    max_jobs=args.max_jobs,
+    lease=args.lease,
+)
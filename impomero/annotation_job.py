@@ -12,76 +12,237 @@ Example annotation file
 # TODO finish module level doc
 
 
+import json
 import logging
-from functools import wraps
 
-import omero
 import pandas as pd
-import toml
 from omero.gateway import (
     CommentAnnotationWrapper,
     MapAnnotationWrapper,
     TagAnnotationWrapper,
 )
+from omero.model import (
+    CommentAnnotationI,
+    DatasetI,
+    DatasetImageLinkI,
+    ImageAnnotationLinkI,
+    ImageI,
+    MapAnnotationI,
+    NamedValue,
+    TagAnnotationI,
+)
+from omero.rtypes import rlist, rlong, rstring, unwrap
+from omero.sys import ParametersI
+
+from . import tracing
+from .cards import load_card
+from .lookup import DatasetLookup
+from .tags import TagResolver
 
 log = logging.getLogger(__name__)
-logfile = logging.FileHandler("auto_importer.log", encoding="utf-8")
-log.setLevel("INFO")
-log.addHandler(logfile)
 
+DEFAULT_CHUNK_SIZE = 500
 
-def auto_reconnect(fun):
-    """Auto reconnection decorator, assumes the connection object is the
-    first argument of the decorated function"""
-    # assumes the connection object is the first argument
-    @wraps(fun)
-    def decorrated(*args, **kwargs):
-        conn = args[0]
-        if not conn.isConnected():
-            conn.connect()
-        return fun(*args, **kwargs)
+EXISTING_LINKS = (
+    "select l.parent.id, l.child.id from ImageAnnotationLink l "
+    "where l.parent.id in (:iids) and l.child.id in (:aids)"
+)
 
-    return decorrated
+EXISTING_LINK_IDS = (
+    "select l.id from ImageAnnotationLink l "
+    "where l.parent.id in (:iids) and l.child.id in (:aids)"
+)
 
+ALL_LINKS = "select l.id from ImageAnnotationLink l where l.parent.id in (:iids)"
 
-@auto_reconnect
-def auto_annotate(conn, import_table, dry_run=False):
+COMMENT_LINK_IDS = (
+    "select l.id from ImageAnnotationLink l, CommentAnnotation c "
+    "where l.child.id = c.id and l.parent.id in (:iids) and c.textValue = :text"
+)
+
+DATASET_LINKS = (
+    "select l.child.id from DatasetImageLink l "
+    "where l.parent.id = :did and l.child.id in (:iids)"
+)
+
+# namespace of the map annotations created from the cards, the maps
+# of the other namespaces (e.g. added by hand) are never modified
+CARD_NAMESPACE = "impomero/card"
+
+LINKED_MAPS = (
+    "select distinct m from ImageAnnotationLink l, MapAnnotation m "
+    "where l.child.id = m.id and l.parent.id in (:iids) and m.ns = :ns"
+)
+
+
+def auto_annotate(
+    conn,
+    import_table,
+    dry_run=False,
+    tag_resolver=None,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    sessions=None,
+    lookup=None,
+):
     """Uses the import_table to annotate all the images
     from the imported dataset
+
+    The tags of each user are resolved in one go, through tag_resolver
+    if it is passed (see :class:`impomero.tags.TagResolver`), and each
+    dataset is annotated in bulk (see :func:`annotate_dataset`)
+
+    If the import table has the "image_ids" of each imported file (see
+    :func:`impomero.importer_job.auto_import`), exactly those images are
+    annotated, else all the images of the dataset are, as found through
+    lookup (see :class:`impomero.lookup.DatasetLookup`, a new one by default).
+
+    If sessions is passed (see :class:`impomero.connection.ConnectionManager`),
+    the user sessions are taken from this pool, else a sudo session is opened
+    from the root connection conn and closed once the user is done.
+
+    The rows flagged with "link" (see :func:`impomero.collector.mark_duplicates`)
+    were not imported again, their existing images are first linked to the
+    dataset (see :func:`link_images`).
     """
+    if tag_resolver is None:
+        tag_resolver = TagResolver()
+    if lookup is None:
+        lookup = DatasetLookup()
     # all images from a given dataset
     # are annotated by the same data
     dset_table = import_table.groupby("dataset").first()
+    if "image_ids" in import_table:
+        dset_table["image_ids"] = pd.Series(
+            {
+                dset: _merge_image_ids(image_ids)
+                for dset, image_ids in import_table.groupby("dataset")["image_ids"]
+            },
+            dtype=object,
+        )
+    origins = _image_origins(import_table)
     annotated = []
-    for dset_name, row in dset_table.iterrows():
-        user = row["user"]
+    with tracing.span("annotate", datasets=len(dset_table)) as span:
+        for user, user_table in dset_table.groupby("user"):
+            annotated.extend(
+                _annotate_user(
+                    conn,
+                    sessions,
+                    user,
+                    user_table,
+                    import_table,
+                    dry_run,
+                    tag_resolver,
+                    lookup,
+                    chunk_size,
+                    origins,
+                )
+            )
+        span.set(images=len(annotated))
+
+    return pd.DataFrame.from_records(annotated)
+
+
+def _annotate_user(
+    conn,
+    sessions,
+    user,
+    user_table,
+    import_table,
+    dry_run,
+    tag_resolver,
+    lookup,
+    chunk_size,
+    origins,
+):
+    if sessions is None:
+        tracing.count(server_calls=1)
         user_conn = conn.suConn(user)
-        try:
-            dset_id = _find_dataset_id(user_conn, dset_name, row["project"])["dataset"]
-        except ValueError:
-            # Try with quotes
-            dset_id = _find_dataset_id(user_conn, f'"{dset_name}"', row["project"])[
-                "dataset"
-            ]
-
-        dataset = user_conn.getObject("Dataset", dset_id)
-        for image in dataset.listChildren():
-            img_id = image.getId()
+    else:
+        user_conn = sessions.checkout(user)
+    try:
+        if not dry_run:
+            _prepare_user(
+                user_conn, import_table, user, tag_resolver, lookup, chunk_size
+            )
+        return _annotate_datasets(
+            user_conn, user_table, dry_run, tag_resolver, lookup, chunk_size, origins
+        )
+    finally:
+        if sessions is None:
+            user_conn.close()
+        else:
+            sessions.checkin(user_conn)
+
+
+def _prepare_user(user_conn, import_table, user, tag_resolver, lookup, chunk_size):
+    user_rows = import_table[import_table["user"] == user]
+    tags = [tag for tags in user_rows["tags"] for tag in tags]
+    if tags:
+        tag_resolver.resolve(user_conn, tags)
+    if "link" not in import_table:
+        return
+    to_link = user_rows[user_rows["link"].fillna(False).astype(bool)]
+    for (project, dataset), rows in to_link.groupby(["project", "dataset"]):
+        dset_id = lookup.dataset_id(user_conn, project, dataset, create=True)
+        image_ids = [img_id for ids in rows["duplicate_of"] for img_id in ids]
+        link_images(user_conn, dset_id, image_ids, chunk_size=chunk_size)
+
+
+def _image_origins(import_table):
+    """Returns the file path and fingerprint of each image with a known id"""
+    if "image_ids" not in import_table:
+        return {}
+    columns = [col for col in ("file_path", "fingerprint") if col in import_table]
+    origins = {}
+    for image_ids, *values in import_table[["image_ids"] + columns].values:
+        if isinstance(image_ids, list):
+            for img_id in image_ids:
+                origins[img_id] = dict(zip(columns, values))
+    return origins
+
+
+def _merge_image_ids(image_ids):
+    """Returns the image ids of all the files, or None if some are unknown"""
+    if any(ids is None for ids in image_ids):
+        return None
+    return [img_id for ids in image_ids for img_id in ids]
+
+
+def _annotate_datasets(
+    user_conn, dset_table, dry_run, tag_resolver, lookup, chunk_size, origins
+):
+    annotated = []
+    for dset_name, row in dset_table.iterrows():
+        with tracing.span("annotate_dataset", dataset=dset_name) as span:
+            image_ids = row.get("image_ids")
+            if not isinstance(image_ids, list):
+                dset_id = lookup.dataset_id(user_conn, row["project"], dset_name)
+                image_ids = lookup.image_ids(user_conn, dset_id)
+            span.set(images=len(image_ids))
             if dry_run:
-                print(f"would annotate image {img_id} with card {row['title']}")
+                for img_id in image_ids:
+                    print(f"would annotate image {img_id} with card {row['title']}")
                 continue
-            annotate(user_conn, img_id, row, object_type="Image")
-            rec = _flatten(row)
-            rec["id"] = img_id
-            annotated.append(rec)
-
-    return pd.DataFrame.from_records(annotated)
+            annotate_dataset(
+                user_conn,
+                image_ids,
+                row,
+                tag_resolver=tag_resolver,
+                chunk_size=chunk_size,
+            )
+        rec = _flatten(row)
+        for img_id in image_ids:
+            annotated.append(dict(rec, id=img_id, **origins.get(img_id, {})))
+    return annotated
 
 
 def _flatten(row):
     """use sql serilizable data types"""
 
     rec = dict(row)
+    # import bookkeeping, not part of the annotation
+    for key in ("batch", "import_status", "image_ids", "duplicate_of", "link"):
+        rec.pop(key, None)
     rec["accessed"] = str(rec["accessed"])
     for key, val in row["kv_pairs"].items():
         rec[key] = val
@@ -90,8 +251,7 @@ def _flatten(row):
     return rec
 
 
-# @auto_reconnect (see GH #295)
-def annotate(conn, object_id, ann, object_type="Image"):
+def annotate(conn, object_id, ann, object_type="Image", tag_resolver=None):
     """Applies the annotations in `ann` to the object
 
     Parameters
@@ -101,6 +261,7 @@ def annotate(conn, object_id, ann, object_type="Image"):
     object_id: int - the Id of the dataset to annotate
     ann: dict containing the annotation
     oject_type: the omero object type to annotate (default "Image")
+    tag_resolver: a :class:`impomero.tags.TagResolver` instance (optional)
 
 
     """
@@ -112,16 +273,14 @@ def annotate(conn, object_id, ann, object_type="Image"):
     if kv_pairs:
         update_mapannotation(conn, annotated, kv_pairs)
 
-    for tag in ann.get("tags", []):
-        log.info("Adding tag: %s", tag)
-        matches = list(conn.getObjects("TagAnnotation", attributes={"textValue": tag}))
-        if matches:
-            tag_ann = matches[0]
-        else:
-            tag_ann = TagAnnotationWrapper(conn)
-            tag_ann.setValue(tag)
-            tag_ann.save()
-        annotated.linkAnnotation(tag_ann)
+    tags = ann.get("tags", [])
+    if tags:
+        if tag_resolver is None:
+            tag_resolver = TagResolver()
+        for tag, tag_id in tag_resolver.resolve(conn, tags).items():
+            log.info("Adding tag: %s", tag)
+            tag_ann = TagAnnotationWrapper(conn, TagAnnotationI(tag_id, False))
+            annotated.linkAnnotation(tag_ann)
 
     comment = ann.get("comment", "")
     if comment:
@@ -132,23 +291,329 @@ def annotate(conn, object_id, ann, object_type="Image"):
         annotated.linkAnnotation(com_ann)
 
 
-def _find_dataset_id(conn, dataset, project):
-    """Query the omero db to find the dataset id based on its name"""
-    dsets = conn.getObjects("Dataset", attributes={"name": dataset})
+def annotate_dataset(
+    conn, image_ids, ann, tag_resolver=None, chunk_size=DEFAULT_CHUNK_SIZE
+):
+    """Applies the annotations in `ann` to all the images in image_ids
+
+    The comment and the key-value pairs are stored in a single comment and
+    a single map annotation, shared by all the images. The links are saved
+    by chunks of chunk_size, so the number of server round-trips depends on
+    the number of images only through the number of chunks.
+
+    Parameters
+    ----------
+
+    conn: An `omero.gateway.BlitzGateway` connection
+    image_ids: list of int - the Ids of the images to annotate
+    ann: dict containing the annotation
+    tag_resolver: a :class:`impomero.tags.TagResolver` instance (optional)
+    chunk_size: int - the number of links saved at once
+
+    Returns
+    -------
+    n_links: int - the number of links created
+    """
+    log.info("Annotating %d images with %s", len(image_ids), ann["title"])
+    if not image_ids:
+        return 0
+
+    ann_ids = []
+    tags = ann.get("tags", [])
+    if tags:
+        if tag_resolver is None:
+            tag_resolver = TagResolver()
+        tag_ids = tag_resolver.resolve(conn, tags)
+        log.info("Adding tags: %s", ", ".join(tag_ids))
+        ann_ids.extend(tag_ids.values())
+
+    # tags may already be linked to some of the images,
+    # the new comment and map are not
+    new_anns = []
+    comment = ann.get("comment", "")
+    if comment:
+        log.info(f"Adding comment: {comment}")
+        new_anns.append(_new_comment(comment))
+
+    kv_pairs = ann.get("kv_pairs")
+    if kv_pairs:
+        log.info("Map annotations: ")
+        log.info("\n".join([f"{k}: {v}" for k, v in kv_pairs.items()]))
+        new_anns.append(_new_map(kv_pairs))
+
+    return _link_annotations(conn, image_ids, ann_ids, new_anns, chunk_size)
+
 
-    for dset in dsets:
-        projs = [p for p in dset.getAncestry() if p.name in (f'"{project}"', project)]
-        if projs:
-            log.info(f"Found dataset {dataset} of project {project}")
-            return {"dataset": dset.getId(), "project": projs[0].getId()}
-        raise ValueError(f"No {dataset} associated with project {project}")
-    raise ValueError(f"No dataset {dataset} was found in the base")
+def _link_annotations(conn, image_ids, tag_ids, new_anns, chunk_size):
+    """Links the tags with ids tag_ids and the unsaved annotations new_anns
+    to the images, returns the number of links created
+    """
+    update = conn.getUpdateService()
+    if new_anns:
+        tracing.count(server_calls=1)
+        new_anns = update.saveAndReturnArray(new_anns, conn.SERVICE_OPTS)
+
+    n_links = 0
+    for start in range(0, len(image_ids), chunk_size):
+        chunk = image_ids[start : start + chunk_size]
+        linked = _existing_links(conn, chunk, tag_ids) if tag_ids else set()
+        links = [
+            _image_link(img_id, TagAnnotationI(tag_id, False))
+            for img_id in chunk
+            for tag_id in tag_ids
+            if (img_id, tag_id) not in linked
+        ]
+        links.extend(
+            _image_link(img_id, new_ann.__class__(new_ann.getId().getValue(), False))
+            for img_id in chunk
+            for new_ann in new_anns
+        )
+        if links:
+            tracing.count(server_calls=1)
+            update.saveArray(links, conn.SERVICE_OPTS)
+        n_links += len(links)
+    return n_links
+
+
+def _new_comment(comment):
+    com_ann = CommentAnnotationI()
+    com_ann.setTextValue(rstring(comment))
+    return com_ann
+
+
+def _new_map(kv_pairs):
+    map_ann = MapAnnotationI()
+    map_ann.setNs(rstring(CARD_NAMESPACE))
+    map_ann.setMapValue([NamedValue(k, str(v)) for k, v in kv_pairs.items()])
+    return map_ann
+
+
+def _image_link(img_id, annotation):
+    link = ImageAnnotationLinkI()
+    link.setParent(ImageI(img_id, False))
+    link.setChild(annotation)
+    return link
+
+
+def _existing_links(conn, image_ids, ann_ids):
+    """Returns the (image id, annotation id) pairs already linked"""
+    params = ParametersI()
+    params.add("iids", rlist([rlong(img_id) for img_id in image_ids]))
+    params.add("aids", rlist([rlong(ann_id) for ann_id in ann_ids]))
+    tracing.count(server_calls=1)
+    rows = conn.getQueryService().projection(EXISTING_LINKS, params, conn.SERVICE_OPTS)
+    return {tuple(row) for row in unwrap(rows)}
+
+
+def link_images(conn, dataset_id, image_ids, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Links already imported images to a dataset
+
+    The images already in the dataset are left alone.
+
+    Returns
+    -------
+    n_links: int, the number of links created
+    """
+    existing = set(
+        _query_chunks(conn, DATASET_LINKS, image_ids, chunk_size, did=rlong(dataset_id))
+    )
+    links = []
+    for img_id in dict.fromkeys(image_ids):
+        if img_id in existing:
+            continue
+        link = DatasetImageLinkI()
+        link.setParent(DatasetI(dataset_id, False))
+        link.setChild(ImageI(img_id, False))
+        links.append(link)
+    update = conn.getUpdateService()
+    for start in range(0, len(links), chunk_size):
+        tracing.count(server_calls=1)
+        update.saveArray(links[start : start + chunk_size], conn.SERVICE_OPTS)
+    log.info("Linked %d images to dataset %d", len(links), dataset_id)
+    return len(links)
+
+
+def normalize_card(card):
+    """Returns a copy of card as it is stored in the import DB"""
+    return json.loads(json.dumps(card, default=str))
+
+
+def diff_cards(old, new):
+    """Compares two versions of a card
+
+    Returns
+    -------
+    diff: dict with keys:
+
+    * "added_tags", "removed_tags": lists of tags
+    * "kv_set": dict of the new or changed key-value pairs
+    * "kv_removed": list of removed keys
+    * "old_comment", "new_comment": the comments, equal if unchanged
+
+    Both cards are compared as they are stored in the import DB, i.e. with
+    their non JSON values (e.g. toml dates) as strings.
+    """
+    old, new = normalize_card(old), normalize_card(new)
+    old_tags, new_tags = old.get("tags", []), new.get("tags", [])
+    old_kv, new_kv = old.get("kv_pairs") or {}, new.get("kv_pairs") or {}
+    return {
+        "added_tags": [tag for tag in new_tags if tag not in old_tags],
+        "removed_tags": [tag for tag in old_tags if tag not in new_tags],
+        "kv_set": {
+            k: v for k, v in new_kv.items() if k not in old_kv or old_kv[k] != v
+        },
+        "kv_removed": [k for k in old_kv if k not in new_kv],
+        "old_comment": old.get("comment", ""),
+        "new_comment": new.get("comment", ""),
+    }
+
+
+def update_dataset_annotations(
+    conn,
+    image_ids,
+    new_card,
+    old_card=None,
+    tag_resolver=None,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+):
+    """Updates the annotations of the images from old_card to new_card
+
+    Only the differences between the two cards are applied: tags added or
+    removed, key-value pairs changed in the map annotations, and the comment
+    replaced if it changed. All the links to remove are deleted in a single
+    request.
+
+    If old_card is None (the previous state is unknown), all the annotations
+    of the images are unlinked and new_card is applied from scratch.
+
+    Returns
+    -------
+    diff: dict, as returned by :func:`diff_cards`, or None if old_card is None
+    """
+    if not image_ids:
+        return None
+    if tag_resolver is None:
+        tag_resolver = TagResolver()
+
+    if old_card is None:
+        _replace_annotations(conn, image_ids, new_card, tag_resolver, chunk_size)
+        return None
+
+    diff = diff_cards(old_card, new_card)
+    log.info("Updating %d images with %s", len(image_ids), diff)
+    link_ids = _obsolete_links(conn, image_ids, diff, tag_resolver, chunk_size)
+    if link_ids:
+        tracing.count(server_calls=1)
+        conn.deleteObjects("ImageAnnotationLink", link_ids, wait=True)
+
+    new_anns = []
+    if diff["old_comment"] != diff["new_comment"] and diff["new_comment"]:
+        new_anns.append(_new_comment(diff["new_comment"]))
+    if diff["kv_set"] or diff["kv_removed"]:
+        if not _update_maps(conn, image_ids, diff, chunk_size):
+            new_anns.append(_new_map(new_card.get("kv_pairs") or {}))
+
+    tag_ids = []
+    if diff["added_tags"]:
+        tag_ids = list(tag_resolver.resolve(conn, diff["added_tags"]).values())
+    if tag_ids or new_anns:
+        _link_annotations(conn, image_ids, tag_ids, new_anns, chunk_size)
+    return diff
+
+
+def _replace_annotations(conn, image_ids, card, tag_resolver, chunk_size):
+    log.info("No previous state, replacing all annotations")
+    link_ids = _query_chunks(conn, ALL_LINKS, image_ids, chunk_size)
+    if link_ids:
+        tracing.count(server_calls=1)
+        conn.deleteObjects("ImageAnnotationLink", link_ids, wait=True)
+    annotate_dataset(conn, image_ids, card, tag_resolver, chunk_size)
+
+
+def _obsolete_links(conn, image_ids, diff, tag_resolver, chunk_size):
+    """Returns the ids of the links to the removed tags and to the previous
+    comment if it changed
+    """
+    link_ids = []
+    if diff["removed_tags"]:
+        tag_ids = tag_resolver.resolve(conn, diff["removed_tags"], create=False)
+        if tag_ids:
+            link_ids.extend(
+                _query_chunks(
+                    conn,
+                    EXISTING_LINK_IDS,
+                    image_ids,
+                    chunk_size,
+                    aids=rlist([rlong(tag_id) for tag_id in tag_ids.values()]),
+                )
+            )
+    if diff["old_comment"] != diff["new_comment"] and diff["old_comment"]:
+        link_ids.extend(
+            _query_chunks(
+                conn,
+                COMMENT_LINK_IDS,
+                image_ids,
+                chunk_size,
+                text=rstring(diff["old_comment"]),
+            )
+        )
+    return link_ids
+
+
+def _update_maps(conn, image_ids, diff, chunk_size):
+    """Applies the key-value changes to the map annotations of the images
+    created from their card, in the :data:`CARD_NAMESPACE` namespace
+
+    Returns the number of map annotations updated
+    """
+    namespace = rstring(CARD_NAMESPACE)
+    map_anns = {}
+    for params in _chunk_params(image_ids, chunk_size, ns=namespace):
+        tracing.count(server_calls=1)
+        for map_ann in conn.getQueryService().findAllByQuery(
+            LINKED_MAPS, params, conn.SERVICE_OPTS
+        ):
+            map_anns[map_ann.getId().getValue()] = map_ann
+
+    for map_ann in map_anns.values():
+        values = {
+            pair.name: pair.value
+            for pair in map_ann.getMapValue() or []
+            if pair.name not in diff["kv_removed"]
+        }
+        values.update({k: str(v) for k, v in diff["kv_set"].items()})
+        map_ann.setMapValue([NamedValue(k, v) for k, v in values.items()])
+    if map_anns:
+        tracing.count(server_calls=1)
+        conn.getUpdateService().saveArray(list(map_anns.values()), conn.SERVICE_OPTS)
+    return len(map_anns)
+
+
+def _query_chunks(conn, query, image_ids, chunk_size, **params):
+    """Runs a projection query returning single ids for chunks of image ids"""
+    ids = []
+    for query_params in _chunk_params(image_ids, chunk_size, **params):
+        tracing.count(server_calls=1)
+        rows = conn.getQueryService().projection(query, query_params, conn.SERVICE_OPTS)
+        ids.extend(row[0] for row in unwrap(rows))
+    return ids
+
+
+def _chunk_params(image_ids, chunk_size, **params):
+    """Yields query parameters with chunks of image_ids as "iids"
+    and the other keyword arguments
+    """
+    for start in range(0, len(image_ids), chunk_size):
+        chunk = image_ids[start : start + chunk_size]
+        query_params = ParametersI()
+        query_params.add("iids", rlist([rlong(img_id) for img_id in chunk]))
+        for key, value in params.items():
+            query_params.add(key, value)
+        yield query_params
 
 
-@auto_reconnect
 def update_annotation(conn, object_id, annotation_path, object_type="Image"):
-    with open(annotation_path, "r", encoding="utf-8") as fh:
-        annotation = toml.load(fh)
+    annotation = load_card(annotation_path)
 
     annotated = conn.getObject(object_type, object_id)
     to_delete = []
@@ -159,15 +624,15 @@ def update_annotation(conn, object_id, annotation_path, object_type="Image"):
     annotate(conn, object_id, annotation, object_type)
 
 
-@auto_reconnect
 def update_mapannotation(conn, annotated, kv_pairs):
-    """Search for MapAnnotations associated to the annotated object
-    and updates **the first map it finds** (in the dictionnary update sense)
-    or creates a new one if no map annotation was present.
+    """Search for MapAnnotations of the :data:`CARD_NAMESPACE` namespace
+    associated to the annotated object and updates **the first map it finds**
+    (in the dictionnary update sense) or creates a new one if no such map
+    annotation was present.
     """
     log.info("Map annotations: ")
     log.info("\n".join([f"{k}: {v}" for k, v in kv_pairs.items()]))
-    for map_ann in annotated.listAnnotations():
+    for map_ann in annotated.listAnnotations(ns=CARD_NAMESPACE):
         if isinstance(map_ann, MapAnnotationWrapper):
             vals = dict(map_ann.getValue())
             vals.update(kv_pairs)
@@ -175,8 +640,7 @@ def update_mapannotation(conn, annotated, kv_pairs):
             break
     else:
         map_ann = MapAnnotationWrapper(conn)
-        namespace = omero.constants.metadata.NSCLIENTMAPANNOTATION
-        map_ann.setNs(namespace)
+        map_ann.setNs(CARD_NAMESPACE)
         map_ann.setValue(list(kv_pairs.items()))
 
     map_ann.save()
@@ -0,0 +1,120 @@
+"""Cached access to the annotation cards
+
+The same card is read by the collector for each of the files it
+annotates, and again by the annotator for each imported image. Cards
+are cached here, keyed by their path and checked against their inode,
+modification time and size, so that each version of a file is only
+parsed once.
+"""
+import copy
+import logging
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+import toml
+
+log = logging.getLogger(__name__)
+
+CARD_HEADER = "# omero annotation file"
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+class _Entry:
+    __slots__ = ("signature", "header", "annotation")
+
+    def __init__(self, signature, header, annotation=None):
+        self.signature = signature
+        self.header = header
+        self.annotation = annotation
+
+
+class CardCache:
+    """Least recently used cache of parsed toml cards
+
+    Parameters
+    ----------
+    maxsize : int, default 1024
+        maximum number of cards kept in memory
+
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def has_header(self, path):
+        """Returns True if the first line of the file contains the card header
+
+        The file is parsed at the same time if this is the case.
+        """
+        return self._get(path, parse=False).header
+
+    def load(self, path):
+        """Returns the content of the toml file as a dictionnary
+
+        The returned dictionnary is a copy and can be modified freely.
+        """
+        return copy.deepcopy(self._get(path, parse=True).annotation)
+
+    def info(self):
+        """Returns the cache statistics as a
+        (hits, misses, maxsize, currsize) named tuple
+        """
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+    def invalidate(self, path):
+        """Removes path from the cache"""
+        with self._lock:
+            self._entries.pop(os.path.abspath(path), None)
+
+    def clear(self):
+        """Empties the cache and resets the statistics"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def _get(self, path, parse):
+        key = os.path.abspath(path)
+        stat = os.stat(key)
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(key)
+            if (
+                entry is not None
+                and entry.signature == signature
+                and (entry.annotation is not None or not parse)
+            ):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        with open(key, "r", encoding="utf-8") as fh:
+            text = fh.read()
+        header = CARD_HEADER in text.split("\n", 1)[0]
+        # cards are always parsed, other toml files only on demand
+        annotation = toml.loads(text) if (parse or header) else None
+        log.debug("Read card %s", key)
+        entry = _Entry(signature, header, annotation)
+
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+
+card_cache = CardCache()
+
+
+def load_card(path):
+    """Returns the content of the card at path, read through the shared cache"""
+    return card_cache.load(path)
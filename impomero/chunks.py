@@ -0,0 +1,104 @@
+"""Splitting of the import batches in balanced chunks
+
+A (user, group) batch can hold a handful of files or hundreds of
+thousands. Each batch is split in chunks of comparable file count and
+size, imported by separate `omero import --bulk` calls, so a large batch
+is spread over the import workers and a failure only affects one chunk.
+"""
+import hashlib
+import heapq
+import logging
+import math
+import os
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_FILES = 1000
+DEFAULT_CHUNK_BYTES = 50 * 2**30
+
+
+def file_size(path):
+    """Returns the size of the file at path, 0 if it can't be read"""
+    try:
+        return os.stat(path).st_size
+    except OSError as err:
+        log.warning("Could not stat %s: %s", path, err)
+        return 0
+
+
+def _n_chunks(sizes, max_files, max_bytes):
+    return max(math.ceil(len(sizes) / max_files), math.ceil(sum(sizes) / max_bytes), 1)
+
+
+def split_chunks(
+    table,
+    sizes,
+    max_files: int = DEFAULT_CHUNK_FILES,
+    max_bytes: int = DEFAULT_CHUNK_BYTES,
+):
+    """Splits the rows of an import table in chunks balanced by file count
+    and total size
+
+    The split only depends on the content of the table, so a table split
+    again after a restart gives the same chunks.
+
+    Parameters
+    ----------
+    table : pd.DataFrame
+        import table of a single (user, group) batch
+    sizes : pd.Series or dict
+        size of the file of each row, in bytes, by index label
+    max_files : int
+        maximum number of files per chunk
+    max_bytes : int
+        target maximum number of bytes per chunk (a single larger
+        file gets a chunk of its own)
+
+    Returns
+    -------
+    seeds : list of lists
+        the index labels of the rows of the seed chunks, in table order.
+        If there is more than one chunk, the seed chunks hold the first row
+        of each dataset, and must be imported before the others so that the
+        datasets are created only once. They are capped like the others.
+    chunks : list of lists
+        the index labels of the rows of the other chunks, in table order
+    """
+    if _n_chunks([sizes[idx] for idx in table.index], max_files, max_bytes) == 1:
+        return [], [list(table.index)]
+
+    seed = list(table.groupby("dataset", sort=False).head(1).index)
+    seeded = set(seed)
+    rest = [idx for idx in table.index if idx not in seeded]
+    position = {idx: pos for pos, idx in enumerate(table.index)}
+    return (
+        _pack(seed, table, sizes, position, max_files, max_bytes),
+        _pack(rest, table, sizes, position, max_files, max_bytes),
+    )
+
+
+def _pack(rows, table, sizes, position, max_files, max_bytes):
+    """Packs the rows in as few balanced chunks as the limits allow"""
+    if not rows:
+        return []
+    n_chunks = _n_chunks([sizes[idx] for idx in rows], max_files, max_bytes)
+
+    # largest files first, each to the least loaded chunk
+    rows = sorted(rows, key=lambda idx: (-sizes[idx], table.at[idx, "file_path"]))
+    chunks = [[] for _ in range(n_chunks)]
+    loads = [(0.0, 0, 0, i) for i in range(n_chunks)]
+    for idx in rows:
+        _, n_files, n_bytes, i = heapq.heappop(loads)
+        chunks[i].append(idx)
+        n_files, n_bytes = n_files + 1, n_bytes + sizes[idx]
+        load = max(n_files / max_files, n_bytes / max_bytes)
+        heapq.heappush(loads, (load, n_files, n_bytes, i))
+    return [sorted(chunk, key=position.get) for chunk in chunks if chunk]
+
+
+def chunk_key(chunk):
+    """Returns a digest identifying the content of a chunk of the import table"""
+    digest = hashlib.blake2b(digest_size=16)
+    for target, file_path in sorted(zip(chunk["target"], chunk["file_path"])):
+        digest.update(f"{target}\t{file_path}\n".encode())
+    return digest.hexdigest()
@@ -0,0 +1,159 @@
+"""Coalescing of the annotation card events
+
+Saving a card usually produces a burst of events (a creation followed
+by several modifications, or the rename of a temporary file). The
+:class:`EventCoalescer` groups these events by base directory, and only
+calls back once no new event arrived for that directory during a quiet
+period.
+"""
+import logging
+import threading
+import time
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+DEFAULT_QUIET_PERIOD = 10.0
+
+
+class EventCoalescer:
+    """Debounces the card events per base directory
+
+    Parameters
+    ----------
+    callback : callable
+        called with the path of the last card seen in a base directory,
+        once the directory has been quiet for `quiet_period` seconds
+    quiet_period : float
+        time in seconds without events before the callback is fired
+    clock : callable, default `time.monotonic`
+        returns the current time in seconds
+
+    Attributes
+    ----------
+    received : int
+        number of submitted events
+    dropped : int
+        number of events superseded by a later one for the same directory
+    fired : int
+        number of callbacks fired
+    """
+
+    def __init__(
+        self,
+        callback,
+        quiet_period: float = DEFAULT_QUIET_PERIOD,
+        clock=time.monotonic,
+    ):
+        self.callback = callback
+        self.quiet_period = quiet_period
+        self.clock = clock
+        self.received = 0
+        self.dropped = 0
+        self.fired = 0
+        # base_dir -> (toml_path, deadline)
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        """Starts firing the callbacks from a background thread"""
+        self._stopped = False
+        self._thread = threading.Thread(
+            target=self._run, name="impomero-coalescer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, flush: bool = True):
+        """Stops the background thread
+
+        If flush is True, the pending callbacks are fired before returning,
+        else they are discarded.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if flush:
+            self.flush()
+        else:
+            with self._condition:
+                self._pending.clear()
+
+    def submit(self, toml_path):
+        """Registers an event for the card at toml_path"""
+        base_dir = Path(toml_path).parent
+        with self._condition:
+            self.received += 1
+            if base_dir in self._pending:
+                self.dropped += 1
+                log.debug("Coalesced event for %s", toml_path)
+            self._pending[base_dir] = (toml_path, self.clock() + self.quiet_period)
+            self._condition.notify()
+
+    def flush(self):
+        """Fires all the pending callbacks now"""
+        with self._condition:
+            due = [toml_path for toml_path, _ in self._pending.values()]
+            self._pending.clear()
+        for toml_path in due:
+            self._fire(toml_path)
+
+    def fire_due(self):
+        """Fires the callbacks of the directories quiet for long enough,
+        returns their number
+        """
+        with self._condition:
+            due = self._pop_due()
+        for toml_path in due:
+            self._fire(toml_path)
+        return len(due)
+
+    def stats(self):
+        """Returns the event counters as a dictionnary"""
+        with self._condition:
+            return {
+                "received": self.received,
+                "dropped": self.dropped,
+                "fired": self.fired,
+                "pending": len(self._pending),
+            }
+
+    def _pop_due(self):
+        now = self.clock()
+        due = [
+            base_dir
+            for base_dir, (_, deadline) in self._pending.items()
+            if deadline <= now
+        ]
+        return [self._pending.pop(base_dir)[0] for base_dir in due]
+
+    def _next_deadline(self):
+        if not self._pending:
+            return None
+        return min(deadline for _, deadline in self._pending.values())
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+                due = self._pop_due()
+                if not due:
+                    deadline = self._next_deadline()
+                    timeout = None if deadline is None else deadline - self.clock()
+                    self._condition.wait(timeout)
+                    continue
+            for toml_path in due:
+                self._fire(toml_path)
+
+    def _fire(self, toml_path):
+        with self._condition:
+            self.fired += 1
+        try:
+            self.callback(toml_path)
+        except Exception:
+            log.exception("Processing of %s failed", toml_path)
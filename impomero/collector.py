@@ -1,14 +1,28 @@
 import logging
 import os
+import time
 from pathlib import Path
 from typing import Union
 
 import pandas as pd
-import toml
 from omero.util import import_candidates
 
+from . import tracing
+from .cards import card_cache, load_card
+from .walker import scan_tree, walk
+
 log = logging.getLogger(__name__)
 
+# files passed to a single import_candidates call; each call starts
+# a JVM (a second or more), so the chunks are large
+DEFAULT_CANDIDATE_CHUNK = 100_000
+# import batches are flushed when they reach that many files
+DEFAULT_BATCH_FILES = 500
+# or when their first file waited that many seconds
+DEFAULT_BATCH_AGE = 300.0
+# what to do with the candidates whose content was already imported
+DEDUP_MODES = ("flag", "drop", "link")
+
 
 def get_configuration():
     """Get configuration from environement
@@ -33,25 +47,26 @@ def is_annotation(toml_file):
     - that the dictionnary returned by `toml.load` has the
     'project' and 'user' keys.
     """
-    with open(toml_file, "r", encoding="utf-8") as fh:
-        if "# omero annotation file" not in fh.readline():
-            return False
-        ann = toml.load(fh)
-        return {"project", "user"}.issubset(ann)
+    if not card_cache.has_header(toml_file):
+        return False
+    return {"project", "user"}.issubset(card_cache.load(toml_file))
 
 
-def collect_annotations(base_dir: Union[Path, str]):
+def collect_annotations(base_dir: Union[Path, str], scan=None):
     """Finds annotation files throughout the base_dir directory
 
     Parameters
     ----------
     base_dir : str or :class:`Path`
         the path to recursively parse to find annotation files
+    scan : :class:`impomero.walker.TreeScan`, optional
+        if given, the toml files are taken from this scan
+        instead of walking base_dir again
 
     Returns
     -------
     annotation : list of paths
-        paths to the annotation files relative to `base_dir` root
+        absolute paths to the annotation files
 
     Notes
     -----
@@ -62,13 +77,19 @@ def collect_annotations(base_dir: Union[Path, str]):
     """
 
     base_dir = Path(base_dir).resolve()
-    all_tomls = base_dir.glob("**/*.toml")
-    # This is relative to base_dir's root
-    annotation_tomls = [toml for toml in all_tomls if is_annotation(base_dir / toml)]
+    if scan is None:
+        scan = scan_tree(base_dir)
+    annotation_tomls = [toml for toml in scan.cards if is_annotation(toml)]
     return annotation_tomls
 
 
-def collect_candidates(base_dir: Union[str, Path], annotation_tomls: list = None):
+def collect_candidates(
+    base_dir: Union[str, Path],
+    annotation_tomls: list = None,
+    scan=None,
+    chunk_size: int = DEFAULT_CANDIDATE_CHUNK,
+    **kwargs,
+):
     """Finds import candidates from base_dir. Only directories with annotation files
     are imported
 
@@ -78,6 +99,16 @@ def collect_candidates(base_dir: Union[str, Path], annotation_tomls: list = None
         the path to recursively parse to find import candidates
     annotation_tomls: list (optional)
         if given, do not search for toml files before importing
+    scan : :class:`impomero.walker.TreeScan`, optional
+        if given, the files and toml files are taken from this scan
+        instead of walking base_dir again
+    chunk_size : int
+        about how many files are passed to a single `import_candidates` call.
+        Each call starts a JVM, which costs a second or more, so the files
+        of many cards are better passed together
+
+    Keyword arguments are passed to :func:`impomero.walker.walk`
+    if base_dir is walked
 
     Returns
     -------
@@ -85,37 +116,209 @@ def collect_candidates(base_dir: Union[str, Path], annotation_tomls: list = None
         keys are the paths to import candidates,
         values are the paths to their corresponing annotation file
 
+    Notes
+    -----
+    Only the files of the scan below an annotated directory are passed to
+    `import_candidates`, so the ignore patterns and maximum depth of the
+    walk apply. The files annotated by the same card are passed together,
+    other files are reported as not imported.
+
     """
     base_dir = Path(base_dir).resolve()
+    if scan is None:
+        scan = scan_tree(base_dir, **kwargs)
     if annotation_tomls is None:
-        annotation_tomls = collect_annotations(base_dir)
+        annotation_tomls = collect_annotations(base_dir, scan=scan)
+
+    card_index = _index_cards(annotation_tomls)
+    card_files = _group_by_card(scan.files, card_index)
+    to_annotate = {}
+    with tracing.span("match", cards=len(card_index)) as span:
+        n_candidates = 0
+        for files in _card_chunks(card_files, chunk_size):
+            candidates = import_candidates.as_dictionary(
+                [path.as_posix() for path in files]
+            )
+            n_candidates += len(candidates)
+            to_annotate.update(_match_cards(candidates, card_index))
+        log.info("Found %d import candidates", n_candidates)
+        span.set(candidates=n_candidates, matched=len(to_annotate))
+    return to_annotate
 
-    candidates = import_candidates.as_dictionary(base_dir.as_posix())
-    log.info("Found %d import candidates", len(candidates))
-    candidate_paths = sorted(candidates, key=lambda p: Path(p).parent.as_posix())
-    annotated_paths = list(annotation_tomls)
 
-    # sort annotated by depth, deeper first
-    annotated_paths.sort(key=lambda p: len(p.parts), reverse=True)
+def _group_by_card(files, card_index):
+    """Returns the files below each card, the others are reported
+    as not imported
+    """
+    dir_cards = {}
+    card_files = {}
+    for path in files:
+        if path.parent not in dir_cards:
+            dir_cards[path.parent] = _deepest_card(path, card_index)
+        annotated = dir_cards[path.parent]
+        if annotated is None:
+            log.info("File %s will not be imported", path)
+            continue
+        card_files.setdefault(annotated, []).append(path)
+    return card_files
+
+
+def _card_chunks(card_files, chunk_size):
+    """Yields the files by chunks of about chunk_size files,
+    the files of a card are never split
+    """
+    chunk = []
+    for annotated in sorted(card_files):
+        chunk.extend(card_files[annotated])
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _match_cards(candidates, card_index):
+    # candidates in the same directory share their card
+    dir_cards = {}
     to_annotate = {}
-    for annotated in annotated_paths:
-        for candidate in candidate_paths:
-            if candidate in to_annotate:
-                log.debug(
-                    "File %s already annotated by %s", candidate, to_annotate[candidate]
+    for candidate in sorted(candidates):
+        candidate = Path(candidate)
+        if candidate.parent not in dir_cards:
+            dir_cards[candidate.parent] = _deepest_card(candidate, card_index)
+        annotated = dir_cards[candidate.parent]
+        if annotated is None:
+            continue
+        to_annotate[candidate] = annotated
+        log.debug(f"Matched {candidate} with {annotated}")
+    return to_annotate
+
+
+def iter_candidates(
+    base_dir: Union[str, Path],
+    chunk_size: int = DEFAULT_CANDIDATE_CHUNK,
+    known=None,
+    **kwargs,
+):
+    """Yields the import candidates of base_dir with their annotation file,
+    as the tree is walked
+
+    Unlike :func:`collect_candidates`, the candidates are found while the
+    walk is in progress: the files of annotated directories are passed to
+    `import_candidates` by chunks of about chunk_size files (a directory
+    is never split), so memory does not grow with the size of the tree.
+    Each `import_candidates` call starts a JVM, which costs a second or
+    more, so chunk_size trades the memory held for the number of calls.
+    The files whose (posix) path is in known, e.g. the manifest of the
+    directory, are not passed to `import_candidates`.
+
+    Keyword arguments are passed to :func:`impomero.walker.walk`
+
+    Yields
+    ------
+    candidate : Path
+        path to the import candidate
+    annotated : Path
+        path to the annotation file of the deepest enclosing directory
+
+    Notes
+    -----
+    Multi-file formats whose files span several directories may be split
+    in several filesets, use :func:`collect_candidates` for those.
+    """
+    base_dir = Path(base_dir).resolve()
+    card_index = {}
+    files = []
+    # a directory is listed before its sub-directories, so its card
+    # and the ones above are known when its files are met
+    for listing in walk(base_dir, **kwargs):
+        for toml in sorted(listing.cards):
+            if is_annotation(toml):
+                card_index.setdefault(listing.path, toml)
+        if (
+            listing.path not in card_index
+            and _deepest_card(listing.path, card_index) is None
+        ):
+            for path in listing.files:
+                log.info("File %s will not be imported", path)
+            continue
+        if known:
+            files.extend(path for path in listing.files if path.as_posix() not in known)
+        else:
+            files.extend(listing.files)
+        if len(files) >= chunk_size:
+            yield from _match_candidates(files, card_index)
+            files = []
+    if files:
+        yield from _match_candidates(files, card_index)
+
+
+def _match_candidates(files, card_index):
+    # the span is closed before yielding, so it does not enclose the caller
+    with tracing.span("match", files=len(files)) as span:
+        candidates = import_candidates.as_dictionary(
+            [path.as_posix() for path in files]
+        )
+        span.set(candidates=len(candidates))
+    log.info("Found %d import candidates in %d files", len(candidates), len(files))
+    for candidate in sorted(candidates):
+        candidate = Path(candidate)
+        yield candidate, _deepest_card(candidate, card_index)
+
+
+def iter_import_tables(
+    base_dir: Union[Path, str],
+    max_files: int = DEFAULT_BATCH_FILES,
+    max_age: float = DEFAULT_BATCH_AGE,
+    update_dataset: bool = False,
+    dedup: str = None,
+    fingerprints=None,
+    **kwargs,
+):
+    """Yields import tables as the candidates of base_dir are found
+
+    A table is flushed once it has max_files rows, or once its first
+    candidate is max_age seconds old, which is checked when the next
+    candidate arrives. The tables have the same columns as the one
+    returned by :func:`create_import_table`.
+
+    Keyword arguments are passed to :func:`iter_candidates`
+    """
+    if dedup is not None and fingerprints is None:
+        raise ValueError("A fingerprint index is needed to find duplicates")
+    base_dir = Path(base_dir).resolve()
+    first = True
+    for pairs in _batches(iter_candidates(base_dir, **kwargs), max_files, max_age):
+        table_ = []
+        with tracing.span("parse_pair", files=len(pairs)):
+            for candidate_path, annotation_path in pairs:
+                new = first and not update_dataset
+                table_.append(
+                    parse_pair(
+                        candidate_path, annotation_path, base_dir, new_dataset=new
+                    )
                 )
-                continue
-            if not _is_relative_to(candidate, annotated.parent):
-                # This is expected as go accross do the whole grid
-                continue
-            to_annotate[Path(candidate)] = annotated
-            log.debug(f"Matched {candidate} with {annotated}")
+                first = False
+        table = pd.DataFrame.from_records(table_)
+        if dedup is not None:
+            table = mark_duplicates(table, fingerprints, dedup)
+        yield table
 
-    not_imported = set(candidates) - set(to_annotate)
-    for candidate in not_imported:
-        log.info("File %s will not be imported", candidate)
 
-    return to_annotate
+def _batches(items, max_size, max_age):
+    """Groups items in lists of at most max_size items, a list is also
+    flushed when its first item is older than max_age seconds
+    """
+    batch = []
+    started = None
+    for item in items:
+        if not batch:
+            started = time.monotonic()
+        batch.append(item)
+        if len(batch) >= max_size or time.monotonic() - started >= max_age:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 def parse_pair(
@@ -157,8 +360,7 @@ def parse_pair(
     https://docs.openmicroscopy.org/omero/5.6.2/users/cli/import-target.html
 
     """
-    with open(annotation_path, "r", encoding="utf-8") as fh:
-        annotation = toml.load(fh)
+    annotation = load_card(annotation_path)
     project = annotation["project"]
 
     dataset_dir = annotation_path.parent
@@ -195,6 +397,8 @@ def create_import_table(
     out_file: Union[Path, str] = None,
     to_annotate: dict = None,
     update_dataset: bool = False,
+    dedup: str = None,
+    fingerprints=None,
 ):
     """Creates a pandas DataFrame to be consumed by importer_job.auto_import
 
@@ -209,6 +413,11 @@ def create_import_table(
     update_dataset: bool, optional, default False
         if True, no new dataset is created, and the data is appended to the
         newest existing dataset of the same name
+    dedup: str, optional
+        one of "flag", "drop" or "link", how to treat the candidates whose
+        content was already imported, see :func:`mark_duplicates`
+    fingerprints: :class:`impomero.fingerprint.FingerprintIndex`, optional
+        fingerprint index used to find those candidates, required with dedup
 
     Returns
     -------
@@ -216,28 +425,131 @@ def create_import_table(
 
 
     """
+    if dedup is not None and fingerprints is None:
+        raise ValueError("A fingerprint index is needed to find duplicates")
     base_dir = Path(base_dir).resolve()
-    if to_annotate is None:
-        to_annotate = collect_candidates(base_dir)
-    table_ = []
-    first = True
-    for candidate_path, annotation_path in to_annotate.items():
-        new = first and not update_dataset
-        entry = parse_pair(candidate_path, annotation_path, base_dir, new_dataset=new)
-        table_.append(entry)
-        first = False
+    with tracing.span("collect", base_dir=base_dir.as_posix()) as span:
+        if to_annotate is None:
+            to_annotate = collect_candidates(base_dir)
+        table_ = []
+        first = True
+        with tracing.span("parse_pair", files=len(to_annotate)):
+            for candidate_path, annotation_path in to_annotate.items():
+                new = first and not update_dataset
+                entry = parse_pair(
+                    candidate_path, annotation_path, base_dir, new_dataset=new
+                )
+                table_.append(entry)
+                first = False
 
-    table = pd.DataFrame.from_records(table_)
+        table = pd.DataFrame.from_records(table_)
+        if dedup is not None:
+            table = mark_duplicates(table, fingerprints, dedup)
+        span.set(rows=len(table))
     if out_file is not None:
         table.to_csv(out_file, sep="\t")
 
     return table
 
 
-def _is_relative_to(path, other):
-    """Tests if a path is relative to an other"""
-    try:
-        Path(path).relative_to(other)
-    except ValueError:
-        return False
-    return True
+def mark_duplicates(table, fingerprints, dedup: str = "flag"):
+    """Finds the rows of an import table whose content was already imported
+    by the same user
+
+    Parameters
+    ----------
+    table: pd.DataFrame
+        import table as returned by `create_import_table`
+    fingerprints: :class:`impomero.fingerprint.FingerprintIndex`
+        fingerprint index backed by the import DB
+    dedup: str, default "flag"
+        * "flag": the duplicates are only reported
+        * "drop": the duplicates are removed from the table
+        * "link": the duplicates are not imported again, the existing images
+          are linked to the new dataset instead
+
+    Returns
+    -------
+    table: pd.DataFrame
+        a copy of the table with a "fingerprint" column and a "duplicate_of"
+        column holding the list of the already imported image ids, or None.
+        With dedup="link", the boolean "link" column is True for those rows
+    """
+    if dedup not in DEDUP_MODES:
+        raise ValueError(f"dedup should be one of {DEDUP_MODES}, not {dedup!r}")
+    table = table.copy()
+    if table.empty:
+        return table
+    with tracing.span("fingerprint", files=len(table)) as span:
+        computed = fingerprints.computed
+        digests = fingerprints.fingerprints(table["file_path"])
+        span.set(computed=fingerprints.computed - computed)
+    imported = fingerprints.store.images_by_fingerprint(set(digests.values()))
+    table["fingerprint"] = table["file_path"].map(digests)
+    table["duplicate_of"] = _confirm_duplicates(table, imported, fingerprints)
+    duplicated = table["duplicate_of"].notna()
+    for file_path, image_ids in table.loc[
+        duplicated, ["file_path", "duplicate_of"]
+    ].values:
+        log.info("%s was already imported as image(s) %s", file_path, image_ids)
+    if dedup == "drop":
+        table = table[~duplicated].reset_index(drop=True)
+    elif dedup == "link":
+        table["link"] = duplicated
+    return table
+
+
+def _confirm_duplicates(table, imported, fingerprints):
+    """Returns the ids of the images imported from a file with the same
+    content as each row's, or None
+
+    The fingerprints only select the candidates: the content digests of
+    the row's file and of the files the images were imported from must be
+    equal, so a file whose origin was moved or modified is imported again
+    """
+    candidates = [
+        imported.get((digest, user), {})
+        for digest, user in zip(table["fingerprint"], table["user"])
+    ]
+    to_hash = set(table["file_path"][[bool(origins) for origins in candidates]])
+    to_hash.update(path for origins in candidates for path in origins)
+    if not to_hash:
+        return [None] * len(table)
+    with tracing.span("content_digest", files=len(to_hash)):
+        contents = fingerprints.content_digests(to_hash)
+    duplicate_of = []
+    for file_path, origins in zip(table["file_path"], candidates):
+        content = contents.get(file_path)
+        image_ids = [
+            img_id
+            for origin, ids in origins.items()
+            if content is not None and contents.get(origin) == content
+            for img_id in ids
+        ]
+        if origins and not image_ids:
+            log.info("%s has the fingerprint of another file", file_path)
+        duplicate_of.append(image_ids or None)
+    return duplicate_of
+
+
+def _index_cards(annotation_tomls):
+    """Indexes the annotation files by the directory they annotate
+
+    If several cards live in the same directory, the first one wins.
+    """
+    card_index = {}
+    for annotated in annotation_tomls:
+        annotated = Path(annotated)
+        card_index.setdefault(annotated.parent, annotated)
+    return card_index
+
+
+def _deepest_card(candidate, card_index):
+    """Returns the annotation file of the deepest directory enclosing candidate,
+    or None if no card is found
+    """
+    for parent in Path(candidate).parents:
+        annotated = card_index.get(parent)
+        if annotated is not None:
+            return annotated
+    return None
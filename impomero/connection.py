@@ -0,0 +1,337 @@
+"""Long lived connections to the omero server
+
+Opening a root connection and a sudo session for each job means a login
+and a session creation each time, and sessions that are never closed.
+The :class:`ConnectionManager` keeps one root connection alive, and a
+least recently used pool of per-user sudo sessions.
+
+Closing a sudo session kills it on the server, also for the import
+processes joining it with its key. The sessions are thus checked out
+while they are in use (see :meth:`ConnectionManager.session`), and a
+checked out session is never evicted nor closed as idle.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from omero.gateway import BlitzGateway
+
+from .collector import get_configuration
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_SESSIONS = 16
+DEFAULT_IDLE_TIMEOUT = 600.0
+DEFAULT_KEEPALIVE = 60.0
+# sudo sessions must outlive the longest import using them
+DEFAULT_SESSION_TTL = 24 * 3600.0
+
+
+def _is_alive(conn):
+    try:
+        return conn.keepAlive()
+    except Exception:
+        return False
+
+
+class _PooledSession:
+    __slots__ = ("conn", "last_used", "users")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.last_used = time.monotonic()
+        # number of check outs not checked in yet
+        self.users = 0
+
+
+class ConnectionManager:
+    """Owns a root connection and a pool of per-user sudo sessions
+
+    Connections are checked (and re-opened if needed) when they are handed
+    out after `keepalive` seconds of inactivity. Once started, a background
+    thread pings the connections every `keepalive` seconds and closes the
+    sessions idle for more than `idle_timeout` seconds.
+
+    Parameters
+    ----------
+    conf : dict, optional
+        server configuration, as returned by
+        :func:`impomero.collector.get_configuration` (the default)
+    max_sessions : int
+        maximum number of user sessions kept open
+    idle_timeout : float
+        seconds after which an unused user session is closed
+    keepalive : float
+        seconds between two keep alive pings
+    session_ttl : float
+        time to live of the sudo sessions, in seconds
+
+    Example
+    -------
+
+    >>> with ConnectionManager() as connections:
+    ...     with connections.session("john") as conn:
+    ...         conn.getObject("Image", 1)
+
+    """
+
+    def __init__(
+        self,
+        conf=None,
+        max_sessions: int = DEFAULT_MAX_SESSIONS,
+        idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+        keepalive: float = DEFAULT_KEEPALIVE,
+        session_ttl: float = DEFAULT_SESSION_TTL,
+    ):
+        self.conf = conf or get_configuration()
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.session_ttl = session_ttl
+        self._root = None
+        self._root_checked = 0.0
+        self._sessions = OrderedDict()
+        # checked out sessions removed from the pool, closed when checked in
+        self._detached = []
+        self._lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._stats = {
+            "root_connections": 0,
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "reconnections": 0,
+        }
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def root(self):
+        """Returns the connected root connection"""
+        to_close = []
+        with self._lock:
+            conn = self._get_root(to_close)
+        self._close_all(to_close)
+        return conn
+
+    def user(self, username, group=None):
+        """Returns a sudo connection as username, in group if not None
+
+        The session is not checked out, and can be closed once it is idle
+        or evicted: use :meth:`session` to hold it
+        """
+        return self._get_user(username, group).conn
+
+    @contextmanager
+    def session(self, username, group=None):
+        """Checks out the session of username for the duration of the block
+
+        The session is not evicted nor expired while it is checked out,
+        even by another thread.
+
+        Yields
+        ------
+        conn : :class:`omero.gateway.BlitzGateway`
+            the sudo connection as username, in group if not None
+        """
+        conn = self.checkout(username, group)
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+    def checkout(self, username, group=None):
+        """Returns username's sudo connection, held until :meth:`checkin`"""
+        return self._get_user(username, group, checkout=True).conn
+
+    def checkin(self, conn):
+        """Releases a connection returned by :meth:`checkout`"""
+        to_close = []
+        with self._lock:
+            pooled = next((p for p in self._sessions.values() if p.conn is conn), None)
+            if pooled is None:
+                pooled = next((p for p in self._detached if p.conn is conn), None)
+                if pooled is None:
+                    raise ValueError(f"{conn} was not checked out")
+                pooled.users -= 1
+                if not pooled.users:
+                    self._detached.remove(pooled)
+                    to_close.append(pooled.conn)
+            else:
+                pooled.users -= 1
+                pooled.last_used = time.monotonic()
+                self._evict(to_close)
+        self._close_all(to_close)
+
+    def ping(self):
+        """Keeps the connections alive and closes the idle sessions"""
+        to_close = []
+        with self._lock:
+            now = time.monotonic()
+            for key, pooled in list(self._sessions.items()):
+                if pooled.users:
+                    # in use, the keep alive still prevents its expiry
+                    _is_alive(pooled.conn)
+                elif now - pooled.last_used > self.idle_timeout:
+                    log.info("Closing idle session of %s", key[0])
+                    self._stats["evictions"] += 1
+                    to_close.append(self._sessions.pop(key).conn)
+                elif not _is_alive(pooled.conn):
+                    to_close.append(self._sessions.pop(key).conn)
+            if self._root is not None:
+                if _is_alive(self._root):
+                    self._root_checked = now
+                else:
+                    # reconnected at next use
+                    self._root_checked = 0.0
+        self._close_all(to_close)
+
+    def stats(self):
+        """Returns the pool statistics as a dictionnary"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["sessions"] = len(self._sessions)
+            stats["root_connected"] = self._root is not None
+        return stats
+
+    def start(self):
+        """Starts the keep alive thread"""
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="impomero-keepalive", daemon=True
+        )
+        self._thread.start()
+
+    def close(self):
+        """Stops the keep alive thread and closes all the connections"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        to_close = []
+        with self._lock:
+            self._clear_sessions(to_close)
+            if self._root is not None:
+                to_close.append(self._root)
+                self._root = None
+        self._close_all(to_close)
+        log.info("Connection pool stats: %s", self._stats)
+
+    def _run(self):
+        while not self._stopped.wait(self.keepalive):
+            try:
+                self.ping()
+            except Exception:
+                log.exception("Keep alive failed")
+
+    def _connect_root(self):
+        conn = BlitzGateway(
+            host=self.conf["server"],
+            port=int(self.conf["port"]),
+            username="root",
+            passwd=self.conf["admin_passwd"],
+            secure=True,
+        )
+        if not conn.connect():
+            raise ConnectionError(
+                f"Could not connect to {self.conf['server']}:{self.conf['port']}"
+            )
+        self._stats["root_connections"] += 1
+        return conn
+
+    def _get_root(self, to_close):
+        """Returns the root connection, the connections to close are
+        appended to to_close (they are closed once the lock is released)
+        """
+        if self._root is not None and (
+            time.monotonic() - self._root_checked < self.keepalive
+            or _is_alive(self._root)
+        ):
+            self._root_checked = time.monotonic()
+            return self._root
+        if self._root is not None:
+            log.warning("Lost the root connection, reconnecting")
+            self._stats["reconnections"] += 1
+            to_close.append(self._root)
+            # the sessions were created by the lost connection
+            self._clear_sessions(to_close)
+        self._root = self._connect_root()
+        self._root_checked = time.monotonic()
+        return self._root
+
+    def _get_user(self, username, group=None, checkout=False):
+        key = (username, group)
+        to_close = []
+        try:
+            with self._lock:
+                pooled = self._pooled_user(key, to_close)
+                if checkout:
+                    pooled.users += 1
+                self._evict(to_close, keep=key)
+                return pooled
+        finally:
+            self._close_all(to_close)
+
+    def _pooled_user(self, key, to_close):
+        pooled = self._sessions.get(key)
+        if pooled is not None:
+            idle = time.monotonic() - pooled.last_used
+            if pooled.users or idle < self.keepalive or _is_alive(pooled.conn):
+                self._sessions.move_to_end(key)
+                pooled.last_used = time.monotonic()
+                self._stats["hits"] += 1
+                return pooled
+            log.info("Session of %s expired", key[0])
+            self._stats["reconnections"] += 1
+            to_close.append(self._sessions.pop(key).conn)
+
+        self._stats["misses"] += 1
+        root = self._get_root(to_close)
+        conn = root.suConn(*key, ttl=int(self.session_ttl * 1000))
+        if conn is None:
+            raise ValueError(f"Could not open a session for user {key[0]}")
+        pooled = self._sessions[key] = _PooledSession(conn)
+        return pooled
+
+    def _evict(self, to_close, keep=None):
+        """Evicts the least recently used sessions above max_sessions,
+        but the checked out ones and the session of key keep
+        """
+        excess = len(self._sessions) - self.max_sessions
+        for key in list(self._sessions):
+            if excess <= 0:
+                return
+            if key == keep or self._sessions[key].users:
+                continue
+            to_close.append(self._sessions.pop(key).conn)
+            self._stats["evictions"] += 1
+            excess -= 1
+
+    def _clear_sessions(self, to_close):
+        """Empties the pool, the checked out sessions are closed
+        when they are checked in
+        """
+        while self._sessions:
+            _, pooled = self._sessions.popitem()
+            if pooled.users:
+                self._detached.append(pooled)
+            else:
+                to_close.append(pooled.conn)
+
+    def _close_all(self, conns):
+        for conn in conns:
+            self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            log.debug("Error while closing %s", conn, exc_info=True)
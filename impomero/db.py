@@ -1,14 +1,667 @@
+"""Persistent state of the monitor
+
+The import DB records the monitored directories, the images annotated
+from each of them (the ledger), the files already handled below each of
+them (the manifest), the cards last applied and the job queue
+(see :mod:`impomero.jobs`). It is accessed through a :class:`StateStore`,
+which holds one connection shared by the threads of the process.
+
+The schema version is stored in sqlite's `user_version`, and older DBs
+are migrated when they are opened.
+"""
+import json
+import logging
+import os
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+# "wal" on a local disk, "delete" on a network file system, see journal_mode_for
+DEFAULT_JOURNAL_MODE = "auto"
+
+# write ahead logging needs memory shared by all the processes using the DB,
+# so it is unsafe when the DB is shared over the network by several hosts
+NETWORK_FILE_SYSTEMS = (
+    "nfs",
+    "nfs4",
+    "cifs",
+    "smbfs",
+    "smb3",
+    "9p",
+    "afs",
+    "ceph",
+    "glusterfs",
+    "gpfs",
+    "lustre",
+    "beegfs",
+    "fuse.sshfs",
+    "fuse.glusterfs",
+    "fuse.cephfs",
+)
+
+# ledger columns of schema version 2, the later ones are added by migrations
+_LEDGER_V2_COLUMNS = (
+    "id",
+    "base_dir",
+    "file_path",
+    "fileset",
+    "target",
+    "project",
+    "dataset",
+    "user",
+    "group",
+    "title",
+    "comment",
+    "tags",
+    "created",
+    "accessed",
+)
+
+ANNOTATED_COLUMNS = _LEDGER_V2_COLUMNS + ("fingerprint",)
+
+_ANNOTATED_TYPES = {"id": "INTEGER NOT NULL"}
+
+
+def _quote(column):
+    return '"{}"'.format(column.replace('"', '""'))
+
+
+def _initial_schema(sql_con):
+    """Version 1, the layout before the schema was versioned"""
+    sql_con.execute("CREATE TABLE IF NOT EXISTS monitored (date, base_dir)")
+    sql_con.execute(
+        """CREATE TABLE IF NOT EXISTS annotated ('index', title, created,
+            project, user, comment, tags, accessed, target, fileset, file_path,
+            'group', organism, sample, channel_0, id, base_dir)"""
+    )
 
 
-def init_db(db_name):
-    """Creates the import database with the correct tables
-    and columns
+def _typed_ledger(sql_con):
+    """Version 2, typed and indexed ledger
+
+    The columns of the legacy annotated table that are not part of the
+    typed layout (the card key-value pairs) are gathered in kv_pairs
+    """
+    columns = ",\n".join(
+        f"{_quote(col)} {_ANNOTATED_TYPES.get(col, 'TEXT')}"
+        for col in _LEDGER_V2_COLUMNS
+    )
+    sql_con.execute(
+        f"""CREATE TABLE annotated_v2 ({columns},
+            kv_pairs TEXT NOT NULL DEFAULT '{{}}',
+            recorded REAL)"""
+    )
+    legacy = [row[1] for row in sql_con.execute("PRAGMA table_info(annotated)")]
+    kept = [col for col in _LEDGER_V2_COLUMNS if col in legacy]
+    extra = [col for col in legacy if col not in _LEDGER_V2_COLUMNS and col != "index"]
+    kv_pairs = "json_object({})".format(
+        ", ".join(f"'{col}', {_quote(col)}" for col in extra)
+    )
+    sql_con.execute(
+        f"""INSERT INTO annotated_v2 ({", ".join(_quote(col) for col in kept)},
+            kv_pairs)
+        SELECT {", ".join(_quote(col) for col in kept)}, {kv_pairs}
+        FROM annotated WHERE id IS NOT NULL"""
+    )
+    sql_con.execute("DROP TABLE annotated")
+    sql_con.execute("ALTER TABLE annotated_v2 RENAME TO annotated")
+    sql_con.execute("CREATE INDEX annotated_base_dir ON annotated (base_dir, id)")
+    sql_con.execute("CREATE INDEX annotated_file_path ON annotated (file_path)")
+    sql_con.execute("CREATE INDEX annotated_id ON annotated (id)")
+    sql_con.execute("CREATE INDEX monitored_base_dir ON monitored (base_dir)")
+
+
+def _import_chunks(sql_con):
+    """Version 3, completion of the import chunks"""
+    sql_con.execute(
+        """CREATE TABLE import_chunks (
+            key TEXT PRIMARY KEY,
+            base_dir TEXT NOT NULL,
+            status TEXT NOT NULL,
+            files INTEGER,
+            bytes INTEGER,
+            image_ids TEXT,
+            updated REAL)"""
+    )
+    sql_con.execute("CREATE INDEX import_chunks_base_dir ON import_chunks (base_dir)")
+
+
+def _fingerprints(sql_con):
+    """Version 4, content fingerprints of the files"""
+    sql_con.execute(
+        """CREATE TABLE fingerprints (
+            path TEXT PRIMARY KEY,
+            inode INTEGER,
+            mtime_ns INTEGER,
+            size INTEGER,
+            digest TEXT NOT NULL,
+            updated REAL)"""
+    )
+    sql_con.execute("ALTER TABLE annotated ADD COLUMN fingerprint TEXT")
+    sql_con.execute("CREATE INDEX annotated_fingerprint ON annotated (fingerprint)")
+
+
+def _manifest(sql_con):
+    """Version 5, files handled by the imports of each directory"""
+    sql_con.execute(
+        """CREATE TABLE manifest (
+            base_dir TEXT NOT NULL,
+            file_path TEXT NOT NULL,
+            recorded REAL,
+            PRIMARY KEY (base_dir, file_path))"""
+    )
+
+
+def _leases(sql_con):
+    """Version 6, leases of the claimed jobs
+
+    The DBs migrated to version 1 by an earlier release got the jobs table
+    there, the others get it with its leases at version 8
     """
-    with sqlite3.connect(db_name) as sql_con:
-        sql_con.execute("CREATE TABLE IF NOT EXISTS monitored (date, base_dir)")
+    if _has_table(sql_con, "jobs"):
+        sql_con.execute("ALTER TABLE jobs ADD COLUMN claimed_until REAL")
+
+
+def _file_checkpoints(sql_con):
+    """Version 7, completion of the import of each file"""
+    sql_con.execute(
+        """CREATE TABLE file_checkpoints (
+            file_path TEXT NOT NULL,
+            target TEXT NOT NULL,
+            base_dir TEXT NOT NULL,
+            image_ids TEXT,
+            updated REAL,
+            PRIMARY KEY (file_path, target))"""
+    )
+
+
+def _jobs_and_cards(sql_con):
+    """Version 8, the job queue and the cards applied to each directory
+
+    Earlier releases created them with the version 1 tables, so they
+    may already exist
+    """
+    sql_con.execute(
+        """CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            base_dir TEXT NOT NULL,
+            toml_path TEXT NOT NULL,
+            state TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker TEXT,
+            payload TEXT,
+            error TEXT,
+            created REAL,
+            updated REAL,
+            claimed_until REAL)"""
+    )
+    sql_con.execute(
+        "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, worker, base_dir)"
+    )
+    sql_con.execute(
+        """CREATE TABLE IF NOT EXISTS cards (
+            base_dir TEXT PRIMARY KEY,
+            toml_path TEXT,
+            content TEXT,
+            updated REAL)"""
+    )
+
+
+def _content_digests(sql_con):
+    """Version 9, digests of the whole content of the files, which confirm
+    the duplicates found by their fingerprints
+    """
+    sql_con.execute("ALTER TABLE fingerprints ADD COLUMN content_digest TEXT")
+
+
+def _has_table(sql_con, name):
+    return bool(
         sql_con.execute(
-            """CREATE TABLE IF NOT EXISTS annotated ('index', title, created,
-                project, user, comment, tags, accessed, target, fileset, file_path,
-                'group', organism, sample, channel_0, id, base_dir)"""
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)
+        ).fetchone()
+    )
+
+
+# MIGRATIONS[n] brings the schema from version n to n + 1
+MIGRATIONS = [
+    _initial_schema,
+    _typed_ledger,
+    _import_chunks,
+    _fingerprints,
+    _manifest,
+    _leases,
+    _file_checkpoints,
+    _jobs_and_cards,
+    _content_digests,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+class StateStore:
+    """Access to the import DB through a single connection
+
+    Parameters
+    ----------
+    db_name : str
+        path to the sqlite DB, created if needed
+    journal_mode : str, default "auto"
+        sqlite journal mode. Write ahead logging ("wal") lets readers run
+        during a write, but needs shared memory: on a network file system,
+        e.g. when the DB is shared by several hosts, "delete" must be used.
+        "auto" picks one of them (see :func:`journal_mode_for`)
+    timeout : float
+        seconds to wait for a lock held by another process
+
+    """
+
+    def __init__(
+        self,
+        db_name,
+        journal_mode: str = DEFAULT_JOURNAL_MODE,
+        timeout: float = 30.0,
+    ):
+        self.db_name = str(db_name)
+        # autocommit mode, transactions are explicit
+        self._con = sqlite3.connect(
+            self.db_name,
+            isolation_level=None,
+            timeout=timeout,
+            check_same_thread=False,
+        )
+        self._lock = threading.RLock()
+        if journal_mode == "auto":
+            journal_mode = journal_mode_for(self.db_name)
+        mode = self._con.execute(f"PRAGMA journal_mode={journal_mode}").fetchone()[0]
+        if mode != journal_mode.lower():
+            log.warning("Journal mode %s not available, using %s", journal_mode, mode)
+        if mode == "wal":
+            # durable at checkpoints, which is enough for the ledger
+            self._con.execute("PRAGMA synchronous=NORMAL")
+        self.migrate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._con.close()
+
+    @property
+    def version(self):
+        """Schema version of the DB"""
+        return self.query("PRAGMA user_version")[0][0]
+
+    def migrate(self):
+        """Applies the missing migrations, returns the schema version"""
+        with self.transaction() as sql_con:
+            version = sql_con.execute("PRAGMA user_version").fetchone()[0]
+            for step, migration in enumerate(MIGRATIONS[version:], start=version):
+                log.info("Migrating %s to schema version %d", self.db_name, step + 1)
+                migration(sql_con)
+            # PRAGMA does not accept parameters
+            sql_con.execute(f"PRAGMA user_version={SCHEMA_VERSION:d}")
+        return SCHEMA_VERSION
+
+    @contextmanager
+    def transaction(self):
+        """Context manager holding a write transaction
+
+        The statements executed on the yielded connection are committed
+        together, or rolled back if an exception is raised
+        """
+        with self._lock:
+            self._con.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._con
+            except BaseException:
+                self._con.execute("ROLLBACK")
+                raise
+            self._con.execute("COMMIT")
+
+    def execute(self, sql, params=()):
+        """Executes a single statement, returns the cursor"""
+        with self._lock:
+            return self._con.execute(sql, params)
+
+    def query(self, sql, params=()):
+        """Returns all the rows selected by sql"""
+        with self._lock:
+            return self._con.execute(sql, params).fetchall()
+
+    def imported_ids(self, base_dir):
+        """Returns the ids of the images already imported from base_dir"""
+        return [
+            row[0]
+            for row in self.query(
+                "SELECT id FROM annotated WHERE base_dir=?",
+                (Path(base_dir).as_posix(),),
+            )
+        ]
+
+    def imported_files(self, base_dir):
+        """Returns the set of file paths already imported from base_dir"""
+        return {
+            row[0]
+            for row in self.query(
+                "SELECT DISTINCT file_path FROM annotated WHERE base_dir=?",
+                (Path(base_dir).as_posix(),),
+            )
+        }
+
+    def has_imported(self, base_dir):
+        """Returns True if images were imported from base_dir"""
+        return bool(
+            self.query(
+                "SELECT 1 FROM annotated WHERE base_dir=? LIMIT 1",
+                (Path(base_dir).as_posix(),),
+            )
+        )
+
+    def add_annotated(self, records, base_dir):
+        """Adds the annotated images to the ledger
+
+        Parameters
+        ----------
+        records : iterable of dicts
+            as returned by :func:`impomero.annotation_job.auto_annotate`,
+            the keys that are not ledger columns are stored in kv_pairs
+        base_dir : str or Path
+            the directory the images were imported from
+        """
+        base_dir = Path(base_dir).as_posix()
+        now = time.time()
+        rows = []
+        for record in records:
+            record = dict(record, base_dir=base_dir)
+            kv_pairs = {
+                key: val
+                for key, val in record.items()
+                if key not in ANNOTATED_COLUMNS and key != "index"
+            }
+            rows.append(
+                [_sql_value(record.get(col)) for col in ANNOTATED_COLUMNS]
+                + [json.dumps(kv_pairs, default=str), now]
+            )
+        columns = ", ".join(_quote(col) for col in ANNOTATED_COLUMNS)
+        marks = ", ".join("?" * (len(ANNOTATED_COLUMNS) + 2))
+        with self.transaction() as sql_con:
+            sql_con.executemany(
+                f"INSERT INTO annotated ({columns}, kv_pairs, recorded) "
+                f"VALUES ({marks})",
+                rows,
+            )
+        return len(rows)
+
+    def chunk_state(self, key):
+        """Returns the status and the {file_path: image_ids} mapping
+        recorded for the import chunk key, or None if it is not known
+        """
+        rows = self.query(
+            "SELECT status, image_ids FROM import_chunks WHERE key=?", (key,)
+        )
+        if not rows:
+            return None
+        status, image_ids = rows[0]
+        return status, json.loads(image_ids or "{}")
+
+    def record_chunk(self, key, base_dir, status, files, size, image_ids=None):
+        """Records the completion of the import chunk key
+
+        Parameters
+        ----------
+        key : str
+            see :func:`impomero.chunks.chunk_key`
+        base_dir : str or Path
+        status : str
+            import status of the chunk
+        files : int
+            number of files in the chunk
+        size : int
+            total size of the files, in bytes
+        image_ids : dict, optional
+            the ids of the images imported from each file
+        """
+        self.execute(
+            "INSERT OR REPLACE INTO import_chunks "
+            "(key, base_dir, status, files, bytes, image_ids, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                key,
+                Path(base_dir).as_posix(),
+                status,
+                files,
+                size,
+                json.dumps(image_ids or {}),
+                time.time(),
+            ),
+        )
+
+    def file_checkpoints(self, file_paths):
+        """Returns a {(file_path, target): image_ids} dictionnary of the
+        files recorded as imported (image_ids is None if they are not known)
+        """
+        found = {}
+        file_paths = list(file_paths)
+        # stay below sqlite's maximum number of parameters
+        for start in range(0, len(file_paths), 500):
+            chunk = file_paths[start : start + 500]
+            marks = ", ".join("?" * len(chunk))
+            for file_path, target, image_ids in self.query(
+                "SELECT file_path, target, image_ids FROM file_checkpoints "
+                f"WHERE file_path IN ({marks})",
+                chunk,
+            ):
+                found[(file_path, target)] = json.loads(image_ids)
+        return found
+
+    def record_file_checkpoints(self, base_dir, entries):
+        """Records the import of (file_path, target, image_ids) entries,
+        so they are not imported again (see :meth:`file_checkpoints`)
+        """
+        base_dir = Path(base_dir).as_posix()
+        now = time.time()
+        with self.transaction() as sql_con:
+            sql_con.executemany(
+                "INSERT OR REPLACE INTO file_checkpoints "
+                "(file_path, target, base_dir, image_ids, updated) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (file_path, target, base_dir, json.dumps(image_ids), now)
+                    for file_path, target, image_ids in entries
+                ],
+            )
+
+    def cached_fingerprint(self, path, stat):
+        """Returns the digest stored for path if the file did not change
+        since (same inode, modification time and size), else None
+        """
+        rows = self.query(
+            "SELECT digest FROM fingerprints "
+            "WHERE path=? AND inode=? AND mtime_ns=? AND size=?",
+            (str(path), stat.st_ino, stat.st_mtime_ns, stat.st_size),
+        )
+        return rows[0][0] if rows else None
+
+    def record_fingerprints(self, entries):
+        """Stores (path, stat, digest) entries in the fingerprint cache"""
+        now = time.time()
+        with self.transaction() as sql_con:
+            sql_con.executemany(
+                "INSERT OR REPLACE INTO fingerprints "
+                "(path, inode, mtime_ns, size, digest, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (str(path), st.st_ino, st.st_mtime_ns, st.st_size, digest, now)
+                    for path, st, digest in entries
+                ],
+            )
+
+    def cached_content_digest(self, path, stat):
+        """Returns the content digest stored for path if the file did not
+        change since, else None
+        """
+        rows = self.query(
+            "SELECT content_digest FROM fingerprints "
+            "WHERE path=? AND inode=? AND mtime_ns=? AND size=?",
+            (str(path), stat.st_ino, stat.st_mtime_ns, stat.st_size),
         )
+        return rows[0][0] if rows else None
+
+    def record_content_digests(self, entries):
+        """Stores (path, stat, digest) entries in the fingerprint cache,
+        the fingerprints of those files must be recorded already
+        """
+        with self.transaction() as sql_con:
+            sql_con.executemany(
+                "UPDATE fingerprints SET content_digest=? "
+                "WHERE path=? AND inode=? AND mtime_ns=? AND size=?",
+                [
+                    (digest, str(path), st.st_ino, st.st_mtime_ns, st.st_size)
+                    for path, st, digest in entries
+                ],
+            )
+
+    def images_by_fingerprint(self, digests):
+        """Returns a {(digest, user): {file_path: [image ids]}} dictionnary
+        of the images of the ledger imported from files with those digests
+        """
+        found = {}
+        digests = list(digests)
+        # stay below sqlite's maximum number of parameters
+        for start in range(0, len(digests), 500):
+            chunk = digests[start : start + 500]
+            marks = ", ".join("?" * len(chunk))
+            for digest, user, file_path, image_id in self.query(
+                "SELECT fingerprint, user, file_path, id FROM annotated "
+                f"WHERE fingerprint IN ({marks}) ORDER BY id",
+                chunk,
+            ):
+                origins = found.setdefault((digest, user), {})
+                origins.setdefault(file_path, []).append(image_id)
+        return found
+
+    def manifest_files(self, base_dir):
+        """Returns the set of file paths recorded in the manifest of base_dir"""
+        return {
+            row[0]
+            for row in self.query(
+                "SELECT file_path FROM manifest WHERE base_dir=?",
+                (Path(base_dir).as_posix(),),
+            )
+        }
+
+    def record_manifest(self, base_dir, file_paths):
+        """Adds file_paths to the manifest of base_dir"""
+        base_dir = Path(base_dir).as_posix()
+        now = time.time()
+        with self.transaction() as sql_con:
+            sql_con.executemany(
+                "INSERT OR REPLACE INTO manifest (base_dir, file_path, recorded) "
+                "VALUES (?, ?, ?)",
+                [(base_dir, Path(path).as_posix(), now) for path in file_paths],
+            )
+
+    def first_recorded(self, base_dir):
+        """Returns the time the first image of base_dir was added to the
+        ledger, or None
+        """
+        rows = self.query(
+            "SELECT MIN(recorded) FROM annotated WHERE base_dir=?",
+            (Path(base_dir).as_posix(),),
+        )
+        return rows[0][0]
+
+    def enclosing_card(self, path):
+        """Returns the (base_dir, toml_path) of the card applied to the
+        deepest directory containing path, or None
+        """
+        path = Path(path)
+        parents = [path.as_posix()] + [parent.as_posix() for parent in path.parents]
+        marks = ", ".join("?" * len(parents))
+        rows = self.query(
+            f"SELECT base_dir, toml_path FROM cards WHERE base_dir IN ({marks}) "
+            "ORDER BY LENGTH(base_dir) DESC LIMIT 1",
+            parents,
+        )
+        return tuple(rows[0]) if rows else None
+
+    def add_monitored(self, base_dir):
+        self.execute(
+            "INSERT INTO monitored (date, base_dir) VALUES (?, ?)",
+            (time.time(), Path(base_dir).as_posix()),
+        )
+
+    def card_state(self, base_dir):
+        """Returns the content of the card last applied to base_dir,
+        or None if it is not known
+        """
+        rows = self.query(
+            "SELECT content FROM cards WHERE base_dir=?", (Path(base_dir).as_posix(),)
+        )
+        return json.loads(rows[0][0]) if rows else None
+
+    def record_card(self, base_dir, toml_path, card):
+        """Stores the content of the card applied to base_dir"""
+        self.execute(
+            "INSERT OR REPLACE INTO cards (base_dir, toml_path, content, updated) "
+            "VALUES (?, ?, ?, ?)",
+            (
+                Path(base_dir).as_posix(),
+                str(toml_path),
+                json.dumps(card, default=str),
+                time.time(),
+            ),
+        )
+
+
+def _sql_value(value):
+    if value is None or isinstance(value, (int, float, str)):
+        return value
+    if hasattr(value, "item"):
+        # numpy scalars
+        return value.item()
+    return str(value)
+
+
+def journal_mode_for(db_name, mounts="/proc/mounts"):
+    """Returns "delete" if db_name is on a network file system, else "wal"
+
+    The file systems are read from mounts, if it can not be read the DB
+    is considered local
+    """
+    path = os.path.realpath(os.path.dirname(os.path.abspath(db_name)))
+    try:
+        with open(mounts) as fh:
+            entries = [line.split()[1:3] for line in fh if len(line.split()) > 2]
+    except OSError:
+        return "wal"
+    # the deepest mount point containing the DB
+    fs_type = None
+    depth = -1
+    for mount_point, mount_type in entries:
+        mount_point = mount_point.replace("\\040", " ")
+        if _is_below(path, mount_point) and len(mount_point) > depth:
+            fs_type, depth = mount_type, len(mount_point)
+    if fs_type in NETWORK_FILE_SYSTEMS:
+        log.info("%s is on a %s file system, not using WAL", db_name, fs_type)
+        return "delete"
+    return "wal"
+
+
+def _is_below(path, root):
+    return os.path.commonpath([path, root]) == root
+
+
+def init_db(db_name, journal_mode=DEFAULT_JOURNAL_MODE):
+    """Creates or migrates the import database"""
+    with StateStore(db_name, journal_mode=journal_mode):
+        pass
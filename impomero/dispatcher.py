@@ -0,0 +1,227 @@
+"""Dispatch of the queued jobs
+
+The card events arrive on the observer and coalescer threads, and a job
+(an import can last hours) must not block them. The
+:class:`JobDispatcher` runs an asyncio loop which claims the jobs of the
+:class:`impomero.jobs.JobQueue` and runs them in a pool of threads, at most
+`max_jobs` at a time. Other threads only enqueue jobs and call
+:meth:`JobDispatcher.notify`.
+
+The leases of the jobs in flight are renewed every third of the lease
+duration of the queue, so that other workers sharing the queue do not
+take them over. If a lease can not be renewed, another worker may
+already run the job: it is asked to stop by setting its cancel event.
+
+On shutdown, the jobs in flight are either drained (waited for), or
+cancelled: they stop after their current import batch, and are then
+released in the queue, so that they are resumed at their last completed
+stage on the next start. Their leases are renewed until they stopped, so
+no other worker takes them over while a batch is still imported.
+"""
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .jobs import JobCancelled, LeaseLost, default_worker_name
+
+log = logging.getLogger(__name__)
+
+# the queue is also polled, e.g. for jobs enqueued by another process
+DEFAULT_POLL_INTERVAL = 60.0
+
+
+class JobDispatcher:
+    """Runs the queued jobs with bounded concurrency
+
+    Parameters
+    ----------
+    jobs : :class:`impomero.jobs.JobQueue`
+    run_job : callable
+        called with each claimed :class:`impomero.jobs.Job` and a
+        :class:`threading.Event`, in a worker thread; it is responsible for
+        finishing or failing the job, unless the event is set: it should
+        then stop as soon as possible, e.g. by raising
+        :class:`impomero.jobs.JobCancelled`
+    max_jobs : int, default 1
+        number of jobs run concurrently
+    worker : str, optional
+        name under which the jobs are claimed, by default unique
+        to this process
+    poll_interval : float
+        seconds between two checks of the queue without notification
+
+    Attributes
+    ----------
+    running : int
+        number of jobs in flight
+    """
+
+    def __init__(
+        self,
+        jobs,
+        run_job,
+        max_jobs: int = 1,
+        worker: str = None,
+        poll_interval: float = DEFAULT_POLL_INTERVAL,
+    ):
+        self.jobs = jobs
+        self.run_job = run_job
+        self.max_jobs = max_jobs
+        self.worker = worker or default_worker_name()
+        self.poll_interval = poll_interval
+        self._loop = None
+        self._wakeup = None
+        self._stopping = False
+        self._drain = True
+        # running task -> job
+        self._tasks = {}
+        # job id -> event set to stop the job
+        self._cancels = {}
+        lease = getattr(jobs, "lease", None)
+        self.renew_interval = lease / 3 if lease else None
+        self._renewed = 0.0
+
+    @property
+    def running(self):
+        return len(self._tasks)
+
+    def notify(self):
+        """Tells the dispatcher that jobs were enqueued
+
+        Safe to call from any thread, does nothing if the dispatcher
+        is not running (the queue is checked when it starts)
+        """
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._wake)
+
+    def stop(self, drain: bool = True):
+        """Asks the dispatcher to stop, from any thread
+
+        If drain is True, the jobs in flight are waited for, else they
+        are cancelled, and released in the queue once they stopped.
+        """
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._stop, drain)
+        else:
+            # not started yet, run returns right away
+            self._stop(drain)
+
+    async def run(self, signals=()):
+        """Runs the queued jobs until :meth:`stop` is called
+
+        Parameters
+        ----------
+        signals : sequence of `signal.Signals`
+            on the first of these signals the dispatcher stops after the
+            jobs in flight, on the second it cancels them
+        """
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        for sig in signals:
+            self._loop.add_signal_handler(sig, self._on_signal)
+        executor = ThreadPoolExecutor(self.max_jobs, thread_name_prefix="impomero-job")
+        try:
+            while not self._stopping:
+                await self._wait(executor)
+            if self._tasks:
+                log.info("Waiting for %d running jobs", len(self._tasks))
+            # woken up as jobs finish, or by a stop without draining
+            while self._tasks:
+                if not self._drain:
+                    self._cancel_all()
+                await self._wait()
+        finally:
+            for sig in signals:
+                self._loop.remove_signal_handler(sig)
+            # e.g. run was itself cancelled, do not start more batches
+            self._cancel_all()
+            self._shutdown(executor)
+
+    async def _wait(self, executor=None):
+        """Renews the leases and dispatches jobs if an executor is given,
+        then waits for a notification or the next renewal
+        """
+        self._wakeup.clear()
+        self._renew()
+        if executor is not None:
+            self._dispatch(executor)
+        timeout = min(self.poll_interval, self.renew_interval or float("inf"))
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _dispatch(self, executor):
+        """Claims jobs until max_jobs are running or the queue is empty"""
+        while len(self._tasks) < self.max_jobs:
+            job = self.jobs.claim(self.worker)
+            if job is None:
+                return
+            log.info("Dispatching %s job %d", job.kind, job.id)
+            cancel = self._cancels[job.id] = threading.Event()
+            task = self._loop.run_in_executor(executor, self._run_job, job, cancel)
+            self._tasks[task] = job
+            task.add_done_callback(self._done)
+
+    def _run_job(self, job, cancel):
+        try:
+            self.run_job(job, cancel)
+        except (JobCancelled, LeaseLost):
+            log.warning("Job %d stopped before its completion", job.id)
+        except Exception as err:
+            log.exception("Job %d failed", job.id)
+            self.jobs.fail(job, err)
+
+    def _done(self, task):
+        job = self._tasks.pop(task, None)
+        if job is not None:
+            self._cancels.pop(job.id, None)
+        self._wake()
+
+    def _renew(self):
+        """Renews the leases of the running jobs when they are due"""
+        if self.renew_interval is None or not self._tasks:
+            return
+        now = time.monotonic()
+        if now - self._renewed < self.renew_interval:
+            return
+        self._renewed = now
+        for job in list(self._tasks.values()):
+            if not self.jobs.renew(job):
+                log.warning("Lost the lease of job %d, stopping it", job.id)
+                self._cancels[job.id].set()
+
+    def _cancel_all(self):
+        for cancel in self._cancels.values():
+            cancel.set()
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _stop(self, drain):
+        self._stopping = True
+        self._drain = self._drain and drain
+        self._wake()
+
+    def _on_signal(self):
+        if self._stopping:
+            log.warning("Stopping the running jobs after their current batch")
+            self._stop(drain=False)
+        else:
+            log.info("Stopping once the running jobs are done")
+            self._stop(drain=True)
+
+    def _shutdown(self, executor):
+        # the jobs cancelled, or interrupted if run was, are left claimed
+        released = self.jobs.release(self.worker)
+        if released:
+            log.warning("Released %d unfinished jobs, they will be resumed", released)
+        executor.shutdown(wait=False)
+        self._loop = None
+        self._stopping = False
+        self._drain = True
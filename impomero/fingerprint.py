@@ -0,0 +1,151 @@
+"""Content fingerprints of the import candidates
+
+A moved, renamed or copied acquisition has a new path but the same bytes.
+Files are first compared by their fingerprint, their size and a hash of
+their first and last blocks, which is cheap to compute even for very large
+files. Many acquisitions of an instrument share their header, trailer and
+size though, so the fingerprint is only a pre-filter: two files are the
+same if the digests of their whole content are equal (see
+:func:`content_digest`), which is only computed for the files whose
+fingerprints match.
+
+Fingerprints and content digests are cached in the import DB (see
+:class:`impomero.db.StateStore`) and only recomputed when the inode,
+modification time or size of a file change.
+"""
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_SIZE = 2**20
+DEFAULT_WORKERS = 8
+
+
+def fingerprint(path, block_size: int = DEFAULT_BLOCK_SIZE, size: int = None):
+    """Returns the fingerprint of the file at path
+
+    The fingerprint is the file size followed by the blake2b digest of
+    its first and last block_size bytes. Different files can have the same
+    fingerprint, use :func:`content_digest` to tell them apart.
+    """
+    if size is None:
+        size = os.stat(path).st_size
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as fh:
+        digest.update(fh.read(block_size))
+        if size > block_size:
+            fh.seek(max(size - block_size, block_size))
+            digest.update(fh.read(block_size))
+    return f"{size}:{digest.hexdigest()}"
+
+
+def content_digest(path, block_size: int = DEFAULT_BLOCK_SIZE):
+    """Returns the file size followed by the blake2b digest of the
+    whole content of the file at path
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    size = 0
+    with open(path, "rb") as fh:
+        while True:
+            block = fh.read(block_size)
+            if not block:
+                break
+            size += len(block)
+            digest.update(block)
+    return f"{size}:{digest.hexdigest()}"
+
+
+class FingerprintIndex:
+    """Computes the fingerprints of many files, with a persistent cache
+
+    Parameters
+    ----------
+    store : :class:`impomero.db.StateStore`
+        the import DB, holding the cache and the ledger of imported files
+    max_workers : int
+        number of files read at the same time
+    block_size : int
+        number of bytes hashed at each end of a file
+    """
+
+    def __init__(
+        self,
+        store,
+        max_workers: int = DEFAULT_WORKERS,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+    ):
+        self.store = store
+        self.max_workers = max_workers
+        self.block_size = block_size
+        self.computed = 0
+        self.cached = 0
+
+    def fingerprints(self, paths):
+        """Returns a {path: fingerprint} dictionnary, files that can't be
+        read are absent from it
+        """
+        paths = list(paths)
+        with ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="impomero-hash"
+        ) as executor:
+            results = list(executor.map(self._fingerprint, paths))
+
+        found, new = {}, []
+        for path, (stat, digest, cached) in zip(paths, results):
+            if digest is None:
+                continue
+            found[path] = digest
+            if not cached:
+                new.append((path, stat, digest))
+        if new:
+            self.store.record_fingerprints(new)
+        self.computed += len(new)
+        self.cached += len(found) - len(new)
+        return found
+
+    def content_digests(self, paths):
+        """Returns a {path: content digest} dictionnary, files that can't
+        be read are absent from it (see :func:`content_digest`)
+        """
+        # the content digests are cached along with the fingerprints
+        paths = list(self.fingerprints(paths))
+        with ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="impomero-hash"
+        ) as executor:
+            results = list(executor.map(self._content_digest, paths))
+
+        found, new = {}, []
+        for path, (stat, digest, cached) in zip(paths, results):
+            if digest is None:
+                continue
+            found[path] = digest
+            if not cached:
+                new.append((path, stat, digest))
+        if new:
+            self.store.record_content_digests(new)
+        return found
+
+    def _content_digest(self, path):
+        try:
+            stat = os.stat(path)
+            digest = self.store.cached_content_digest(path, stat)
+            if digest is not None:
+                return stat, digest, True
+            return stat, content_digest(path, self.block_size), False
+        except OSError as err:
+            log.warning("Could not read %s: %s", path, err)
+            return None, None, False
+
+    def _fingerprint(self, path):
+        try:
+            stat = os.stat(path)
+            digest = self.store.cached_fingerprint(path, stat)
+            if digest is not None:
+                return stat, digest, True
+            return stat, fingerprint(path, self.block_size, stat.st_size), False
+        except OSError as err:
+            log.warning("Could not fingerprint %s: %s", path, err)
+            return None, None, False
@@ -4,90 +4,593 @@
 """
 import csv
 import logging
+import multiprocessing
 import os
 import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
+from typing import NamedTuple
 
 import yaml
 from omero.cli import CLI
 
-from .collector import create_import_table, get_configuration
+from . import tracing
+from .chunks import (
+    DEFAULT_CHUNK_BYTES,
+    DEFAULT_CHUNK_FILES,
+    chunk_key,
+    file_size,
+    split_chunks,
+)
+from .collector import (
+    DEFAULT_BATCH_AGE,
+    DEFAULT_BATCH_FILES,
+    create_import_table,
+    get_configuration,
+    iter_import_tables,
+)
+from .jobs import JobCancelled
+from .lookup import images_by_client_path
 
 log = logging.getLogger(__name__)
-logfile = logging.FileHandler("auto_importer.log", encoding="utf-8")
-log.setLevel("INFO")
-log.addHandler(logfile)
+
+# The omero CLI of this process, see _get_cli
+_cli = None
+
+# seconds between two checks of the cancel event while batches are imported
+CANCEL_POLL_INTERVAL = 1.0
+
+
+class _Chunking(NamedTuple):
+    max_files: int
+    max_bytes: int
+    checkpoints: object
 
 
 def auto_import(
-    base_dir, dry_run=False, import_table=None, reset=True, clean=False, **kwargs
+    base_dir,
+    dry_run=False,
+    import_table=None,
+    reset=True,
+    clean=False,
+    max_workers=1,
+    runner=None,
+    chunk_files=DEFAULT_CHUNK_FILES,
+    chunk_bytes=DEFAULT_CHUNK_BYTES,
+    checkpoints=None,
+    dedup=None,
+    fingerprints=None,
+    **kwargs,
 ):
     """Automatically import image data from the directories bellow base_dir
 
     The process starts by walking those directories to find annotation files.
     An annotation file must contain a `username` and a `project` entry.
 
+    Each (user, group) batch is split in chunks of at most chunk_files files
+    and about chunk_bytes bytes (see :func:`impomero.chunks.split_chunks`),
+    and each chunk is imported by a separate `omero import --bulk` call.
+    If max_workers is more than 1, the chunks are imported concurrently
+    by a pool of processes (the omero CLI is not thread safe).
+
+    If checkpoints is passed (see :class:`impomero.db.StateStore`), each
+    file imported is recorded there with its target, and the files already
+    imported to the same target are skipped: after a failure or an
+    interruption, only the files not imported yet are imported again,
+    however they are split in chunks.
+
+    The imports are ran by runner if it is passed, so that the CLI and the
+    sessions are reused from one call to the next (see :class:`ImportRunner`),
+    else by a runner with max_workers processes discarded at the end.
+
+    If dedup is passed, the files whose content was already imported are
+    found with the fingerprints index and flagged, dropped or linked to
+    their new dataset (see :func:`impomero.collector.mark_duplicates`).
+
+    If a `cancel` event (:class:`threading.Event`) is passed, the chunks not
+    started yet once it is set are not imported, and
+    :class:`impomero.jobs.JobCancelled` is raised after the completion of
+    the other chunks is recorded.
+
+    Returns
+    -------
+    conf : dict
+        the configuration of the last chunk, with the configurations of all
+        the chunks under the "batches" key
+    import_table : pd.DataFrame
+        the import table, with the "batch" (chunk) index and "import_status"
+        ("imported", "failed", "skipped", "linked", "cancelled" or "dry_run")
+        of each row,
+        and the "image_ids" created by the import of the row, or None if they
+        could not be read from the import output (see :func:`read_import_output`)
     """
 
     base_dir = Path(base_dir)
-    conf = get_configuration()
-    conf["base_dir"] = base_dir
     if (import_table is None) or reset:
-        import_table = create_import_table(base_dir)
+        import_table = create_import_table(
+            base_dir, dedup=dedup, fingerprints=fingerprints
+        )
 
+    chunking = _Chunking(chunk_files, chunk_bytes, checkpoints)
+    if runner is None:
+        with ImportRunner(max_workers=max_workers) as runner:
+            return _import_table(
+                base_dir, import_table, dry_run, clean, runner, chunking, kwargs
+            )
+    return _import_table(
+        base_dir, import_table, dry_run, clean, runner, chunking, kwargs
+    )
+
+
+def iter_import(
+    base_dir,
+    dry_run=False,
+    clean=False,
+    max_workers=1,
+    runner=None,
+    max_files=DEFAULT_BATCH_FILES,
+    max_age=DEFAULT_BATCH_AGE,
+    update_dataset=False,
+    exclude=None,
+    known=None,
+    chunk_files=DEFAULT_CHUNK_FILES,
+    chunk_bytes=DEFAULT_CHUNK_BYTES,
+    checkpoints=None,
+    dedup=None,
+    fingerprints=None,
+    **kwargs,
+):
+    """Imports the data bellow base_dir while the tree is being walked
+
+    The import candidates are streamed from the walk of base_dir (see
+    :func:`impomero.collector.iter_import_tables`), and imported by batches
+    of at most max_files files, or as soon as the oldest file of the batch
+    waited max_age seconds. The first imports thus start while the rest of
+    the tree is still being scanned. The files whose path is in exclude
+    are not imported, and the files in known are not even looked at (see
+    :func:`impomero.collector.iter_candidates`).
+
+    Other arguments are the same as for :func:`auto_import`
+
+    Yields
+    ------
+    conf, import_table : dict, pd.DataFrame
+        the result of :func:`auto_import` for each batch
+    """
+    base_dir = Path(base_dir)
+    chunking = _Chunking(chunk_files, chunk_bytes, checkpoints)
+    own_runner = runner is None
+    if own_runner:
+        runner = ImportRunner(max_workers=max_workers)
+    try:
+        for import_table in iter_import_tables(
+            base_dir,
+            max_files=max_files,
+            max_age=max_age,
+            update_dataset=update_dataset,
+            dedup=dedup,
+            fingerprints=fingerprints,
+            known=known,
+        ):
+            if exclude:
+                import_table = import_table[
+                    ~import_table["file_path"].isin(exclude)
+                ].reset_index(drop=True)
+                if import_table.empty:
+                    continue
+            yield _import_table(
+                base_dir, import_table, dry_run, clean, runner, chunking, kwargs
+            )
+    finally:
+        if own_runner:
+            runner.close()
+
+
+def _import_table(base_dir, import_table, dry_run, clean, runner, chunking, kwargs):
+    with tracing.span("import", base_dir=Path(base_dir).as_posix()) as span:
+        conf, import_table = _import_chunks(
+            base_dir, import_table, dry_run, clean, runner, chunking, kwargs
+        )
+        span.set(
+            files=len(import_table),
+            batches=len(conf.get("batches", [])),
+            statuses=import_table["import_status"].value_counts().to_dict(),
+        )
+    return conf, import_table
+
+
+def _import_chunks(base_dir, import_table, dry_run, clean, runner, chunking, kwargs):
+    base_conf = get_configuration()
+    base_conf["base_dir"] = base_dir
     if "group" not in import_table:
         import_table["group"] = ""
 
-    for (user, group), sub_table in import_table.groupby(["user", "group"]):
+    import_table["batch"] = -1
+    import_table["image_ids"] = None
+    import_table["import_status"] = None
+    sizes = import_table["file_path"].map(file_size)
+    # duplicates to be linked to their new dataset are not imported again
+    if "link" not in import_table:
+        import_table["link"] = False
+    linked = import_table["link"].fillna(False).astype(bool)
+    batches = []
+    to_import = import_table[~linked]
+    if chunking.checkpoints is not None and not dry_run:
+        to_import = _skip_imported(import_table, to_import, chunking.checkpoints)
+    for (user, group), sub_table in to_import.groupby(["user", "group"]):
+        seeds, chunks = split_chunks(
+            sub_table, sizes, max_files=chunking.max_files, max_bytes=chunking.max_bytes
+        )
+        for pos, rows in enumerate(seeds + chunks):
+            chunk = sub_table.loc[rows]
+            conf = _prepare_chunk(base_conf, user, group, chunk, sizes, dry_run)
+            conf["batch"] = len(batches)
+            conf["seed"] = pos < len(seeds)
+            import_table.loc[rows, "batch"] = conf["batch"]
+            batches.append(conf)
+
+    _run_chunks(runner, batches, dry_run, kwargs)
+    _record_statuses(import_table, batches, clean, runner, chunking.checkpoints)
+    cancel = kwargs.get("cancel")
+    if cancel is not None and cancel.is_set():
+        raise JobCancelled(f"Import of {base_dir} cancelled")
+    for idx in import_table.index[linked]:
+        import_table.at[idx, "import_status"] = "linked"
+        import_table.at[idx, "image_ids"] = import_table.at[idx, "duplicate_of"]
+    if not batches:
+        return base_conf, import_table
+    conf = batches[-1].copy()
+    conf["batches"] = batches
+    return conf, import_table
 
-        _, bulk_yml = tempfile.mkstemp(suffix=".yml", text=True)
-        log.info(f"creating bulk yaml {bulk_yml}")
 
-        _, tsv_file = tempfile.mkstemp(suffix=".tsv", text=True)
-        log.info(f"creating tsv_file {tsv_file}")
+def _skip_imported(import_table, to_import, checkpoints):
+    """Marks the rows of to_import already imported to their target
+    as skipped, returns the other rows
+    """
+    done = checkpoints.file_checkpoints(to_import["file_path"])
+    skipped = []
+    for idx, file_path, target in zip(
+        to_import.index, to_import["file_path"], to_import["target"]
+    ):
+        if (file_path, target) in done:
+            import_table.at[idx, "import_status"] = "skipped"
+            import_table.at[idx, "image_ids"] = done[(file_path, target)]
+            skipped.append(idx)
+    if skipped:
+        log.info("Skipping %d files already imported", len(skipped))
+    return to_import.drop(skipped)
+
+
+def _prepare_chunk(base_conf, user, group, chunk, sizes, dry_run):
+    conf = _prepare_batch(base_conf, user, group, chunk, dry_run)
+    conf["chunk_key"] = chunk_key(chunk)
+    conf["files"] = len(chunk)
+    conf["bytes"] = int(sizes[chunk.index].sum())
+    return conf
+
+
+def _run_chunks(runner, batches, dry_run, kwargs):
+    """Imports the chunks, the chunks creating the datasets first"""
+    seeds = [conf for conf in batches if conf["seed"]]
+    others = [conf for conf in batches if not conf["seed"]]
+    for stage in (seeds, others):
+        if not stage:
+            continue
+        statuses = runner.run(stage, dry_run=dry_run, **kwargs)
+        for conf, status in zip(stage, statuses):
+            conf["import_status"] = status
+
+
+def _record_statuses(import_table, batches, clean, runner, checkpoints):
+    in_batch = import_table["batch"] >= 0
+    import_table.loc[in_batch, "import_status"] = import_table.loc[
+        in_batch, "batch"
+    ].map({conf["batch"]: conf["import_status"] for conf in batches})
+    for conf in batches:
+        status = conf["import_status"]
+        if status in ("imported", "failed"):
+            # a failed bulk import may still have imported some of the files
+            _attach_image_ids(import_table, conf, find_images=runner.find_images)
+        if checkpoints is not None and status not in ("dry_run", "cancelled"):
+            _record_chunk(import_table, conf, checkpoints)
+        if clean:
+            for tmp in (conf["bulk_yml"], conf["tsv_file"], conf["out_file"]):
+                os.remove(tmp)
+            if status != "failed":
+                os.remove(conf["err_file"])
 
-        _, out_file = tempfile.mkstemp(suffix=".out.yml", text=True)
-        log.info(f"creating out_file {out_file}")
 
-        conf["username"] = user
-        conf["group"] = group
-        conf["bulk_yml"] = bulk_yml
-        conf["tsv_file"] = tsv_file
-        conf["out_file"] = out_file
+def _record_chunk(import_table, conf, checkpoints):
+    """Records the status of the chunk, and each of its files whose images
+    are known
+    """
+    rows = import_table[import_table["batch"] == conf["batch"]]
+    checkpoints.record_chunk(
+        conf["chunk_key"],
+        conf["base_dir"],
+        conf["import_status"],
+        conf["files"],
+        conf["bytes"],
+        image_ids=dict(zip(rows["file_path"], rows["image_ids"])),
+    )
+    imported = rows[rows["image_ids"].notna()]
+    checkpoints.record_file_checkpoints(
+        conf["base_dir"],
+        zip(imported["file_path"], imported["target"], imported["image_ids"]),
+    )
+
+
+class ImportRunner:
+    """Runs `omero import --bulk` batches, keeping the importers warm
+
+    Loading the CLI plugins and logging in costs a few seconds per import.
+    The runner loads the CLI once per process and keeps its worker
+    processes alive between calls to :meth:`run`. If a session pool is
+    given, the imports join the user sessions of the pool (with `-k`)
+    instead of logging in as root with `--sudo`; the sessions are checked
+    out of the pool until the batches using them are imported.
+
+    Parameters
+    ----------
+    max_workers : int, default 1
+        number of batches imported concurrently, if more than 1 the imports
+        are ran by a pool of processes, else in the current process
+    sessions : :class:`impomero.connection.ConnectionManager`, optional
+        pool from which the user session keys are taken
 
-        _create_bulk_yml(bulk_yml=bulk_yml, dry_run=dry_run, path=tsv_file)
-        sub_table[["target", "fileset", "file_path"]].to_csv(
-            tsv_file, sep="\t", index=False, header=False, quoting=csv.QUOTE_NONE
-        )
+    Example
+    -------
+
+    >>> with ImportRunner(max_workers=4, sessions=connections) as runner:
+    ...     conf, import_table = auto_import(base_dir, runner=runner)
+
+    """
 
-        if not dry_run:
-            perform_import(conf, **kwargs)
+    def __init__(self, max_workers: int = 1, sessions=None):
+        self.max_workers = max_workers
+        self.sessions = sessions
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def run(self, batches, dry_run=False, cancel=None, **kwargs):
+        """Imports the batches prepared by :func:`auto_import`
+
+        The batches not started yet once the cancel event is set
+        are not imported, their status is "cancelled"
+
+        Returns the list of the batches import statuses
+        """
+        if dry_run:
+            results = [_timed_import(conf, dry_run, kwargs) for conf in batches]
+            return _trace_batches(batches, results)
+        if self.max_workers > 1 and len(batches) > 1:
+            executor = self._get_executor()
+            with ExitStack() as held:
+                futures = []
+                for conf in batches:
+                    held.enter_context(self._session(conf))
+                    futures.append(
+                        executor.submit(_timed_import, conf, dry_run, kwargs)
+                    )
+                results = _wait_batches(futures, cancel)
         else:
-            print("dry_run")
-            print({k: v for k, v in conf.items() if k != "admin_passwd"})
+            results = []
+            for conf in batches:
+                if cancel is not None and cancel.is_set():
+                    results.append(("cancelled", None, None))
+                    continue
+                with self._session(conf):
+                    results.append(_timed_import(conf, dry_run, kwargs))
+        return _trace_batches(batches, results)
+
+    def find_images(self, conf, file_paths):
+        """Returns the images imported from file_paths by conf's batch,
+        as {file_path: [image ids]}, looked up by their client paths
+
+        The lookup needs the session pool, without it nothing is found.
+        """
+        if self.sessions is None:
+            return {}
+        try:
+            with self.sessions.session(conf["username"], conf["group"] or None) as conn:
+                return images_by_client_path(
+                    conn, file_paths, since=conf.get("started") or 0.0
+                )
+        except Exception:
+            log.exception("Could not look up the images of %s", conf["out_file"])
+            return {}
+
+    def close(self):
+        """Shuts down the worker processes"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            # the workers are long lived, and the monitor is multi-threaded,
+            # so they are spawned rather than forked
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_get_cli,
+            )
+        return self._executor
+
+    @contextmanager
+    def _session(self, conf):
+        """Checks out the session of the batch user for the duration of the
+        block, and sets its key in conf
+        """
+        conn = None
+        if self.sessions is not None:
+            try:
+                conn = self.sessions.checkout(conf["username"], conf["group"] or None)
+                conf["session_key"] = conn.c.getSessionId()
+            except Exception:
+                log.exception(
+                    "No session for %s, falling back to a sudo login",
+                    conf["username"],
+                )
+        try:
+            yield
+        finally:
+            if conn is not None:
+                self.sessions.checkin(conn)
+
+
+def _prepare_batch(base_conf, user, group, sub_table, dry_run):
+    """Writes the temporary files needed to import sub_table
+
+    Each batch has its own files, so they can be imported concurrently
+    """
+    conf = base_conf.copy()
+
+    _, bulk_yml = tempfile.mkstemp(suffix=".yml", text=True)
+    log.info(f"creating bulk yaml {bulk_yml}")
+
+    _, tsv_file = tempfile.mkstemp(suffix=".tsv", text=True)
+    log.info(f"creating tsv_file {tsv_file}")
+
+    _, out_file = tempfile.mkstemp(suffix=".out.yml", text=True)
+    log.info(f"creating out_file {out_file}")
+
+    _, err_file = tempfile.mkstemp(suffix=".err.txt", text=True)
+
+    conf["username"] = user
+    conf["group"] = group
+    conf["bulk_yml"] = bulk_yml
+    conf["tsv_file"] = tsv_file
+    conf["out_file"] = out_file
+    conf["err_file"] = err_file
+
+    _create_bulk_yml(bulk_yml=bulk_yml, dry_run=dry_run, path=tsv_file)
+    sub_table[["target", "fileset", "file_path"]].to_csv(
+        tsv_file, sep="\t", index=False, header=False, quoting=csv.QUOTE_NONE
+    )
+    return conf
+
+
+def _import_batch(conf, dry_run, kwargs):
+    """Imports a single batch, returns its import status"""
+    if dry_run:
+        print("dry_run")
+        print({k: v for k, v in conf.items() if k != "admin_passwd"})
+        return "dry_run"
+    try:
+        return_code = perform_import(conf, **kwargs)
+    except Exception:
+        log.exception("Import of %s's batch failed", conf["username"])
+        return "failed"
+    if return_code:
+        log.error(
+            "Import of %s's batch failed, see %s", conf["username"], conf["err_file"]
+        )
+        return "failed"
+    return "imported"
+
+
+def _timed_import(conf, dry_run, kwargs):
+    """Imports a single batch, returns its import status, start time
+    and duration
+    """
+    start = time.time()
+    status = _import_batch(conf, dry_run, kwargs)
+    return status, start, time.time() - start
 
-        if clean:
-            for tmp in (bulk_yml, tsv_file, out_file):
-                os.remove(tmp)
-    return conf, import_table
+
+def _wait_batches(futures, cancel):
+    """Waits for the imports, the ones not started are cancelled
+    once cancel is set
+    """
+    pending = set(futures)
+    while pending and cancel is not None:
+        _, pending = wait(pending, timeout=CANCEL_POLL_INTERVAL)
+        if cancel.is_set():
+            for future in pending:
+                future.cancel()
+            break
+    return [_batch_status(future) for future in futures]
+
+
+def _batch_status(future):
+    if future.cancelled():
+        return "cancelled", None, None
+    try:
+        return future.result()
+    except Exception:
+        # e.g. a worker process died
+        log.exception("Import worker failed")
+        return "failed", None, None
+
+
+def _trace_batches(batches, results):
+    """Records the import of each batch, returns the statuses"""
+    for conf, (status, start, duration) in zip(batches, results):
+        if start is None:
+            continue
+        conf["started"] = start
+        tracing.record(
+            "import_batch",
+            start,
+            duration,
+            user=conf.get("username"),
+            batch=conf.get("batch"),
+            files=conf.get("files"),
+            bytes=conf.get("bytes"),
+            status=status,
+        )
+    return [status for status, _, _ in results]
 
 
 def perform_import(conf, transfer="ln_s"):
+    """Runs `omero import --bulk` for the batch described by conf
 
-    # see https://docs.openmicroscopy.org/omero/5.6.2/users/cli/sessions.html
+    If conf has a "session_key", the import joins this session,
+    else it logs in as the batch user with `--sudo root`.
+
+    Returns the CLI return code
+    """
+    cmd = _import_command(conf, transfer)
+    secrets = {conf["admin_passwd"], conf.get("session_key")}
+    cmd_str = ["XXX" if arg in secrets else arg for arg in cmd]
+    log.info("Invoking omero %s", " ".join(cmd_str))
+    cli = _get_cli()
+    # the return code of the previous command is not reset by the CLI
+    cli.rv = 0
+    cli.invoke(cmd)
+    return cli.rv
 
-    cmd = [
-        "import",
-        "-s",
-        conf["server"],
-        "-p",
-        conf["port"],
-        "--sudo",
-        "root",
-        "-w",
-        conf["admin_passwd"],
-        "-u",
-        conf["username"],
+
+def _get_cli():
+    """Returns the CLI of this process, loading its plugins on first use"""
+    global _cli
+    if _cli is None:
+        _cli = CLI()
+        _cli.loadplugins()
+    return _cli
+
+
+def _import_command(conf, transfer):
+    # see https://docs.openmicroscopy.org/omero/5.6.2/users/cli/sessions.html
+    cmd = ["import", "-s", conf["server"], "-p", conf["port"]]
+    if conf.get("session_key"):
+        cmd.extend(["-k", conf["session_key"]])
+    else:
+        cmd.extend(
+            ["--sudo", "root", "-w", conf["admin_passwd"], "-u", conf["username"]]
+        )
+        if conf["group"]:
+            cmd.extend(["-g", conf["group"]])
+    cmd += [
         "--exclude",
         "clientpath",
         "--file",
@@ -95,23 +598,88 @@ def perform_import(conf, transfer="ln_s"):
         "--output",
         "yaml",
         "--errs",
-        Path("err.txt").absolute().as_posix(),
+        Path(conf["err_file"]).absolute().as_posix(),
         "--bulk",
         conf["bulk_yml"],
     ]
-    if conf["group"]:
-        cmd.extend(["-g", conf["group"]])
-
     if transfer:
         cmd.extend(["--transfer", transfer])
+    return cmd
 
-    cli = CLI()
-    cli.loadplugins()
-    pwd_idx = cmd.index(conf["admin_passwd"])
-    cmd_str = cmd.copy()
-    cmd_str[pwd_idx] = "XXX"
-    log.info("Invoking omero %s", " ".join(cmd_str))
-    cli.invoke(cmd)
+
+def read_import_output(out_file):
+    """Reads the yaml written by `omero import --output yaml`
+
+    Returns
+    -------
+    imported : list of dicts
+        one dictionnary per imported fileset, in import order, with the
+        "fileset" id, the list of "images" ids and the imported "path"
+        if the output reports it (None otherwise)
+    """
+    try:
+        with open(out_file) as out:
+            documents = list(yaml.safe_load_all(out))
+    except (OSError, yaml.YAMLError):
+        log.exception("Could not read the import output %s", out_file)
+        return []
+
+    imported = []
+    for document in documents:
+        if isinstance(document, dict):
+            document = [document]
+        for entry in document or []:
+            if not isinstance(entry, dict) or "Fileset" not in entry:
+                continue
+            images = entry.get("Image", [])
+            if not isinstance(images, list):
+                images = [images]
+            imported.append(
+                {
+                    "fileset": int(entry["Fileset"]),
+                    "images": [int(image) for image in images],
+                    "path": entry.get("path"),
+                }
+            )
+    return imported
+
+
+def _attach_image_ids(import_table, conf, find_images=None):
+    """Sets the "image_ids" of the rows of conf's batch from its import output
+
+    The filesets are matched with the rows by path if the output has them,
+    else by order, when all the rows were imported. Otherwise the files
+    can't be told apart, and their images are looked up on the server by
+    their original path with `find_images(conf, file_paths)` if it is
+    given. The rows matched with images are marked as imported, even if
+    the import of the batch failed, the others keep the status of the batch.
+    """
+    imported = read_import_output(conf["out_file"])
+    rows = import_table.index[import_table["batch"] == conf["batch"]]
+    file_paths = import_table.loc[rows, "file_path"].tolist()
+    by_path = {
+        Path(entry["path"]).absolute().as_posix(): entry["images"]
+        for entry in imported
+        if entry["path"]
+    }
+    if not by_path and len(imported) == len(rows):
+        by_path = {
+            file_path: entry["images"] for file_path, entry in zip(file_paths, imported)
+        }
+    elif not by_path and (imported or conf.get("import_status") != "failed"):
+        log.warning(
+            "%d filesets in %s for %d files, looking up their images",
+            len(imported),
+            conf["out_file"],
+            len(rows),
+        )
+        if find_images is not None:
+            by_path = find_images(conf, file_paths)
+    for idx, file_path in zip(rows, file_paths):
+        ids = by_path.get(file_path)
+        import_table.at[idx, "image_ids"] = ids
+        if ids is not None:
+            import_table.at[idx, "import_status"] = "imported"
 
 
 def _create_bulk_yml(bulk_yml="bulk.yml", **kwargs):
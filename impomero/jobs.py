@@ -0,0 +1,285 @@
+"""Durable queue of import and annotation jobs
+
+Jobs are stored in the import sqlite DB (see :class:`impomero.db.StateStore`)
+so that work survives a restart of the monitor. A job goes through the
+following states::
+
+    pending -> importing -> annotating -> done
+                        \\-> failed
+
+An update job (the card of an imported directory was modified, or files
+were added to it) first updates the annotations, then imports the new
+files, and goes through annotating before importing.
+
+Each stage is recorded once it is completed, so a job interrupted by a
+crash is resumed at its last stage rather than from scratch.
+
+Several monitors (on several hosts, sharing the import DB) can work from
+the same queue. A claimed job is leased to its worker until
+`claimed_until`: the worker renews the lease while it runs the job (see
+:class:`impomero.dispatcher.JobDispatcher`), and a job whose lease expired,
+e.g. because its host crashed, is claimed again by another worker. Only
+one live lease is granted per directory, and a worker that lost its lease
+can not record progress on the job anymore (see :class:`LeaseLost`).
+
+Another backend can be used as long as it provides the methods of
+:class:`JobQueue`.
+"""
+import logging
+import os
+import socket
+import time
+from typing import NamedTuple
+
+from .db import StateStore
+
+log = logging.getLogger(__name__)
+
+PENDING = "pending"
+IMPORTING = "importing"
+ANNOTATING = "annotating"
+DONE = "done"
+FAILED = "failed"
+
+FINAL_STATES = (DONE, FAILED)
+
+DEFAULT_MAX_ATTEMPTS = 3
+# seconds a claimed job stays leased to its worker without renewal
+DEFAULT_LEASE = 300.0
+
+
+class LeaseLost(RuntimeError):
+    """The lease of a job expired or was released, another worker
+    may be running it
+    """
+
+
+class JobCancelled(RuntimeError):
+    """The job was asked to stop before its completion, e.g. because
+    its lease could not be renewed
+    """
+
+
+class Job(NamedTuple):
+    id: int
+    kind: str
+    base_dir: str
+    toml_path: str
+    state: str
+    attempts: int
+    payload: str
+    worker: str = None
+
+
+_JOB_COLUMNS = "id, kind, base_dir, toml_path, state, attempts, payload, worker"
+
+
+def default_worker_name():
+    """Returns a name unique to this process"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _is_orphan(worker):
+    """Returns True if worker is a process of this host that is not running"""
+    host, _, pid = worker.rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        # e.g. the process exists but belongs to another user
+        return False
+    return False
+
+
+class JobQueue:
+    """Job queue persisted in the import DB
+
+    Parameters
+    ----------
+    store : :class:`impomero.db.StateStore` or str
+        the import DB, or the path to it
+    max_attempts : int, default 3
+        a job claimed that many times without completing is marked as failed
+    lease : float, default 300
+        seconds a claimed job stays leased without being renewed
+
+    """
+
+    def __init__(
+        self,
+        store,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        lease: float = DEFAULT_LEASE,
+    ):
+        if not isinstance(store, StateStore):
+            store = StateStore(store)
+        self.store = store
+        self.max_attempts = max_attempts
+        self.lease = lease
+
+    def enqueue(self, kind, base_dir, toml_path):
+        """Adds a job, or updates the pending job of the same base_dir
+
+        Returns the job id
+        """
+        now = time.time()
+        with self.store.transaction() as sql_con:
+            row = sql_con.execute(
+                "SELECT id FROM jobs WHERE base_dir=? AND state=? AND worker IS NULL",
+                (str(base_dir), PENDING),
+            ).fetchone()
+            if row is not None:
+                job_id = row[0]
+                sql_con.execute(
+                    "UPDATE jobs SET kind=?, toml_path=?, updated=? WHERE id=?",
+                    (kind, str(toml_path), now, job_id),
+                )
+                log.info("Updated pending job %d for %s", job_id, base_dir)
+            else:
+                job_id = sql_con.execute(
+                    """INSERT INTO jobs (kind, base_dir, toml_path, state,
+                    attempts, created, updated) VALUES (?, ?, ?, ?, 0, ?, ?)""",
+                    (kind, str(base_dir), str(toml_path), PENDING, now, now),
+                ).lastrowid
+                log.info("Queued %s job %d for %s", kind, job_id, base_dir)
+        return job_id
+
+    def claim(self, worker=None):
+        """Atomically claims the oldest runnable job, and leases it to worker
+
+        A job is runnable if it is not finished, not claimed (or its lease
+        expired), and no other job of the same base_dir is leased.
+
+        Returns
+        -------
+        job : :class:`Job` or None if there is nothing to do
+        """
+        worker = worker or default_worker_name()
+        while True:
+            with self.store.transaction() as sql_con:
+                now = time.time()
+                row = sql_con.execute(
+                    f"""SELECT {_JOB_COLUMNS} FROM jobs
+                    WHERE state NOT IN (?, ?)
+                    AND (worker IS NULL OR COALESCE(claimed_until, 0) < ?)
+                    AND base_dir NOT IN (
+                        SELECT base_dir FROM jobs
+                        WHERE worker IS NOT NULL AND claimed_until >= ?
+                        AND state NOT IN (?, ?))
+                    ORDER BY id LIMIT 1""",
+                    (*FINAL_STATES, now, now, *FINAL_STATES),
+                ).fetchone()
+                if row is None:
+                    return None
+                job = Job(*row)
+                if job.worker is not None:
+                    log.warning("The lease of job %d by %s expired", job.id, job.worker)
+                if job.attempts < self.max_attempts:
+                    sql_con.execute(
+                        """UPDATE jobs SET worker=?, claimed_until=?,
+                        attempts=attempts + 1, updated=? WHERE id=?""",
+                        (worker, now + self.lease, now, job.id),
+                    )
+                    return job._replace(attempts=job.attempts + 1, worker=worker)
+                sql_con.execute(
+                    "UPDATE jobs SET state=?, worker=NULL, updated=? WHERE id=?",
+                    (FAILED, now, job.id),
+                )
+            log.error("Job %d failed %d times, giving up", job.id, job.attempts)
+
+    def advance(self, job, state, payload=None):
+        """Records that job reached state, with an optional payload
+        needed by the next stage
+
+        Returns the updated job
+
+        Raises
+        ------
+        LeaseLost
+            if job is not leased to its worker anymore
+        """
+        payload = job.payload if payload is None else payload
+        cursor = self.store.execute(
+            "UPDATE jobs SET state=?, payload=?, updated=? WHERE id=? AND worker IS ?",
+            (state, payload, time.time(), job.id, job.worker),
+        )
+        if not cursor.rowcount:
+            raise LeaseLost(f"Job {job.id} is not leased to {job.worker} anymore")
+        return job._replace(state=state, payload=payload)
+
+    def renew(self, job):
+        """Extends the lease of job, returns False if it was lost"""
+        cursor = self.store.execute(
+            "UPDATE jobs SET claimed_until=? WHERE id=? AND worker IS ?",
+            (time.time() + self.lease, job.id, job.worker),
+        )
+        if not cursor.rowcount:
+            log.warning("Job %d is not leased to %s anymore", job.id, job.worker)
+        return bool(cursor.rowcount)
+
+    def finish(self, job):
+        """Marks job as done and releases it"""
+        self._release_job(job, DONE, None)
+
+    def fail(self, job, error):
+        """Releases job after an error, it is retried until it has been
+        attempted `max_attempts` times
+        """
+        state = FAILED if job.attempts >= self.max_attempts else job.state
+        self._release_job(job, state, str(error))
+
+    def _release_job(self, job, state, error):
+        cursor = self.store.execute(
+            """UPDATE jobs SET state=?, worker=NULL, claimed_until=NULL, error=?,
+            updated=? WHERE id=? AND worker IS ?""",
+            (state, error, time.time(), job.id, job.worker),
+        )
+        if not cursor.rowcount:
+            # another worker took the job over, its record wins
+            log.warning("Job %d is not leased to %s anymore", job.id, job.worker)
+
+    def release(self, worker=None):
+        """Releases the jobs claimed by worker (all jobs if worker is None),
+        e.g. after a crash. They are resumed at the stage they had reached.
+
+        Returns the number of released jobs
+        """
+        if worker is None:
+            cursor = self.store.execute(
+                "UPDATE jobs SET worker=NULL, claimed_until=NULL "
+                "WHERE worker IS NOT NULL"
+            )
+        else:
+            cursor = self.store.execute(
+                "UPDATE jobs SET worker=NULL, claimed_until=NULL WHERE worker=?",
+                (worker,),
+            )
+        return cursor.rowcount
+
+    def release_orphans(self):
+        """Releases the jobs claimed by the processes of this host that
+        are not running anymore, without waiting for their lease to expire
+
+        Returns the number of released jobs
+        """
+        workers = [
+            row[0]
+            for row in self.store.query(
+                "SELECT DISTINCT worker FROM jobs WHERE worker IS NOT NULL"
+            )
+        ]
+        return sum(self.release(worker) for worker in workers if _is_orphan(worker))
+
+    def get(self, job_id):
+        """Returns the job with id job_id"""
+        rows = self.store.query(
+            f"SELECT {_JOB_COLUMNS} FROM jobs WHERE id=?", (job_id,)
+        )
+        return Job(*rows[0]) if rows else None
+
+    def counts(self):
+        """Returns the number of jobs per state"""
+        return dict(self.store.query("SELECT state, COUNT(*) FROM jobs GROUP BY state"))
@@ -0,0 +1,194 @@
+"""Id lookups of the imported datasets and images
+
+Loading full Dataset and Image wrappers to read their ids costs a query
+per object and keeps the whole graph in memory. The :class:`DatasetLookup`
+only asks the query service for ids, and remembers the answers.
+"""
+import logging
+import threading
+
+from omero.model import DatasetI, ProjectDatasetLinkI, ProjectI
+from omero.rtypes import rlist, rlong, rstring, rtime, unwrap
+from omero.sys import ParametersI
+
+from . import tracing
+
+log = logging.getLogger(__name__)
+
+DATASET_IDS = (
+    "select d.id from ProjectDatasetLink l join l.parent p join l.child d "
+    "where d.name in (:dnames) and p.name in (:pnames) "
+    "and d.details.owner.id = :uid and d.details.group.id = :gid "
+    "order by d.id desc"
+)
+
+PROJECT_IDS = (
+    "select p.id from Project p where p.name in (:pnames) "
+    "and p.details.owner.id = :uid and p.details.group.id = :gid "
+    "order by p.id desc"
+)
+
+IMAGE_IDS = (
+    "select l.child.id from DatasetImageLink l "
+    "where l.parent.id = :did order by l.child.id"
+)
+
+FILESET_IMAGES = (
+    "select e.clientPath, i.id from Image i join i.fileset f "
+    "join f.usedFiles e where e.clientPath in (:paths) "
+    "and f.details.creationEvent.time >= :since order by i.id"
+)
+
+# number of client paths per fileset query
+PATHS_PER_QUERY = 500
+
+
+def _names(name):
+    # the datasets created by the cli may have kept their quotes
+    return rlist([rstring(name), rstring(f'"{name}"')])
+
+
+def images_by_client_path(conn, file_paths, since=0.0):
+    """Returns the ids of the images imported from file_paths since
+    the given time, as {file_path: [image ids]}
+
+    The importer stores the client paths without their leading slash,
+    both forms are looked up. The files not found are left out.
+
+    Parameters
+    ----------
+    conn : omero.gateway.BlitzGateway
+    file_paths : list of str
+        absolute paths of the imported files
+    since : float, default 0
+        time stamp (in seconds) before which the filesets are ignored,
+        so that the previous imports of the same files are not returned
+    """
+    client_paths = {}
+    for file_path in file_paths:
+        client_paths[file_path] = file_path
+        client_paths[file_path.lstrip("/")] = file_path
+    paths = list(client_paths)
+    found = {}
+    with tracing.span("fileset_lookup", files=len(file_paths)) as span:
+        for start in range(0, len(paths), PATHS_PER_QUERY):
+            params = ParametersI()
+            params.add(
+                "paths",
+                rlist([rstring(p) for p in paths[start : start + PATHS_PER_QUERY]]),
+            )
+            params.add("since", rtime(int(since * 1000)))
+            tracing.count(server_calls=1)
+            rows = conn.getQueryService().projection(
+                FILESET_IMAGES, params, conn.SERVICE_OPTS
+            )
+            for client_path, image_id in unwrap(rows):
+                found.setdefault(client_paths[client_path], []).append(image_id)
+        span.set(found=len(found))
+    return found
+
+
+class DatasetLookup:
+    """Caches the dataset and image ids found with projection queries
+
+    The cache is meant to live for one annotation run, as the datasets
+    can receive new images in between.
+
+    Attributes
+    ----------
+    queries : int
+        number of queries sent to the server
+    """
+
+    def __init__(self):
+        self._dataset_ids = {}
+        self._image_ids = {}
+        self._lock = threading.Lock()
+        self.queries = 0
+
+    def dataset_id(self, conn, project, dataset, create=False):
+        """Returns the id of the connected user's dataset named dataset in
+        project. If there are several, the most recent one is returned.
+
+        If create is True, the dataset (and the project) are created
+        if they don't exist
+
+        Raises
+        ------
+        ValueError if there is no such dataset and create is False
+        """
+        ctx = conn.getEventContext()
+        key = (ctx.userId, ctx.groupId, project, dataset)
+        with self._lock:
+            if key not in self._dataset_ids:
+                with tracing.span("dataset_lookup", dataset=dataset):
+                    self._dataset_ids[key] = self._find_dataset(
+                        conn, ctx, project, dataset, create
+                    )
+            return self._dataset_ids[key]
+
+    def _find_dataset(self, conn, ctx, project, dataset, create):
+        params = self._params(ctx, pnames=_names(project))
+        params.add("dnames", _names(dataset))
+        rows = self._projection(conn, DATASET_IDS, params)
+        if rows:
+            log.info(f"Found dataset {dataset} of project {project}")
+            return rows[0][0]
+        if create:
+            return self._create(conn, ctx, project, dataset)
+        raise ValueError(f"No dataset {dataset} associated with project {project}")
+
+    def image_ids(self, conn, dataset_id):
+        """Returns the ids of the images in the dataset"""
+        with self._lock:
+            if dataset_id not in self._image_ids:
+                with tracing.span("image_lookup", dataset_id=dataset_id) as span:
+                    params = ParametersI()
+                    params.add("did", rlong(dataset_id))
+                    rows = self._projection(conn, IMAGE_IDS, params)
+                    self._image_ids[dataset_id] = [row[0] for row in rows]
+                    span.set(images=len(rows))
+            return list(self._image_ids[dataset_id])
+
+    def clear(self):
+        """Forgets all the cached ids"""
+        with self._lock:
+            self._dataset_ids.clear()
+            self._image_ids.clear()
+
+    def _create(self, conn, ctx, project, dataset):
+        rows = self._projection(
+            conn, PROJECT_IDS, self._params(ctx, pnames=_names(project))
+        )
+        if rows:
+            parent = ProjectI(rows[0][0], False)
+        else:
+            log.info(f"Creating project {project}")
+            parent = ProjectI()
+            parent.setName(rstring(project))
+        log.info(f"Creating dataset {dataset} in project {project}")
+        child = DatasetI()
+        child.setName(rstring(dataset))
+        link = ProjectDatasetLinkI()
+        link.setParent(parent)
+        link.setChild(child)
+        tracing.count(server_calls=1)
+        link = conn.getUpdateService().saveAndReturnObject(link, conn.SERVICE_OPTS)
+        return link.getChild().getId().getValue()
+
+    @staticmethod
+    def _params(ctx, **params):
+        query_params = ParametersI()
+        query_params.add("uid", rlong(ctx.userId))
+        query_params.add("gid", rlong(ctx.groupId))
+        for key, value in params.items():
+            query_params.add(key, value)
+        query_params.page(0, 1)
+        return query_params
+
+    def _projection(self, conn, query, params):
+        self.queries += 1
+        tracing.count(server_calls=1)
+        return unwrap(
+            conn.getQueryService().projection(query, params, conn.SERVICE_OPTS)
+        )
@@ -1,19 +1,43 @@
 """Filesystem monitoring
 """
 
+import asyncio
+import json
 import logging
-import sqlite3
-import time
+import os
+import signal
 from pathlib import Path
 
-from omero.gateway import BlitzGateway
-from watchdog.events import PatternMatchingEventHandler
-from watchdog.observers.polling import PollingObserver as Observer
+import pandas as pd
+from watchdog.events import EVENT_TYPE_MODIFIED, PatternMatchingEventHandler
 
-from .annotation_job import auto_annotate, update_annotation
-from .collector import get_configuration, is_annotation
-from .db import init_db
-from .importer_job import auto_import
+from . import tracing
+from .annotation_job import (
+    auto_annotate,
+    normalize_card,
+    update_dataset_annotations,
+)
+from .cards import load_card
+from .coalescer import DEFAULT_QUIET_PERIOD, EventCoalescer
+from .collector import is_annotation
+from .connection import ConnectionManager
+from .db import DEFAULT_JOURNAL_MODE, StateStore
+from .dispatcher import JobDispatcher
+from .fingerprint import FingerprintIndex
+from .importer_job import ImportRunner, auto_import, iter_import
+from .jobs import (
+    ANNOTATING,
+    DEFAULT_LEASE,
+    IMPORTING,
+    PENDING,
+    JobCancelled,
+    JobQueue,
+    LeaseLost,
+    default_worker_name,
+)
+from .observer import DEFAULT_INTERVAL, DirectoryPollingObserver
+from .roots import watched_roots
+from .walker import scan_tree
 
 log = logging.getLogger(__name__)
 
@@ -30,10 +54,32 @@ class TomlCreatedEventHandler(PatternMatchingEventHandler):
     :func:`impomero.collector.is_annotation`).  If this is the case,
     the data already present in its parent directory is imported and
     anotated, and the directory is added to the observed directories
+
+    The work is queued in the import DB (see :class:`impomero.jobs.JobQueue`),
+    so it is resumed after a restart, and run by a
+    :class:`impomero.dispatcher.JobDispatcher`, so that a long import does
+    not hold back the events of other directories.
+
+    Once a directory is imported, the files found below it are recorded in
+    its manifest. When new files appear in an imported directory (or its
+    card is modified), only the files missing from the manifest are
+    imported and annotated (see :meth:`import_new`).
     """
 
     def __init__(
-        self, transfer: str = None, dry_run: bool = False, import_db: str = None
+        self,
+        transfer: str = None,
+        dry_run: bool = False,
+        import_db: str = None,
+        quiet_period: float = DEFAULT_QUIET_PERIOD,
+        import_workers: int = 1,
+        connections: ConnectionManager = None,
+        journal_mode: str = DEFAULT_JOURNAL_MODE,
+        stream: bool = False,
+        dedup: str = None,
+        max_jobs: int = 1,
+        lease: float = DEFAULT_LEASE,
+        jobs=None,
     ):
         """Returns a :class:`TomlCreatedEventHandler` instance
 
@@ -46,7 +92,31 @@ class TomlCreatedEventHandler(PatternMatchingEventHandler):
             if True, will only print what it would do (up to some point)
         import_db : str
             path to the sqlite DB used to store information between sessions
-
+        quiet_period : float
+            events are processed once their card's directory did not see
+            any other event for that many seconds
+        import_workers : int, default 1
+            number of (user, group) batches imported concurrently
+        connections : :class:`impomero.connection.ConnectionManager`, optional
+            pool of server connections, by default a new one
+            is created with the configuration from the environment
+        journal_mode : str, default "auto"
+            journal mode of the import DB (see :class:`impomero.db.StateStore`)
+        stream : bool, default False
+            if True, new directories are imported and annotated by batches
+            while they are walked, instead of after the whole walk
+        dedup : str, optional
+            one of "flag", "drop" or "link", what to do with the files whose
+            content was already imported (see
+            :func:`impomero.collector.mark_duplicates`), by default their
+            content is not checked
+        max_jobs : int, default 1
+            number of jobs (i.e. directories) processed concurrently
+        lease : float, default 300
+            seconds a job stays leased to this monitor without renewal,
+            after that another monitor sharing the import DB can claim it
+        jobs : :class:`impomero.jobs.JobQueue`, optional
+            the job queue, by default the one of the import DB
 
         .. _[1]: https://docs.openmicroscopy.org/omero/5.6.3/sysadmins/\
         in-place-import.html#getting-started
@@ -54,97 +124,390 @@ class TomlCreatedEventHandler(PatternMatchingEventHandler):
         self.transfer = transfer
         self.dry_run = dry_run
         self.import_db = import_db
-        init_db(import_db)
+        self.import_workers = import_workers
+        self.stream = stream
+        self.connections = connections or ConnectionManager()
+        self.importer = ImportRunner(import_workers, sessions=self.connections)
+        self.store = StateStore(import_db, journal_mode=journal_mode)
+        self.jobs = jobs or JobQueue(self.store, lease=lease)
+        self.dedup = dedup
+        self.fingerprints = FingerprintIndex(self.store) if dedup else None
+        self.worker = default_worker_name()
+        self.dispatcher = JobDispatcher(
+            self.jobs, self.run_job, max_jobs=max_jobs, worker=self.worker
+        )
+        self.coalescer = EventCoalescer(self.process_card, quiet_period=quiet_period)
         super().__init__(patterns=["*.toml"])
 
     def on_created(self, event):
         """What happens when a toml file is created"""
         log.info(f"Toml file {event.src_path} created")
-        if not is_annotation(event.src_path):
-            log.info(f"{event.src_path} was not an annotation file")
+        self.coalescer.submit(event.src_path)
+
+    def on_modified(self, event):
+        log.info(f"Toml file {event.src_path} modified")
+        self.coalescer.submit(event.src_path)
+
+    def dispatch(self, event):
+        # directory events do not match the toml pattern
+        if event.is_directory and event.event_type == EVENT_TYPE_MODIFIED:
+            self.on_dir_modified(event)
             return
+        super().dispatch(event)
+
+    def on_dir_modified(self, event):
+        """Files were added or removed in a directory, if it belongs to
+        an imported directory, its card is processed again
+        """
+        found = self.store.enclosing_card(Path(event.src_path).resolve())
+        if found is None:
+            return
+        base_dir, toml_path = found
+        log.info(f"Directory {event.src_path} of {base_dir} modified")
+        self.coalescer.submit(toml_path)
+
+    def on_moved(self, event):
+        # e.g. rsync renaming its temporary file
+        if event.dest_path.endswith(".toml"):
+            log.info(f"Toml file moved to {event.dest_path}")
+            self.coalescer.submit(event.dest_path)
+
+    def process_card(self, toml_path):
+        """Imports or updates the data annotated by the card at toml_path"""
+        if not Path(toml_path).exists():
+            log.info(f"{toml_path} does not exist anymore")
+            return
+        if not is_annotation(toml_path):
+            log.info(f"{toml_path} was not an annotation file")
+            return
+
+        base_dir = Path(toml_path).parent.resolve()
+        kind = "update" if self.store.has_imported(base_dir) else "import"
+        self.jobs.enqueue(kind, base_dir.as_posix(), toml_path)
+        self.dispatcher.notify()
+
+    def run_pending(self):
+        """Runs the queued jobs in the current thread until there are none left
+
+        The monitor runs them with its :class:`impomero.dispatcher.JobDispatcher`
+        """
+        while True:
+            job = self.jobs.claim(self.worker)
+            if job is None:
+                return
+            self.run_job(job)
 
-        base_dir = Path(event.src_path).parent
+    def run_job(self, job, cancel=None):
+        """Runs a job from its last completed stage
 
+        If the cancel event is set, e.g. because the lease of the job was
+        lost, no more import batch is started and the job is left as is
+        """
+        base_dir = Path(job.base_dir)
         log.info("~~~~~~~~~####~~~~~~~~~")
-        log.info(f"importing from {base_dir}")
+        log.info(f"{job.kind} job {job.id} for {base_dir} ({job.state})")
         log.info("~~~~~~~~~####~~~~~~~~~")
+        with tracing.span("job", kind=job.kind, job=job.id, base_dir=str(base_dir)):
+            try:
+                if job.kind == "update" or self._imported_since(job, base_dir):
+                    job, card = self._update_stage(job, base_dir, cancel)
+                elif self.stream:
+                    # the card as it is when the import starts
+                    card = load_card(job.toml_path)
+                    job = self.jobs.advance(job, IMPORTING)
+                    files = self.list_files(base_dir)
+                    failed = self.stream_import(base_dir, cancel=cancel)
+                    self.record_manifest(base_dir, files - failed)
+                else:
+                    job = self._import_stage(job, base_dir, cancel)
+                    payload = json.loads(job.payload)
+                    card = payload["card"]
+                    import_table = pd.DataFrame.from_records(payload["import_table"])
+                    self.annotate_imported(base_dir, import_table)
+                self.store.record_card(base_dir, job.toml_path, card)
+                self.store.add_monitored(base_dir)
+            except LeaseLost:
+                log.warning(f"Job {job.id} was taken over by another worker")
+            except JobCancelled:
+                log.warning(f"Job {job.id} stopped at stage {job.state}")
+            except Exception as err:
+                log.exception(f"{job.kind} job {job.id} failed at stage {job.state}")
+                self.jobs.fail(job, err)
+            else:
+                self.jobs.finish(job)
 
-        with sqlite3.connect(self.import_db) as sql_con:
-            ids = [
-                val[0]
-                for val in sql_con.execute(
-                    f"SELECT id FROM annotated WHERE base_dir='{base_dir}'"
+    def _import_stage(self, job, base_dir, cancel=None):
+        """Imports the data of an import job if it was not done yet,
+        and stores the import table in the job payload
+        """
+        if job.state not in (PENDING, IMPORTING):
+            return job
+        # the card as it is when the import starts
+        card = load_card(job.toml_path)
+        job = self.jobs.advance(job, IMPORTING)
+        files = self.list_files(base_dir)
+        import_table = self.import_data(base_dir, cancel=cancel)
+        self.record_manifest(base_dir, files - _failed(import_table))
+        payload = json.dumps(
+            {
+                "card": card,
+                "import_table": json.loads(
+                    import_table.to_json(
+                        orient="records",
+                        date_format="iso",
+                        default_handler=str,
+                    )
+                ),
+            },
+            default=str,
+        )
+        return self.jobs.advance(job, ANNOTATING, payload=payload)
+
+    def _imported_since(self, job, base_dir):
+        """An import job queued while another worker imported the same
+        directory only needs to update it
+        """
+        return job.state == PENDING and self.store.has_imported(base_dir)
+
+    def _update_stage(self, job, base_dir, cancel=None):
+        """Updates the annotations if the card changed, then imports
+        the new files of the directory
+        """
+        card = load_card(job.toml_path)
+        if job.state in (PENDING, ANNOTATING):
+            job = self.jobs.advance(job, ANNOTATING)
+            old_card = self.store.card_state(base_dir)
+            if normalize_card(card) != old_card:
+                self.update_imported(
+                    self.imported_ids(base_dir), job.toml_path, card=card
                 )
-            ]
-        if ids:
-            self.update_imported(ids, event.src_path)
-        else:
-            self.fresh_import(base_dir)
-        with sqlite3.connect(self.import_db) as sql_con:
-            sql_con.execute(f"INSERT INTO monitored (base_dir) VALUES ({base_dir});")
+            self.store.record_card(base_dir, job.toml_path, card)
+            job = self.jobs.advance(job, IMPORTING)
+        self.import_new(base_dir, cancel=cancel)
+        return job, card
 
-    def on_modified(self, event):
-        return self.on_created(event)
+    def imported_ids(self, base_dir):
+        """Returns the ids of the images already imported from base_dir"""
+        return self.store.imported_ids(base_dir)
 
     def fresh_import(self, base_dir):
         """If base_dir did not have images before, import them"""
+        import_table = self.import_data(base_dir)
+        self.annotate_imported(base_dir, import_table)
+
+    def import_data(self, base_dir, cancel=None):
+        """Imports the data below base_dir, returns the import table
+
+        No more batch is imported once cancel is set (see
+        :func:`impomero.importer_job.auto_import`)
+        """
         conf, import_table = auto_import(
             base_dir=base_dir,
             dry_run=self.dry_run,
             # We do not want to clean temp files
             # as we want to data annotate after
             clean=False,
+            runner=self.importer,
+            checkpoints=self.store,
+            dedup=self.dedup,
+            fingerprints=self.fingerprints,
             transfer=self.transfer,
+            cancel=cancel,
         )
+        return import_table
 
+    def stream_import(self, base_dir, known=None, update_dataset=False, cancel=None):
+        """Imports and annotates the data below base_dir batch by batch,
+        while the directory is being walked (see
+        :func:`impomero.importer_job.iter_import`)
+
+        The files already in the ledger, e.g. imported by an interrupted
+        job, are skipped, and the files in known are not looked at. No more
+        batch is imported once cancel is set.
+
+        Returns the set of the paths of the files that failed to import
+        """
+        imported = self.store.imported_files(base_dir)
+        failed = set()
+        for conf, import_table in iter_import(
+            base_dir=base_dir,
+            dry_run=self.dry_run,
+            clean=False,
+            runner=self.importer,
+            update_dataset=update_dataset,
+            exclude=imported,
+            known=known,
+            checkpoints=self.store,
+            dedup=self.dedup,
+            fingerprints=self.fingerprints,
+            transfer=self.transfer,
+            cancel=cancel,
+        ):
+            self.annotate_imported(base_dir, import_table)
+            failed |= _failed(import_table)
+        return failed
+
+    def import_new(self, base_dir, cancel=None):
+        """Imports and annotates the files added below base_dir since
+        it was imported
+
+        The files of the directory are compared with its manifest: only the
+        new ones are passed to `import_candidates`, imported in the existing
+        datasets and annotated, so the cost grows with the new data rather
+        than with the whole directory.
+        """
+        known = self.manifest(base_dir)
+        files = self.list_files(base_dir)
+        new = files - known
+        if not new:
+            log.info(f"No new files in {base_dir}")
+            return
+        log.info(f"Importing {len(new)} new files from {base_dir}")
+        failed = self.stream_import(
+            base_dir, known=known, update_dataset=True, cancel=cancel
+        )
+        self.record_manifest(base_dir, new - failed)
+
+    def list_files(self, base_dir):
+        """Returns the set of the (posix) paths of the files below base_dir"""
+        return {path.as_posix() for path in scan_tree(base_dir).files}
+
+    def manifest(self, base_dir):
+        """Returns the set of the files already handled below base_dir
+
+        Directories imported before the manifests were recorded get one
+        with the files older than their first import and the files of
+        the ledger.
+        """
+        known = self.store.manifest_files(base_dir)
+        if known or not self.store.has_imported(base_dir):
+            return known
+        since = self.store.first_recorded(base_dir)
+        known = self.store.imported_files(base_dir)
+        if since is not None:
+            known |= {
+                path for path in self.list_files(base_dir) if _mtime(path) < since
+            }
+        log.info(f"Recording the manifest of {base_dir} ({len(known)} files)")
+        self.record_manifest(base_dir, known)
+        return known
+
+    def record_manifest(self, base_dir, files):
+        if not self.dry_run:
+            self.store.record_manifest(base_dir, files)
+
+    def annotate_imported(self, base_dir, import_table):
+        """Annotates the images imported from base_dir"""
         log.info("~~~~~~~~~####~~~~~~~~~")
         log.info("Annotating ... ")
         log.info("~~~~~~~~~####~~~~~~~~~")
-        with BlitzGateway(
-            host=conf["server"],
-            port=conf["port"],
-            username="root",
-            passwd=conf["admin_passwd"],
-            secure=True,
-        ) as conn:
-            annotated = auto_annotate(conn, import_table)
-
-        annotated["base_dir"] = base_dir.resolve().as_posix()
-        with sqlite3.connect(self.import_db) as sql_con:
-            annotated.to_sql("annotated", con=sql_con, if_exists="append")
-
-        # TODO: spawn a new Observer for that base_dir
-
-    def update_imported(self, ids, toml_path):
-
-        conf = get_configuration()
-        with BlitzGateway(
-            host=conf["server"],
-            port=conf["port"],
-            username="root",
-            passwd=conf["admin_passwd"],
-            secure=True,
-        ) as conn:
-            for img_id in ids:
-                update_annotation(conn, img_id, toml_path, object_type="Image")
-
-
-def start_toml_observer(path, transfer=None, dry_run=False, import_db=None):
+        annotated = auto_annotate(
+            self.connections.root(), import_table, sessions=self.connections
+        )
+
+        self.store.add_annotated(
+            annotated.to_dict(orient="records"), base_dir.resolve()
+        )
+
+    def update_imported(self, ids, toml_path, card=None):
+        """Updates the annotations of the images with the card at toml_path
+
+        Only the differences with the card previously applied are sent to the
+        server (see :func:`impomero.annotation_job.update_dataset_annotations`)
+        """
+        if card is None:
+            card = load_card(toml_path)
+        old_card = self.store.card_state(Path(toml_path).parent.resolve())
+        with self.connections.session(card["user"]) as user_conn:
+            update_dataset_annotations(user_conn, ids, card, old_card=old_card)
+
+
+def _failed(import_table):
+    """Returns the set of the paths of the files that failed to import"""
+    if "import_status" not in import_table:
+        return set()
+    return set(import_table.loc[import_table["import_status"] == "failed", "file_path"])
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return float("inf")
+
+
+def start_toml_observer(
+    path,
+    transfer=None,
+    dry_run=False,
+    import_db=None,
+    interval=DEFAULT_INTERVAL,
+    quiet_period=DEFAULT_QUIET_PERIOD,
+    import_workers=1,
+    journal_mode=DEFAULT_JOURNAL_MODE,
+    stream=False,
+    dedup=None,
+    max_jobs=1,
+    lease=DEFAULT_LEASE,
+):
+    """Monitors the directory trees at path, until interrupted
+
+    path is a directory or a list of directories (or of
+    :class:`impomero.roots.WatchedRoot` with their own polling interval).
+    Each root is polled by its own observer, while the jobs, the server
+    connections and the import DB are shared.
+
+    Several monitors, e.g. on several hosts, can share the import DB and
+    split the work: each job is leased to one of them for lease seconds
+    at a time (see :mod:`impomero.jobs`).
+
+    The first SIGINT or SIGTERM stops the monitor once the jobs in flight
+    are done, a second one stops it right away, and the interrupted jobs
+    are resumed on the next start.
+    """
     toml_handler = TomlCreatedEventHandler(
-        transfer=transfer, dry_run=dry_run, import_db=import_db
+        transfer=transfer,
+        dry_run=dry_run,
+        import_db=import_db,
+        quiet_period=quiet_period,
+        import_workers=import_workers,
+        journal_mode=journal_mode,
+        stream=stream,
+        dedup=dedup,
+        max_jobs=max_jobs,
+        lease=lease,
     )
 
-    # We use the polling observer as inotify
+    # We use a polling observer as inotify
     # does not see remote file creation events
-    observer = Observer()
-    observer.schedule(toml_handler, path, recursive=True)
-    print("Starting observer")
-    observer.start()
-    print("Observer started")
+    observers = []
+    for root in watched_roots(path, interval):
+        observer = DirectoryPollingObserver(timeout=root.interval, dir_events=True)
+        observer.schedule(toml_handler, root.path, recursive=True)
+        observers.append(observer)
+    print("Starting observers")
+    toml_handler.coalescer.start()
+    toml_handler.connections.start()
+    for observer in observers:
+        observer.start()
+    print(f"Watching {len(observers)} directories")
     try:
-        while True:
-            time.sleep(1)
+        # resume the jobs interrupted by a previous crash, the jobs of
+        # other hosts are claimed again once their lease expired
+        released = toml_handler.jobs.release_orphans()
+        if released:
+            log.info("Resuming %d interrupted jobs", released)
+        asyncio.run(
+            toml_handler.dispatcher.run(signals=(signal.SIGINT, signal.SIGTERM))
+        )
     finally:
-        observer.stop()
-        observer.join()
+        for observer in observers:
+            observer.stop()
+        for observer in observers:
+            observer.join()
+        # the pending card events are only queued, to be run on the next start
+        toml_handler.coalescer.stop(flush=True)
+        log.info("Card events: %s", toml_handler.coalescer.stats())
+        toml_handler.importer.close()
+        toml_handler.connections.close()
+        toml_handler.store.close()
@@ -0,0 +1,232 @@
+"""Polling observer for large watched trees
+
+watchdog's `PollingObserver` stats every file of the watched tree at each
+poll, which does not scale to shares holding millions of image files.
+The :class:`DirectoryPollingObserver` only keeps track of the directories
+and of the toml files they contain. At each poll, the directories are
+stat'ed and only those whose modification time changed are listed again,
+so the cost of a poll grows with the amount of change rather than with
+the number of files.
+
+Note that a file modified in place does not change its directory
+modification time, this is why the (few) toml files are stat'ed as well.
+
+With `dir_events=True`, a modification event is also emitted for each
+directory whose content changed, e.g. when new image files are added.
+"""
+import functools
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from watchdog.events import (
+    DirModifiedEvent,
+    FileCreatedEvent,
+    FileDeletedEvent,
+    FileModifiedEvent,
+)
+from watchdog.observers.api import DEFAULT_EMITTER_TIMEOUT, BaseObserver, EventEmitter
+
+from .walker import DEFAULT_IGNORE, DEFAULT_WORKERS, scan_dir
+
+log = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 5.0
+
+
+class _DirState:
+    """What we remember about a directory"""
+
+    __slots__ = ("mtime", "tomls", "sub_dirs")
+
+    def __init__(self, mtime, tomls, sub_dirs):
+        self.mtime = mtime
+        # toml file name -> (mtime, size)
+        self.tomls = tomls
+        self.sub_dirs = sub_dirs
+
+
+def _stat_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class DirectoryPollingEmitter(EventEmitter):
+    """Emits the creation, modification and deletion events of toml files
+    by polling the directories modification times
+
+    See :class:`DirectoryPollingObserver`
+    """
+
+    def __init__(
+        self,
+        event_queue,
+        watch,
+        timeout=DEFAULT_EMITTER_TIMEOUT,
+        ignore=DEFAULT_IGNORE,
+        max_workers=DEFAULT_WORKERS,
+        dir_events=False,
+        **kwargs,
+    ):
+        super().__init__(event_queue, watch, timeout=timeout, **kwargs)
+        self.ignore = ignore
+        self.max_workers = max_workers
+        self.dir_events = dir_events
+        self._dirs = {}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def n_directories(self):
+        """Number of directories in the snapshot"""
+        return len(self._dirs)
+
+    def on_thread_start(self):
+        self.snapshot()
+
+    def on_thread_stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def queue_events(self, timeout):
+        # timeout behaves like an interval for polling emitters.
+        if self.stopped_event.wait(timeout):
+            return
+        with self._lock:
+            if not self.should_keep_running():
+                return
+            for event in self.poll():
+                self.queue_event(event)
+
+    def snapshot(self):
+        """Takes the initial snapshot of the watched tree, no event is emitted"""
+        self._dirs = {}
+        self._add_tree(os.fspath(self.watch.path), [], emit=False)
+        log.info("Watching %d directories under %s", len(self._dirs), self.watch.path)
+
+    def poll(self):
+        """Compares the watched tree with the last snapshot
+
+        Returns
+        -------
+        events : list of file system events
+        """
+        events = []
+        # tomls modified in place
+        for dir_path, state in list(self._dirs.items()):
+            for name, signature in state.tomls.items():
+                path = os.path.join(dir_path, name)
+                new_signature = _stat_signature(path)
+                if new_signature is not None and new_signature != signature:
+                    state.tomls[name] = new_signature
+                    events.append(FileModifiedEvent(path))
+
+        # directories with new or removed entries
+        dir_paths = list(self._dirs)
+        mtimes = self._map(_stat_signature, dir_paths)
+        changed = [
+            dir_path
+            for dir_path, mtime in zip(dir_paths, mtimes)
+            if mtime is None or mtime[0] != self._dirs[dir_path].mtime
+        ]
+        # parents first, so removed sub-trees are only handled once
+        changed.sort(key=lambda p: p.count(os.sep))
+        for dir_path in changed:
+            if dir_path in self._dirs:
+                self._update_dir(dir_path, events)
+                if self.dir_events and dir_path in self._dirs:
+                    events.append(DirModifiedEvent(dir_path))
+        return events
+
+    def _map(self, fun, items):
+        if self.max_workers <= 1 or len(items) < 2 * self.max_workers:
+            return [fun(item) for item in items]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="impomero-poll"
+            )
+        return list(self._executor.map(fun, items, chunksize=64))
+
+    def _list(self, dir_path):
+        """stat then list dir_path, returns None if it does not exist anymore"""
+        signature = _stat_signature(dir_path)
+        if signature is None:
+            return None
+        listing = scan_dir(dir_path, ignore=self.ignore)
+        tomls = {}
+        for card in listing.cards:
+            card_signature = _stat_signature(card)
+            if card_signature is not None:
+                tomls[card.name] = card_signature
+        sub_dirs = {sub_dir.name for sub_dir in listing.sub_dirs}
+        if not self.watch.is_recursive:
+            sub_dirs = set()
+        return _DirState(signature[0], tomls, sub_dirs)
+
+    def _add_tree(self, dir_path, events, emit=True):
+        to_add = [dir_path]
+        while to_add:
+            dir_path = to_add.pop()
+            state = self._list(dir_path)
+            if state is None:
+                continue
+            self._dirs[dir_path] = state
+            if emit:
+                events.extend(
+                    FileCreatedEvent(os.path.join(dir_path, name))
+                    for name in state.tomls
+                )
+            to_add.extend(os.path.join(dir_path, name) for name in state.sub_dirs)
+
+    def _remove_tree(self, dir_path, events):
+        to_remove = [dir_path]
+        while to_remove:
+            dir_path = to_remove.pop()
+            state = self._dirs.pop(dir_path, None)
+            if state is None:
+                continue
+            events.extend(
+                FileDeletedEvent(os.path.join(dir_path, name)) for name in state.tomls
+            )
+            to_remove.extend(os.path.join(dir_path, name) for name in state.sub_dirs)
+
+    def _update_dir(self, dir_path, events):
+        old = self._dirs[dir_path]
+        new = self._list(dir_path)
+        if new is None:
+            self._remove_tree(dir_path, events)
+            return
+
+        for name, signature in new.tomls.items():
+            path = os.path.join(dir_path, name)
+            if name not in old.tomls:
+                events.append(FileCreatedEvent(path))
+            elif old.tomls[name] != signature:
+                events.append(FileModifiedEvent(path))
+        events.extend(
+            FileDeletedEvent(os.path.join(dir_path, name))
+            for name in old.tomls.keys() - new.tomls.keys()
+        )
+        self._dirs[dir_path] = new
+        for name in old.sub_dirs - new.sub_dirs:
+            self._remove_tree(os.path.join(dir_path, name), events)
+        for name in new.sub_dirs - old.sub_dirs:
+            self._add_tree(os.path.join(dir_path, name), events)
+
+
+class DirectoryPollingObserver(BaseObserver):
+    """Observer polling the directories modification times every
+    `timeout` seconds
+
+    Only toml files are reported, and the modified directories if
+    dir_events is True, see :class:`DirectoryPollingEmitter`
+    """
+
+    def __init__(self, timeout=DEFAULT_INTERVAL, dir_events=False):
+        emitter = functools.partial(DirectoryPollingEmitter, dir_events=dir_events)
+        super().__init__(emitter, timeout=timeout)
@@ -0,0 +1,92 @@
+"""Directory trees watched by the monitor
+
+A single monitor can watch several roots (e.g. one share per instrument),
+each polled at its own interval, while the job dispatcher, the server
+connections and the import DB are shared. The roots are given on the
+command line, or in a toml file::
+
+    # default polling interval, in seconds
+    interval = 5.0
+
+    [[roots]]
+    path = "/mnt/confocal"
+
+    [[roots]]
+    path = "/mnt/lightsheet"
+    interval = 60.0
+
+"""
+import logging
+import os
+from typing import NamedTuple
+
+import toml
+
+from .observer import DEFAULT_INTERVAL
+
+log = logging.getLogger(__name__)
+
+
+class WatchedRoot(NamedTuple):
+    path: str
+    interval: float = DEFAULT_INTERVAL
+
+
+def load_roots(config_path, interval=DEFAULT_INTERVAL):
+    """Reads the roots from the toml file at config_path
+
+    interval is the polling interval of the roots that do not set one,
+    unless the file sets another default
+
+    Returns
+    -------
+    roots : list of :class:`WatchedRoot`
+    """
+    config = toml.load(config_path)
+    interval = config.get("interval", interval)
+    roots = []
+    for root in config.get("roots", []):
+        if "path" not in root:
+            raise ValueError(f"A root of {config_path} has no path")
+        roots.append(WatchedRoot(root["path"], root.get("interval", interval)))
+    return roots
+
+
+def watched_roots(paths, interval=DEFAULT_INTERVAL):
+    """Normalizes the roots to watch
+
+    Parameters
+    ----------
+    paths : str, :class:`WatchedRoot` or a list of those
+        paths are polled every interval seconds
+    interval : float
+
+    Returns
+    -------
+    roots : list of :class:`WatchedRoot`
+        with resolved paths, without the roots inside another root
+        (they are already watched)
+    """
+    if isinstance(paths, (str, os.PathLike, WatchedRoot)):
+        paths = [paths]
+    roots = {}
+    for root in paths:
+        if not isinstance(root, WatchedRoot):
+            root = WatchedRoot(root, interval)
+        path = os.path.realpath(root.path)
+        if not os.path.isdir(path):
+            raise ValueError(f"{root.path} is not a directory")
+        roots[path] = root._replace(path=path)
+
+    watched = []
+    for path in sorted(roots):
+        parent = next((w for w in watched if _is_below(path, w.path)), None)
+        if parent is not None:
+            log.warning("%s is already watched as part of %s", path, parent.path)
+            continue
+        watched.append(roots[path])
+    return watched
+
+
+def _is_below(path, root):
+    return os.path.commonpath([path, root]) == root
@@ -0,0 +1,123 @@
+"""Resolution of tag names to omero TagAnnotation ids
+
+Looking up each tag of each image is a server round-trip per
+(image, tag) pair. The :class:`TagResolver` looks up all the tags it is
+asked for in a single query, creates the missing ones in a single save,
+and remembers the ids per group until explicitly invalidated.
+"""
+import logging
+import threading
+
+from omero.model import TagAnnotationI
+from omero.rtypes import rlist, rlong, rstring, unwrap
+from omero.sys import ParametersI
+
+from . import tracing
+
+log = logging.getLogger(__name__)
+
+TAGS_BY_VALUE = (
+    "select t.id, t.textValue from TagAnnotation t "
+    "where t.textValue in (:values) and t.details.group.id = :gid "
+    "order by t.id"
+)
+
+
+def _group_id(conn):
+    return conn.getEventContext().groupId
+
+
+class TagResolver:
+    """Caches tag name -> TagAnnotation id, per omero group
+
+    Attributes
+    ----------
+    queries : int
+        number of lookup queries sent to the server
+    created : int
+        number of tags created
+    """
+
+    def __init__(self):
+        # group id -> {tag: tag_id}
+        self._ids = {}
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.created = 0
+
+    def resolve(self, conn, tags, create=True):
+        """Returns a {tag: tag_id} dictionnary for the tags in the
+        connection's current group, creating the missing ones
+
+        Parameters
+        ----------
+        conn : :class:`omero.gateway.BlitzGateway`
+        tags : iterable of str
+        create : bool, default True
+            if False, the missing tags are not created
+            and absent from the returned dictionnary
+        """
+        tags = list(dict.fromkeys(tags))
+        group_id = _group_id(conn)
+        with self._lock:
+            cache = self._ids.setdefault(group_id, {})
+            missing = [tag for tag in tags if tag not in cache]
+            if missing:
+                found = self._query(conn, group_id, missing)
+                cache.update(found)
+                to_create = [tag for tag in missing if tag not in found]
+                if to_create and create:
+                    cache.update(self._create(conn, group_id, to_create))
+            return {tag: cache[tag] for tag in tags if tag in cache}
+
+    def invalidate(self, group_id=None):
+        """Forgets the cached ids of group_id, or of all groups if None"""
+        with self._lock:
+            if group_id is None:
+                self._ids.clear()
+            else:
+                self._ids.pop(group_id, None)
+
+    def _query(self, conn, group_id, tags):
+        """Returns the oldest tag id for each of the tags found"""
+        params = ParametersI()
+        params.add("values", rlist([rstring(tag) for tag in tags]))
+        params.add("gid", rlong(group_id))
+        self.queries += 1
+        tracing.count(server_calls=1)
+        rows = conn.getQueryService().projection(
+            TAGS_BY_VALUE, params, conn.SERVICE_OPTS
+        )
+        found = {}
+        for tag_id, tag in unwrap(rows):
+            found.setdefault(tag, tag_id)
+        return found
+
+    def _create(self, conn, group_id, tags):
+        log.info("Creating tags: %s", ", ".join(tags))
+        new_tags = []
+        for tag in tags:
+            tag_ann = TagAnnotationI()
+            tag_ann.setTextValue(rstring(tag))
+            new_tags.append(tag_ann)
+        tracing.count(server_calls=1)
+        saved = conn.getUpdateService().saveAndReturnArray(new_tags, conn.SERVICE_OPTS)
+        self.created += len(saved)
+        created = {
+            tag_ann.getTextValue().getValue(): tag_ann.getId().getValue()
+            for tag_ann in saved
+        }
+
+        # An other worker may have created the same tags in the meantime,
+        # everybody settles on the oldest one and we drop ours
+        canonical = self._query(conn, group_id, tags)
+        duplicates = [
+            created[tag]
+            for tag in tags
+            if canonical.get(tag, created[tag]) != created[tag]
+        ]
+        if duplicates:
+            log.info("Removing %d duplicated tags", len(duplicates))
+            tracing.count(server_calls=1)
+            conn.deleteObjects("Annotation", duplicates, wait=True)
+        return {tag: canonical.get(tag, created[tag]) for tag in tags}
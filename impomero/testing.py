@@ -0,0 +1,592 @@
+"""In-memory stand-in for an OMERO server, for tests and benchmarks
+
+:class:`FakeServer` holds projects, datasets, images and annotations in
+memory, and :class:`FakeGateway` implements the subset of
+:class:`omero.gateway.BlitzGateway` used by impomero on top of it: object
+wrappers (`getObject(s)`, `listChildren`, `listAnnotations`,
+`linkAnnotation`), `suConn`, `deleteObjects`, and the query and update
+services.
+
+The queries are not parsed: each HQL query sent by impomero is answered by
+a handler registered under that exact string in :attr:`FakeServer.handlers`
+(a new query raises `NotImplementedError` until a handler is added). Every
+call that would be a server round-trip is counted in
+:attr:`FakeServer.calls` and can be delayed by a configurable latency, so
+the number of round-trips of the annotation code can be checked, and its
+throughput measured, without a server.
+
+Permissions are not modelled, apart from the owner and group filters of
+the queries.
+
+Example
+-------
+
+..code:
+
+    server = FakeServer(latency=0.001)
+    dataset_id = server.add_dataset("dset", project="proj", owner="john")
+    image_ids = [server.add_image(f"img{i}", dataset_id) for i in range(10)]
+    conn = FakeGateway(server)
+    annotate_dataset(conn.suConn("john"), image_ids, card)
+    print(server.calls, server.round_trips)
+
+"""
+import collections
+import itertools
+import logging
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+import omero.model
+from omero.gateway import AnnotationWrapper, BlitzObjectWrapper, ServiceOptsDict
+from omero.rtypes import rlong, unwrap, wrap
+
+from . import annotation_job, lookup, tags
+
+log = logging.getLogger(__name__)
+
+# model class name suffixes and the kinds of objects they are stored as
+_LINK_KINDS = {
+    "AnnotationLinkI": "annotation_links",
+    "DatasetImageLinkI": "dataset_links",
+    "ProjectDatasetLinkI": "project_links",
+}
+
+
+def _kind(obj):
+    """Returns the kind of a model object, e.g. "Image" or "Annotation" """
+    name = type(obj).__name__
+    if name.endswith("AnnotationI"):
+        return "Annotation"
+    return name[:-1] if name.endswith("I") else name
+
+
+def _id(obj):
+    return unwrap(obj.getId())
+
+
+class FakeServer:
+    """In-memory OMERO database shared by :class:`FakeGateway` connections
+
+    Parameters
+    ----------
+    latency : float or dict, default 0
+        seconds waited at each round-trip, or {call name: seconds}
+        (missing calls don't wait)
+
+    Attributes
+    ----------
+    calls : collections.Counter
+        number of calls of each kind, e.g. "projection" or "saveArray"
+    handlers : dict
+        {HQL query: handler(server, ctx, params)}, a handler returns the
+        rows of a projection or the objects of a findAllByQuery call
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.handlers = dict(HANDLERS)
+        self.users = {"root": 0}
+        self.groups = {"system": 0}
+        # (kind, id) -> model object, and its (owner id, group id)
+        self.objects = {}
+        self.details = {}
+        # link id -> (parent kind, parent id, annotation id)
+        self.annotation_links = {}
+        # link id -> (dataset id, image id)
+        self.dataset_links = {}
+        # link id -> (project id, dataset id)
+        self.project_links = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+
+    @property
+    def round_trips(self):
+        """Total number of calls to the server"""
+        return sum(self.calls.values())
+
+    def reset_counts(self):
+        self.calls.clear()
+
+    def call(self, name):
+        """Counts a round-trip and waits for the latency"""
+        with self._lock:
+            self.calls[name] += 1
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(name, 0.0)
+        if latency:
+            time.sleep(latency)
+
+    def user_id(self, username):
+        with self._lock:
+            return self.users.setdefault(username, len(self.users))
+
+    def group_id(self, group):
+        with self._lock:
+            return self.groups.setdefault(group, len(self.groups))
+
+    def context(self, username="root", group=None):
+        """Returns the event context of username in group, by default
+        the user's own group
+        """
+        if group is None:
+            group = "system" if username == "root" else f"{username}_group"
+        return SimpleNamespace(
+            userId=self.user_id(username),
+            userName=username,
+            groupId=self.group_id(group),
+            groupName=group,
+        )
+
+    def add_project(self, name, owner="root", group=None):
+        """Creates a project, returns its id"""
+        project = omero.model.ProjectI()
+        project.setName(wrap(name))
+        return _id(self.save(project, self.context(owner, group)))
+
+    def add_dataset(self, name, project=None, owner="root", group=None):
+        """Creates a dataset in the project with that name (created if
+        needed), returns its id
+        """
+        ctx = self.context(owner, group)
+        dataset = omero.model.DatasetI()
+        dataset.setName(wrap(name))
+        dataset_id = _id(self.save(dataset, ctx))
+        if project is not None:
+            project_ids = self.find(
+                "Project", name=project, owner=ctx.userId, group=ctx.groupId
+            )
+            project_id = (
+                project_ids[-1]
+                if project_ids
+                else self.add_project(project, owner, group)
+            )
+            link = omero.model.ProjectDatasetLinkI()
+            link.setParent(omero.model.ProjectI(project_id, False))
+            link.setChild(omero.model.DatasetI(dataset_id, False))
+            self.save(link, ctx)
+        return dataset_id
+
+    def add_image(self, name, dataset_id=None, owner=None):
+        """Creates an image in the dataset, with the dataset's owner
+        by default, returns its id
+        """
+        if owner is None and dataset_id is not None:
+            uid, gid = self.details[("Dataset", dataset_id)]
+            ctx = SimpleNamespace(userId=uid, groupId=gid)
+        else:
+            ctx = self.context(owner or "root")
+        image = omero.model.ImageI()
+        image.setName(wrap(name))
+        image_id = _id(self.save(image, ctx))
+        if dataset_id is not None:
+            link = omero.model.DatasetImageLinkI()
+            link.setParent(omero.model.DatasetI(dataset_id, False))
+            link.setChild(omero.model.ImageI(image_id, False))
+            self.save(link, ctx)
+        return image_id
+
+    def find(self, kind, owner=None, group=None, **attributes):
+        """Returns the sorted ids of the objects of that kind, e.g. "Dataset"
+        or "TagAnnotation", with the given owner id, group id and attributes
+        """
+        with self._lock:
+            return sorted(
+                obj_id
+                for key, obj in self.objects.items()
+                for obj_id in [key[1]]
+                if type(obj).__name__ == f"{kind}I"
+                and (owner is None or self.details[key][0] == owner)
+                and (group is None or self.details[key][1] == group)
+                and all(
+                    unwrap(getattr(obj, f"get{attr[0].upper()}{attr[1:]}")()) == value
+                    for attr, value in attributes.items()
+                )
+            )
+
+    def annotations(self, kind, obj_id):
+        """Returns the (link id, annotation) pairs of an object"""
+        with self._lock:
+            return [
+                (link_id, self.objects[("Annotation", ann_id)])
+                for link_id, (parent_kind, parent_id, ann_id) in sorted(
+                    self.annotation_links.items()
+                )
+                if (parent_kind, parent_id) == (kind, obj_id)
+            ]
+
+    def children(self, kind, obj_id):
+        """Returns the ids of the datasets of a project or the images
+        of a dataset
+        """
+        links = {"Project": self.project_links, "Dataset": self.dataset_links}[kind]
+        with self._lock:
+            return sorted(child for parent, child in links.values() if parent == obj_id)
+
+    def save(self, obj, ctx):
+        """Stores a model object and the unsaved objects it refers to,
+        returns it with its id set
+        """
+        with self._lock:
+            for suffix, table in _LINK_KINDS.items():
+                if type(obj).__name__.endswith(suffix):
+                    return self._save_link(obj, ctx, suffix, getattr(self, table))
+            if obj.getId() is None:
+                obj.setId(rlong(next(self._ids)))
+                self.details[(_kind(obj), _id(obj))] = (ctx.userId, ctx.groupId)
+            if obj.isLoaded():
+                self.objects[(_kind(obj), _id(obj))] = obj
+            return obj
+
+    def _save_link(self, link, ctx, suffix, table):
+        parent = link.getParent()
+        child = link.getChild()
+        for linked in (parent, child):
+            if linked.getId() is None:
+                self.save(linked, ctx)
+        if link.getId() is None:
+            link.setId(rlong(next(self._ids)))
+        if suffix == "AnnotationLinkI":
+            table[_id(link)] = (_kind(parent), _id(parent), _id(child))
+        elif (_id(parent), _id(child)) not in table.values():
+            table[_id(link)] = (_id(parent), _id(child))
+        return link
+
+    def delete(self, graph_spec, obj_ids):
+        """Deletes the objects, the links to the deleted objects go with them"""
+        with self._lock:
+            if graph_spec.endswith("Link"):
+                for table in _LINK_KINDS.values():
+                    for link_id in obj_ids:
+                        getattr(self, table).pop(link_id, None)
+                return
+            for obj_id in obj_ids:
+                self.objects.pop((graph_spec, obj_id), None)
+                self.details.pop((graph_spec, obj_id), None)
+            deleted = set(obj_ids)
+            for link_id, link in list(self.annotation_links.items()):
+                if link[2] in deleted or (link[0] == graph_spec and link[1] in deleted):
+                    del self.annotation_links[link_id]
+            for table in (self.dataset_links, self.project_links):
+                for link_id, link in list(table.items()):
+                    if deleted.intersection(link):
+                        del table[link_id]
+
+
+class FakeGateway:
+    """Connection of a user to a :class:`FakeServer`
+
+    Parameters
+    ----------
+    server : :class:`FakeServer`, optional
+        by default a new, empty, server
+    username : str, default "root"
+    group : str, optional
+        the group name, by default the user's own group
+
+    Other keyword arguments, e.g. the ones of
+    :class:`omero.gateway.BlitzGateway`, are ignored
+    """
+
+    def __init__(self, server=None, username="root", group=None, **kwargs):
+        self.server = server if server is not None else FakeServer()
+        self.username = username
+        self._ctx = self.server.context(username, group)
+        self.SERVICE_OPTS = ServiceOptsDict()
+        session_key = str(uuid.uuid4())
+        self.c = SimpleNamespace(getSessionId=lambda: session_key)
+        self._connected = True
+        self._query = _FakeQueryService(self)
+        self._update = _FakeUpdateService(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def connect(self):
+        self._connected = True
+        return True
+
+    def isConnected(self):
+        return self._connected
+
+    def close(self, hard=True):
+        self._connected = False
+
+    def keepAlive(self):
+        self.server.call("keepAlive")
+        return self._connected
+
+    def getEventContext(self):
+        # cached by the client, as in BlitzGateway
+        return self._ctx
+
+    def suConn(self, username, group=None, ttl=60000):
+        self.server.call("suConn")
+        return FakeGateway(self.server, username, group)
+
+    def getQueryService(self):
+        return self._query
+
+    def getUpdateService(self):
+        return self._update
+
+    def getObject(self, obj_type, oid=None, params=None, attributes=None, opts=None):
+        """Returns the wrapper of an object by id or attributes, or None"""
+        self.server.call("getObject")
+        found = self._find(obj_type, [oid] if oid is not None else None, attributes)
+        return found[0] if found else None
+
+    def getObjects(self, obj_type, ids=None, params=None, attributes=None, opts=None):
+        """Returns the wrappers of the objects by ids or attributes"""
+        self.server.call("getObjects")
+        return iter(self._find(obj_type, ids, attributes))
+
+    def deleteObjects(self, graph_spec, obj_ids, wait=False, **kwargs):
+        self.server.call("deleteObjects")
+        self.server.delete(graph_spec, list(obj_ids))
+
+    def _find(self, obj_type, ids, attributes):
+        found = self.server.find(obj_type, **(attributes or {}))
+        if ids is not None:
+            ids = set(ids)
+            found = [obj_id for obj_id in found if obj_id in ids]
+        if obj_type.endswith("Annotation"):
+            return [
+                AnnotationWrapper._wrap(self, self.server.objects[("Annotation", i)])
+                for i in found
+            ]
+        return [FakeObjectWrapper(self, obj_type, obj_id) for obj_id in found]
+
+
+class FakeObjectWrapper:
+    """Wrapper of a project, dataset or image of a :class:`FakeServer`"""
+
+    def __init__(self, conn, obj_type, obj_id):
+        self._conn = conn
+        self.OMERO_CLASS = obj_type
+        self._obj = conn.server.objects[(obj_type, obj_id)]
+
+    def __repr__(self):
+        return f"<{self.OMERO_CLASS} {self.getId()}: {self.getName()}>"
+
+    def getId(self):
+        return _id(self._obj)
+
+    @property
+    def id(self):
+        return self.getId()
+
+    def getName(self):
+        return unwrap(self._obj.getName())
+
+    @property
+    def name(self):
+        return self.getName()
+
+    def listChildren(self):
+        self._conn.server.call("listChildren")
+        kind = {"Project": "Dataset", "Dataset": "Image"}[self.OMERO_CLASS]
+        return iter(
+            FakeObjectWrapper(self._conn, kind, child_id)
+            for child_id in self._conn.server.children(self.OMERO_CLASS, self.id)
+        )
+
+    def listAnnotations(self, ns=None):
+        self._conn.server.call("listAnnotations")
+        link_class = getattr(omero.model, f"{self.OMERO_CLASS}AnnotationLinkI")
+        for link_id, ann in self._conn.server.annotations(self.OMERO_CLASS, self.id):
+            if ns is not None and unwrap(ann.getNs()) != ns:
+                continue
+            link = BlitzObjectWrapper(self._conn, link_class(link_id, False))
+            yield AnnotationWrapper._wrap(self._conn, ann, link=link)
+
+    def linkAnnotation(self, ann, sameOwner=False):
+        """Links an annotation wrapper to the object, saving it first if needed"""
+        if ann.getId() is None:
+            ann.save()
+        link = getattr(omero.model, f"{self.OMERO_CLASS}AnnotationLinkI")()
+        link.setParent(self._obj.__class__(self.id, False))
+        link.setChild(ann._obj.__class__(ann.getId(), False))
+        self._conn.getUpdateService().saveObject(link, self._conn.SERVICE_OPTS)
+        return ann
+
+
+class _FakeQueryService:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def projection(self, query, params, ctx=None):
+        self._conn.server.call("projection")
+        rows = self._handle(query, params)
+        return [[wrap(value) for value in row] for row in rows]
+
+    def findAllByQuery(self, query, params, ctx=None):
+        self._conn.server.call("findAllByQuery")
+        return list(self._handle(query, params))
+
+    def _handle(self, query, params):
+        server = self._conn.server
+        if query not in server.handlers:
+            raise NotImplementedError(f"The fake server can't answer {query!r}")
+        with server._lock:
+            rows = server.handlers[query](server, self._conn._ctx, unwrap(params.map))
+        return _page(params, rows)
+
+
+def _page(params, rows):
+    flt = getattr(params, "theFilter", None)
+    limit = unwrap(getattr(flt, "limit", None))
+    if limit is None:
+        return rows
+    offset = unwrap(getattr(flt, "offset", None)) or 0
+    return rows[offset : offset + limit]
+
+
+class _FakeUpdateService:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def saveObject(self, obj, ctx=None):
+        self._conn.server.call("saveObject")
+        self._conn.server.save(obj, self._conn._ctx)
+
+    def saveAndReturnObject(self, obj, ctx=None):
+        self._conn.server.call("saveAndReturnObject")
+        return self._conn.server.save(obj, self._conn._ctx)
+
+    def saveArray(self, objs, ctx=None):
+        self._conn.server.call("saveArray")
+        for obj in objs:
+            self._conn.server.save(obj, self._conn._ctx)
+
+    def saveAndReturnArray(self, objs, ctx=None):
+        self._conn.server.call("saveAndReturnArray")
+        return [self._conn.server.save(obj, self._conn._ctx) for obj in objs]
+
+
+# Query handlers, by the queries of the impomero modules
+
+
+def _image_links(server, image_ids, ann_ids=None):
+    image_ids = set(image_ids)
+    return [
+        (link_id, image_id, ann_id)
+        for link_id, (kind, image_id, ann_id) in sorted(server.annotation_links.items())
+        if kind == "Image"
+        and image_id in image_ids
+        and (ann_ids is None or ann_id in ann_ids)
+    ]
+
+
+def _annotation(server, ann_id):
+    return server.objects[("Annotation", ann_id)]
+
+
+def _tags_by_value(server, ctx, params):
+    return [
+        (ann_id, unwrap(ann.getTextValue()))
+        for (kind, ann_id), ann in sorted(server.objects.items())
+        if type(ann).__name__ == "TagAnnotationI"
+        and unwrap(ann.getTextValue()) in params["values"]
+        and server.details[(kind, ann_id)][1] == params["gid"]
+    ]
+
+
+def _existing_links(server, ctx, params):
+    return [
+        (image_id, ann_id)
+        for _, image_id, ann_id in _image_links(server, params["iids"], params["aids"])
+    ]
+
+
+def _existing_link_ids(server, ctx, params):
+    return [
+        (link_id,)
+        for link_id, _, _ in _image_links(server, params["iids"], params["aids"])
+    ]
+
+
+def _all_links(server, ctx, params):
+    return [(link_id,) for link_id, _, _ in _image_links(server, params["iids"])]
+
+
+def _comment_link_ids(server, ctx, params):
+    return [
+        (link_id,)
+        for link_id, _, ann_id in _image_links(server, params["iids"])
+        if type(_annotation(server, ann_id)).__name__ == "CommentAnnotationI"
+        and unwrap(_annotation(server, ann_id).getTextValue()) == params["text"]
+    ]
+
+
+def _linked_maps(server, ctx, params):
+    maps = {}
+    for _, _, ann_id in _image_links(server, params["iids"]):
+        ann = _annotation(server, ann_id)
+        if (
+            type(ann).__name__ == "MapAnnotationI"
+            and unwrap(ann.getNs()) == params["ns"]
+        ):
+            maps[ann_id] = ann
+    return list(maps.values())
+
+
+def _dataset_links(server, ctx, params):
+    image_ids = set(params["iids"])
+    return [
+        (image_id,)
+        for dataset_id, image_id in server.dataset_links.values()
+        if dataset_id == params["did"] and image_id in image_ids
+    ]
+
+
+def _named(server, kind, names, params):
+    return [
+        obj_id
+        for obj_id in server.find(kind, owner=params["uid"], group=params["gid"])
+        if unwrap(server.objects[(kind, obj_id)].getName()) in names
+    ]
+
+
+def _dataset_ids(server, ctx, params):
+    projects = set(_named(server, "Project", params["pnames"], params))
+    datasets = set(_named(server, "Dataset", params["dnames"], params))
+    return [
+        (dataset_id,)
+        for dataset_id in sorted(
+            {d for p, d in server.project_links.values() if p in projects} & datasets,
+            reverse=True,
+        )
+    ]
+
+
+def _project_ids(server, ctx, params):
+    return [
+        (project_id,)
+        for project_id in reversed(_named(server, "Project", params["pnames"], params))
+    ]
+
+
+def _image_ids(server, ctx, params):
+    return [(image_id,) for image_id in server.children("Dataset", params["did"])]
+
+
+HANDLERS = {
+    tags.TAGS_BY_VALUE: _tags_by_value,
+    annotation_job.EXISTING_LINKS: _existing_links,
+    annotation_job.EXISTING_LINK_IDS: _existing_link_ids,
+    annotation_job.ALL_LINKS: _all_links,
+    annotation_job.COMMENT_LINK_IDS: _comment_link_ids,
+    annotation_job.LINKED_MAPS: _linked_maps,
+    annotation_job.DATASET_LINKS: _dataset_links,
+    lookup.DATASET_IDS: _dataset_ids,
+    lookup.PROJECT_IDS: _project_ids,
+    lookup.IMAGE_IDS: _image_ids,
+}
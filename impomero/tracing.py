@@ -0,0 +1,160 @@
+"""Timing of the pipeline stages
+
+Each stage of the pipeline (scan, match, parse_pair, import_batch,
+dataset_lookup, annotate_dataset...) runs in a :func:`span`, which
+records its duration and some counts (files, bytes, images...). Spans
+opened while another span is open are its children, and the server
+round-trips counted with :func:`count` are added to the current span and
+all its parents.
+
+Closed spans are written as JSON lines by the "impomero.trace" logger,
+see :func:`configure_tracing`::
+
+    {"span": "annotate_dataset", "id": "9f0c...", "parent": "51a2...",
+     "trace": "77d1...", "start": 1619425130.25, "duration": 0.82,
+     "status": "ok", "thread": "MainThread", "pid": 4242,
+     "dataset": "raw-dir0", "images": 120, "server_calls": 6}
+
+so they can be loaded with e.g. `pandas.read_json(path, lines=True)` and
+aggregated by span name. When no handler is configured, nothing is written.
+"""
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+trace_log = logging.getLogger("impomero.trace")
+# the spans are only written where configure_tracing says
+trace_log.propagate = False
+
+_current = contextvars.ContextVar("impomero_span", default=None)
+# counts may be added to a parent span from several threads
+_counts_lock = threading.Lock()
+
+
+class Span:
+    """A timed stage of the pipeline
+
+    Attributes
+    ----------
+    name : str
+    attributes : dict
+        values describing the stage, e.g. the number of files
+    counts : dict
+        counters incremented with :func:`count`, by this span or its children
+    """
+
+    def __init__(self, name, parent=None, **attributes):
+        self.name = name
+        self.id = uuid.uuid4().hex[:16]
+        self.parent = parent
+        self.trace = parent.trace if parent is not None else self.id
+        self.attributes = attributes
+        self.counts = {}
+        self.start = time.time()
+        self.duration = None
+        self.status = "ok"
+
+    def set(self, **attributes):
+        """Adds or updates attributes of the span"""
+        self.attributes.update(attributes)
+
+    def add(self, **counts):
+        """Increments the counters of this span and of its parents"""
+        span = self
+        with _counts_lock:
+            while span is not None:
+                for key, value in counts.items():
+                    span.counts[key] = span.counts.get(key, 0) + value
+                span = span.parent
+
+    def record(self):
+        """Returns the span as a JSON serializable dictionnary"""
+        return {
+            "span": self.name,
+            "id": self.id,
+            "parent": self.parent.id if self.parent is not None else None,
+            "trace": self.trace,
+            "start": self.start,
+            "duration": self.duration,
+            "status": self.status,
+            "thread": threading.current_thread().name,
+            "pid": os.getpid(),
+            **self.attributes,
+            **self.counts,
+        }
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Times the enclosed block as a child of the current span
+
+    Yields
+    ------
+    span : :class:`Span`
+        its attributes can be set in the block, e.g. once the number of
+        files is known
+    """
+    current = Span(name, _current.get(), **attributes)
+    token = _current.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException as err:
+        current.status = "error"
+        current.set(error=repr(err))
+        raise
+    finally:
+        current.duration = time.perf_counter() - start
+        _current.reset(token)
+        _emit(current)
+
+
+def record(name, start, duration, **attributes):
+    """Writes a span measured elsewhere, e.g. in a worker process, as a child
+    of the current span
+
+    start is a time.time() timestamp, duration is in seconds
+    """
+    done = Span(name, _current.get(), **attributes)
+    done.start = start
+    done.duration = duration
+    _emit(done)
+    return done
+
+
+def current_span():
+    """Returns the current span, or None"""
+    return _current.get()
+
+
+def count(**counts):
+    """Increments counters, e.g. server_calls=1, of the current span
+    and its parents
+    """
+    current = _current.get()
+    if current is not None:
+        current.add(**counts)
+
+
+def _emit(done):
+    if not trace_log.handlers or not trace_log.isEnabledFor(logging.INFO):
+        return
+    trace_log.info(json.dumps(done.record(), default=str))
+
+
+def configure_tracing(trace_file):
+    """Writes the spans as JSON lines to trace_file
+
+    Returns the handler, to be removed with
+    `logging.getLogger("impomero.trace").removeHandler`
+    """
+    handler = logging.FileHandler(trace_file, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    trace_log.addHandler(handler)
+    trace_log.setLevel(logging.INFO)
+    return handler
@@ -0,0 +1,155 @@
+"""Parallel directory walker
+
+On network file systems (NFS, SMB) each directory listing costs at least
+one round-trip to the file server, so walking a tree is latency bound.
+Here sub-directories are listed concurrently by a bounded thread pool,
+and a single traversal collects both the annotation cards and the
+image files.
+"""
+import fnmatch
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import List, NamedTuple, Union
+
+from . import tracing
+
+log = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 8
+
+DEFAULT_IGNORE = (
+    ".snapshot",
+    ".zfs",
+    "$RECYCLE.BIN",
+    "System Volume Information",
+    ".Trash-*",
+    "@eaDir",
+)
+
+
+class DirListing(NamedTuple):
+    """Content of a single directory"""
+
+    path: Path
+    depth: int
+    cards: List[Path]
+    files: List[Path]
+    sub_dirs: List[Path]
+
+
+class TreeScan(NamedTuple):
+    """Content of a whole tree"""
+
+    cards: List[Path]
+    files: List[Path]
+
+
+def is_ignored(name: str, ignore=DEFAULT_IGNORE):
+    """Returns True if name matches one of the glob patterns in `ignore`"""
+    return any(fnmatch.fnmatchcase(name, pattern) for pattern in ignore)
+
+
+def scan_dir(path: Union[str, Path], depth: int = 0, ignore=DEFAULT_IGNORE):
+    """Lists a single directory with `os.scandir`
+
+    Symbolic links to directories are not followed. Unreadable
+    directories are logged and treated as empty.
+
+    Returns
+    -------
+    listing : :class:`DirListing`
+    """
+    path = Path(path)
+    cards, files, sub_dirs = [], [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if is_ignored(entry.name, ignore):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        sub_dirs.append(path / entry.name)
+                    elif entry.is_file():
+                        if entry.name.endswith(".toml"):
+                            cards.append(path / entry.name)
+                        else:
+                            files.append(path / entry.name)
+                except OSError as err:
+                    log.warning("Could not stat %s: %s", entry.path, err)
+    except OSError as err:
+        log.warning("Could not list %s: %s", path, err)
+    return DirListing(path, depth, cards, files, sub_dirs)
+
+
+def walk(
+    base_dir: Union[str, Path],
+    max_depth: int = None,
+    ignore=DEFAULT_IGNORE,
+    max_workers: int = DEFAULT_WORKERS,
+):
+    """Recursively lists base_dir, fanning out over sub-directories
+
+    Parameters
+    ----------
+    base_dir : str or :class:`Path`
+        the root of the walk, at depth 0
+    max_depth : int, optional
+        directories deeper than this are not listed
+    ignore : sequence of str
+        glob patterns of file and directory names to skip, ignored
+        directories are not descended into
+    max_workers : int
+        maximum number of directories listed at the same time
+
+    Yields
+    ------
+    listing : :class:`DirListing`
+        one per directory, a directory is always yielded before
+        its sub-directories
+    """
+    base_dir = Path(base_dir)
+    with ThreadPoolExecutor(
+        max_workers=max_workers, thread_name_prefix="impomero-walk"
+    ) as executor:
+        pending = {executor.submit(scan_dir, base_dir, 0, ignore)}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    listing = future.result()
+                    if max_depth is None or listing.depth < max_depth:
+                        pending.update(
+                            executor.submit(
+                                scan_dir, sub_dir, listing.depth + 1, ignore
+                            )
+                            for sub_dir in listing.sub_dirs
+                        )
+                    yield listing
+        finally:
+            # the walk was interrupted, do not list the remaining directories
+            for future in pending:
+                future.cancel()
+
+
+def scan_tree(base_dir: Union[str, Path], **kwargs):
+    """Walks base_dir once and gathers the toml cards and the other files
+
+    Keyword arguments are passed to :func:`walk`
+
+    Returns
+    -------
+    scan : :class:`TreeScan`
+        sorted lists of toml files and other files
+    """
+    cards, files = [], []
+    with tracing.span("scan", base_dir=str(base_dir)) as span:
+        n_dirs = 0
+        for listing in walk(base_dir, **kwargs):
+            cards.extend(listing.cards)
+            files.extend(listing.files)
+            n_dirs += 1
+        span.set(dirs=n_dirs, cards=len(cards), files=len(files))
+    log.info("Found %d toml files and %d other files", len(cards), len(files))
+    return TreeScan(sorted(cards), sorted(files))
@@ -8,7 +8,8 @@ import pytest
 from Ice import ConnectionLostException
 from omero.gateway import BlitzGateway
 
-from impomero import collector
+from impomero import collector, jobs
+from impomero.db import init_db
 
 pytest_plugins = ["docker_compose"]
 
@@ -105,3 +106,17 @@ def candidates(move_tomls):
 @pytest.fixture
 def import_table(move_tomls):
     return collector.create_import_table(RAW)
+
+
+@pytest.fixture
+def make_queue(tmp_path):
+    """Returns a function creating a job queue in a new state database,
+    its keyword arguments are passed to :class:`impomero.jobs.JobQueue`
+    """
+    db_name = tmp_path / "impomero.sql"
+    init_db(db_name)
+
+    def _make_queue(**kwargs):
+        return jobs.JobQueue(db_name, **kwargs)
+
+    return _make_queue
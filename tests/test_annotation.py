@@ -5,7 +5,16 @@ import pytest
 import toml
 from omero.gateway import MapAnnotationWrapper, TagAnnotationWrapper
 
-from impomero.annotation_job import annotate, auto_annotate, update_annotation
+from impomero.annotation_job import (
+    annotate,
+    annotate_dataset,
+    auto_annotate,
+    diff_cards,
+    update_annotation,
+    update_dataset_annotations,
+)
+from impomero.lookup import DatasetLookup
+from impomero.tags import TagResolver
 
 pytest_plugins = ["docker_compose"]
 
@@ -69,3 +78,92 @@ def test_auto_annotate(get_root_connection, import_table):
     conn = get_root_connection
     with pytest.raises(ValueError):
         auto_annotate(conn, import_table, dry_run=False)
+
+
+def test_tag_resolver(get_connection):
+    conn = get_connection
+    resolver = TagResolver()
+    ids = resolver.resolve(conn, ["test", "resolved", "test"])
+    assert list(ids) == ["test", "resolved"]
+    # one lookup, plus one check after creating the missing tags
+    assert resolver.queries <= 2
+    queries = resolver.queries
+    assert resolver.resolve(conn, ["resolved"]) == {"resolved": ids["resolved"]}
+    assert resolver.queries == queries
+    resolver.invalidate()
+    assert resolver.resolve(conn, ["resolved"]) == {"resolved": ids["resolved"]}
+    tag_ann = conn.getObjects("TagAnnotation", attributes={"textValue": "resolved"})
+    assert len(list(tag_ann)) == 1
+
+
+def test_annotate_dataset(get_connection):
+    annotation = {
+        "title": "Title 2",
+        "project": "Project Test 2",
+        "user": "john",
+        "comment": "shared comment",
+        "tags": ["test", "bulk"],
+        "kv_pairs": {"organism": "Python breitensteini"},
+    }
+    conn = get_connection
+    annotate_dataset(conn, [1], annotation, chunk_size=1)
+    img = conn.getObject("Image", 1)
+    values = [ann.getValue() for ann in img.listAnnotations()]
+    assert "bulk" in values
+    assert "shared comment" in values
+    # the tags are already linked, only a new comment and map are
+    assert annotate_dataset(conn, [1], annotation) == 2
+
+
+def test_diff_cards():
+    old = {
+        "tags": ["test", "old"],
+        "comment": "a comment",
+        "kv_pairs": {"organism": "Python breitensteini", "sample": "epidermis"},
+    }
+    new = {
+        "tags": ["test", "new"],
+        "comment": "a comment",
+        "kv_pairs": {"organism": "Python breitensteini", "channel_0": "Atb2-GFP"},
+    }
+    diff = diff_cards(old, new)
+    assert diff["added_tags"] == ["new"]
+    assert diff["removed_tags"] == ["old"]
+    assert diff["kv_set"] == {"channel_0": "Atb2-GFP"}
+    assert diff["kv_removed"] == ["sample"]
+    assert diff["old_comment"] == diff["new_comment"]
+
+    # the old card was stored as JSON, the new one is read from toml
+    accessed = datetime.datetime(2021, 4, 26, 10, 23, 9)
+    old = dict(new, kv_pairs={"accessed": str(accessed)})
+    new = dict(new, kv_pairs={"accessed": accessed})
+    assert diff_cards(old, new)["kv_set"] == {}
+
+
+def test_update_dataset_annotations(get_connection):
+    old = {"title": "Title 3", "tags": ["test"], "comment": "before"}
+    new = {"title": "Title 3", "tags": ["after"], "comment": "after"}
+    conn = get_connection
+    update_dataset_annotations(conn, [1], old)
+    update_dataset_annotations(conn, [1], new, old_card=old)
+    img = conn.getObject("Image", 1)
+    values = [ann.getValue() for ann in img.listAnnotations()]
+    assert "after" in values
+    assert "before" not in values
+    assert "test" not in values
+
+
+def test_dataset_lookup(get_connection):
+    conn = get_connection
+    lookup = DatasetLookup()
+    dset_id = lookup.dataset_id(conn, "Test_Proj", "Test_Dset")
+    dataset = conn.getObject("Dataset", dset_id)
+    assert dataset.getName() == "Test_Dset"
+    image_ids = lookup.image_ids(conn, dset_id)
+    assert image_ids == sorted(image.getId() for image in dataset.listChildren())
+    # cached
+    assert lookup.dataset_id(conn, "Test_Proj", "Test_Dset") == dset_id
+    assert lookup.image_ids(conn, dset_id) == image_ids
+    assert lookup.queries == 2
+    with pytest.raises(ValueError):
+        lookup.dataset_id(conn, "Test_Proj", "No_Dset")
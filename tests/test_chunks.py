@@ -0,0 +1,52 @@
+import pandas as pd
+
+from impomero.chunks import chunk_key, split_chunks
+
+
+def _table(n_files, n_datasets=2):
+    return pd.DataFrame(
+        {
+            "dataset": [f"dset{i % n_datasets}" for i in range(n_files)],
+            "target": [f"Dataset:+name:dset{i % n_datasets}" for i in range(n_files)],
+            "file_path": [f"/data/img{i:02d}.tif" for i in range(n_files)],
+        }
+    )
+
+
+def test_single_chunk():
+    table = _table(10)
+    sizes = pd.Series(100, index=table.index)
+    assert split_chunks(table, sizes, max_files=10) == ([], [list(table.index)])
+
+
+def test_balanced_chunks():
+    table = _table(20)
+    sizes = pd.Series([1000 if i < 4 else 10 for i in range(20)], index=table.index)
+    seeds, rest = split_chunks(table, sizes, max_files=8, max_bytes=1500)
+    # the first row of each dataset comes first, within the byte limit
+    assert seeds == [[0], [1]]
+    chunks = seeds + rest
+    assert sorted(idx for chunk in chunks for idx in chunk) == list(range(20))
+    assert all(len(chunk) <= 8 for chunk in rest)
+    chunk_bytes = [sizes[chunk].sum() for chunk in rest]
+    assert max(chunk_bytes) - min(chunk_bytes) <= 1000
+    # deterministic
+    assert split_chunks(table, sizes, max_files=8, max_bytes=1500) == (seeds, rest)
+
+
+def test_capped_seed_chunks():
+    table = _table(30, n_datasets=12)
+    sizes = pd.Series(10, index=table.index)
+    seeds, rest = split_chunks(table, sizes, max_files=5, max_bytes=40)
+    # more datasets than files per chunk, the seed is split too
+    assert len(seeds) == 3
+    assert sorted(idx for chunk in seeds for idx in chunk) == list(range(12))
+    chunks = seeds + rest
+    assert all(len(chunk) <= 4 for chunk in chunks)
+    assert sorted(idx for chunk in chunks for idx in chunk) == list(range(30))
+
+
+def test_chunk_key():
+    table = _table(4)
+    assert chunk_key(table) == chunk_key(table.iloc[::-1])
+    assert chunk_key(table) != chunk_key(table.iloc[:3])
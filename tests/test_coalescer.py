@@ -0,0 +1,58 @@
+import time
+
+from impomero.coalescer import EventCoalescer
+
+
+def test_coalesce_per_directory():
+    fired = []
+    coalescer = EventCoalescer(fired.append, quiet_period=60)
+    for _ in range(3):
+        coalescer.submit("/data/dir0/card.toml")
+    coalescer.submit("/data/dir0/card.toml.tmp.toml")
+    coalescer.submit("/data/dir1/card.toml")
+    assert not fired
+    coalescer.flush()
+    assert sorted(fired) == ["/data/dir0/card.toml.tmp.toml", "/data/dir1/card.toml"]
+    stats = coalescer.stats()
+    assert stats["received"] == 5
+    assert stats["dropped"] == 3
+    assert stats["fired"] == 2
+    assert stats["pending"] == 0
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_quiet_period():
+    fired = []
+    clock = FakeClock()
+    coalescer = EventCoalescer(fired.append, quiet_period=0.2, clock=clock)
+    coalescer.submit("/data/dir0/card.toml")
+    clock.now = 0.1
+    coalescer.submit("/data/dir0/card.toml")
+    clock.now = 0.25
+    assert coalescer.fire_due() == 0
+    clock.now = 0.35
+    assert coalescer.fire_due() == 1
+    assert fired == ["/data/dir0/card.toml"]
+
+
+def test_background_thread():
+    fired = []
+    coalescer = EventCoalescer(fired.append, quiet_period=0.1)
+    coalescer.start()
+    try:
+        coalescer.submit("/data/dir0/card.toml")
+        submitted = time.monotonic()
+        deadline = submitted + 5
+        while not fired and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert time.monotonic() - submitted >= 0.1
+        assert fired == ["/data/dir0/card.toml"]
+    finally:
+        coalescer.stop(flush=False)
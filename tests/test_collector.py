@@ -2,6 +2,7 @@ import os
 from pathlib import Path
 
 from impomero import collector
+from impomero.cards import CardCache
 
 DATA_PATH = Path(__file__).parent.parent / "data/"
 RAW = DATA_PATH / "raw"
@@ -71,3 +72,95 @@ def test_create_import_table(import_table):
 
     table = collector.create_import_table(RAW, update_dataset=True)
     assert "Dataset:+name" in table.loc[0, "target"]
+
+
+def test_collect_candidates_deepest_card(candidates):
+    img3 = RAW / "dir0" / "sub_dir2" / "img3.tif"
+    img3 = img3.absolute().resolve()
+    assert candidates[img3].as_posix().endswith("file2.toml")
+
+
+def test_collect_candidates_walk_options(move_tomls, monkeypatch):
+    calls = []
+    as_dictionary = collector.import_candidates.as_dictionary
+
+    def counted(paths):
+        calls.append(paths)
+        return as_dictionary(paths)
+
+    monkeypatch.setattr(collector.import_candidates, "as_dictionary", counted)
+    cands = collector.collect_candidates(RAW, ignore=("sub_dir2",), chunk_size=1)
+    assert len(cands) == 4
+    assert not any("sub_dir2" in path.as_posix() for path in cands)
+    # only files are passed, one call per card
+    assert len(calls) == 2
+    assert all(os.path.isfile(path) for paths in calls for path in paths)
+
+    calls.clear()
+    cands = collector.collect_candidates(RAW, max_depth=2)
+    assert len(cands) == 6
+    # each call starts a JVM, by default all the cards go in a single call
+    assert len(calls) == 1
+
+
+def test_deepest_card():
+    card_index = collector._index_cards(
+        [Path("/a/b/card.toml"), Path("/a/card.toml"), Path("/a/b/other.toml")]
+    )
+    assert card_index[Path("/a/b")] == Path("/a/b/card.toml")
+    assert collector._deepest_card("/a/b/c/img.tif", card_index) == Path(
+        "/a/b/card.toml"
+    )
+    assert collector._deepest_card("/a/img.tif", card_index) == Path("/a/card.toml")
+    assert collector._deepest_card("/d/img.tif", card_index) is None
+
+
+def test_card_cache(tmp_path):
+    card = tmp_path / "card.toml"
+    card.write_text('# omero annotation file\nproject = "p"\nuser = "john"\n')
+    cache = CardCache(maxsize=2)
+    assert cache.has_header(card)
+    assert cache.load(card)["user"] == "john"
+    assert cache.info().misses == 1
+    assert cache.info().hits == 1
+
+    ann = cache.load(card)
+    ann["user"] = "kathleen"
+    assert cache.load(card)["user"] == "john"
+
+    card.write_text('# omero annotation file\nproject = "p"\nuser = "kathleen"\n')
+    assert cache.load(card)["user"] == "kathleen"
+    assert cache.info().misses == 2
+
+    for i in range(3):
+        other = tmp_path / f"other{i}.toml"
+        other.write_text(f"title = 'other {i}'\n")
+        assert not cache.has_header(other)
+    assert cache.info().currsize == 2
+
+
+def test_iter_candidates(candidates):
+    pairs = dict(collector.iter_candidates(RAW, chunk_size=2))
+    assert pairs == candidates
+
+
+def test_iter_candidates_known(candidates):
+    known = {path.as_posix() for path in candidates if path.parent.name == "sub_dir2"}
+    assert known
+    pairs = dict(collector.iter_candidates(RAW, known=known))
+    assert set(pairs) == set(candidates) - set(map(Path, known))
+
+
+def test_iter_import_tables(import_table):
+    tables = list(collector.iter_import_tables(RAW, max_files=3))
+    assert [len(table) for table in tables] == [3, 3, 1]
+    assert "Dataset:@name" in tables[0].loc[0, "target"]
+    assert "Dataset:+name" in tables[1].loc[0, "target"]
+    file_paths = [path for table in tables for path in table["file_path"]]
+    assert sorted(file_paths) == sorted(import_table["file_path"])
+
+
+def test_batches():
+    assert list(collector._batches(range(5), 2, 60)) == [[0, 1], [2, 3], [4]]
+    # every batch is too old as soon as it starts
+    assert list(collector._batches(range(3), 10, 0)) == [[0], [1], [2]]
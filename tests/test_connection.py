@@ -0,0 +1,101 @@
+import pytest
+
+from impomero import connection
+from impomero.connection import ConnectionManager
+
+CONF = {"server": "omero", "port": "4064", "admin_passwd": "omero"}
+
+
+class FakeGateway:
+    def __init__(self, username="root", **kwargs):
+        self.username = username
+        self.alive = True
+        self.closed = False
+
+    def connect(self):
+        return True
+
+    def keepAlive(self):
+        return self.alive
+
+    def suConn(self, username, group=None, ttl=60000):
+        return FakeGateway(username)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    monkeypatch.setattr(connection, "BlitzGateway", FakeGateway)
+    manager = ConnectionManager(CONF, max_sessions=2, keepalive=0)
+    yield manager
+    manager.close()
+
+
+def test_session_pool(connections):
+    john = connections.user("john")
+    assert connections.user("john") is john
+    paul = connections.user("paul")
+    connections.user("john")
+    # paul is the least recently used
+    connections.user("ringo")
+    assert paul.closed
+    assert not john.closed
+    stats = connections.stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 3
+    assert stats["evictions"] == 1
+    assert stats["sessions"] == 2
+    assert stats["root_connections"] == 1
+
+
+def test_reconnect(connections):
+    root = connections.root()
+    john = connections.user("john")
+    john.alive = False
+    assert connections.user("john") is not john
+    root.alive = False
+    assert connections.root() is not root
+    assert root.closed
+    stats = connections.stats()
+    assert stats["reconnections"] == 2
+    assert stats["root_connections"] == 2
+    # sessions opened by the lost root connection are dropped
+    assert stats["sessions"] == 0
+
+
+def test_idle_eviction(connections):
+    connections.idle_timeout = 0
+    john = connections.user("john")
+    connections.ping()
+    assert john.closed
+    assert connections.stats()["sessions"] == 0
+
+
+def test_checked_out_sessions(connections):
+    connections.idle_timeout = 0
+    with connections.session("john") as john:
+        # neither evicted nor closed as idle while in use
+        connections.user("paul")
+        connections.user("ringo")
+        connections.ping()
+        assert not john.closed
+        assert connections.user("john") is john
+    assert connections.stats()["sessions"] == 1
+    connections.ping()
+    assert john.closed
+
+
+def test_detached_sessions(connections):
+    root = connections.root()
+    john = connections.checkout("john")
+    root.alive = False
+    connections.root()
+    # still used by an import, closed once checked in
+    assert not john.closed
+    assert connections.user("john") is not john
+    connections.checkin(john)
+    assert john.closed
+    with pytest.raises(ValueError):
+        connections.checkin(john)
@@ -0,0 +1,128 @@
+import sqlite3
+
+from impomero.db import SCHEMA_VERSION, StateStore, journal_mode_for
+from impomero.jobs import JobQueue
+
+
+def test_migrate_legacy_db(tmp_path):
+    db_name = tmp_path / "impomero.sql"
+    with sqlite3.connect(db_name) as sql_con:
+        sql_con.execute(
+            """CREATE TABLE annotated ('index', title, project, user, tags,
+            file_path, organism, id, base_dir)"""
+        )
+        sql_con.execute(
+            "INSERT INTO annotated VALUES (0, 'Title', 'Proj', 'john', 'a,b', "
+            "'/data/dir0/img0.tif', 'S. pombe', 12, '/data/dir0')"
+        )
+    with StateStore(db_name) as store:
+        assert store.version == SCHEMA_VERSION
+        assert store.imported_ids("/data/dir0") == [12]
+        ((kv_pairs,),) = store.query("SELECT kv_pairs FROM annotated")
+        assert kv_pairs == '{"organism":"S. pombe"}'
+    # reopening does not migrate again
+    with StateStore(db_name) as store:
+        assert store.imported_ids("/data/dir0") == [12]
+
+
+def test_migrate_baseline_db(tmp_path):
+    db_name = tmp_path / "impomero.sql"
+    # the layout of the DBs created before the schema was versioned
+    with sqlite3.connect(db_name) as sql_con:
+        sql_con.execute("CREATE TABLE monitored (date, base_dir)")
+        sql_con.execute(
+            """CREATE TABLE annotated ('index', title, created,
+            project, user, comment, tags, accessed, target, fileset, file_path,
+            'group', organism, sample, channel_0, id, base_dir)"""
+        )
+    with StateStore(db_name) as store:
+        assert store.version == SCHEMA_VERSION
+        columns = [row[1] for row in store.query("PRAGMA table_info(jobs)")]
+        assert "claimed_until" in columns
+        store.record_card("/data/dir0", "/data/dir0/card.toml", {"user": "john"})
+        assert store.card_state("/data/dir0") == {"user": "john"}
+    jobs = JobQueue(db_name)
+    job_id = jobs.enqueue("import", "/data/dir0", "/data/dir0/card.toml")
+    assert jobs.claim("worker0").id == job_id
+
+
+def test_ledger(tmp_path):
+    with StateStore(tmp_path / "impomero.sql") as store:
+        assert store.query("PRAGMA journal_mode") == [("wal",)]
+        assert not store.has_imported("/data/dir0")
+        records = [
+            {"id": img_id, "title": "Title", "tags": "a,b", "organism": "S. pombe"}
+            for img_id in (1, 2)
+        ]
+        assert store.add_annotated(records, "/data/dir0") == 2
+        assert store.has_imported("/data/dir0")
+        assert sorted(store.imported_ids("/data/dir0")) == [1, 2]
+        assert store.imported_ids("/data/dir1") == []
+        plan = store.query(
+            "EXPLAIN QUERY PLAN SELECT id FROM annotated WHERE base_dir=?",
+            ("/data/dir0",),
+        )
+        assert "annotated_base_dir" in plan[0][-1]
+
+        assert store.card_state("/data/dir0") is None
+        card = {"user": "john", "tags": ["a", "b"]}
+        store.record_card("/data/dir0", "/data/dir0/card.toml", card)
+        assert store.card_state("/data/dir0") == card
+
+
+def test_transaction_rollback(tmp_path):
+    with StateStore(tmp_path / "impomero.sql") as store:
+        try:
+            with store.transaction() as sql_con:
+                sql_con.execute("INSERT INTO monitored VALUES (0, '/data/dir0')")
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        assert store.query("SELECT COUNT(*) FROM monitored") == [(0,)]
+
+
+def test_manifest(tmp_path):
+    with StateStore(tmp_path / "impomero.sql") as store:
+        assert store.manifest_files("/data/dir0") == set()
+        store.record_manifest("/data/dir0", ["/data/dir0/a.tif", "/data/dir0/b.tif"])
+        store.record_manifest("/data/dir0", ["/data/dir0/b.tif", "/data/dir0/c.tif"])
+        assert store.manifest_files("/data/dir0") == {
+            "/data/dir0/a.tif",
+            "/data/dir0/b.tif",
+            "/data/dir0/c.tif",
+        }
+        assert store.manifest_files("/data/dir1") == set()
+
+        assert store.enclosing_card("/data/dir0/sub/d.tif") is None
+        store.record_card("/data", "/data/card.toml", {})
+        store.record_card("/data/dir0", "/data/dir0/card.toml", {})
+        assert store.enclosing_card("/data/dir0/sub") == (
+            "/data/dir0",
+            "/data/dir0/card.toml",
+        )
+        assert store.enclosing_card("/data/dir1") == ("/data", "/data/card.toml")
+
+
+def test_journal_mode_for(tmp_path):
+    mounts = tmp_path / "mounts"
+    mounts.write_text(
+        "/dev/sda1 / ext4 rw,relatime 0 0\n"
+        "server:/export /mnt/shared\\040data nfs4 rw,relatime 0 0\n"
+        "/dev/sdb1 /mnt/shared\\040data/local xfs rw 0 0\n"
+    )
+    assert journal_mode_for("/mnt/shared data/impomero.sql", mounts) == "delete"
+    assert journal_mode_for("/mnt/shared data/local/impomero.sql", mounts) == "wal"
+    assert journal_mode_for("/home/impomero.sql", mounts) == "wal"
+    assert journal_mode_for("/home/impomero.sql", tmp_path / "missing") == "wal"
+
+
+def test_file_checkpoints(tmp_path):
+    store = StateStore(tmp_path / "impomero.sql")
+    store.record_file_checkpoints(
+        "/data",
+        [("/data/a.tif", "Dataset:+name:d0", [1, 2]), ("/data/b.tif", "t", None)],
+    )
+    assert store.file_checkpoints(["/data/a.tif", "/data/c.tif"]) == {
+        ("/data/a.tif", "Dataset:+name:d0"): [1, 2]
+    }
+    assert store.file_checkpoints(["/data/b.tif"]) == {("/data/b.tif", "t"): None}
@@ -0,0 +1,158 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from impomero import jobs
+from impomero.dispatcher import JobDispatcher
+
+
+class BlockingJobs:
+    """run_job callback blocking until released, e.g. while a batch
+    is imported
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.started = []
+        self.cancels = []
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+
+    def __call__(self, job, cancel):
+        with self.lock:
+            self.started.append(job.base_dir)
+            self.cancels.append(cancel)
+        self.release.wait(5)
+        if cancel.is_set():
+            raise jobs.JobCancelled()
+        self.queue.finish(job)
+
+
+def _start(dispatcher):
+    thread = threading.Thread(target=asyncio.run, args=(dispatcher.run(),))
+    thread.start()
+    return thread
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_bounded_concurrency(make_queue):
+    queue = make_queue()
+    run_job = BlockingJobs(queue)
+    dispatcher = JobDispatcher(queue, run_job, max_jobs=2, worker="worker0")
+    thread = _start(dispatcher)
+    try:
+        for i in range(3):
+            queue.enqueue("import", f"/data/dir{i}", f"/data/dir{i}/card.toml")
+            dispatcher.notify()
+        assert _wait_for(lambda: len(run_job.started) == 2)
+        # the events are still accepted while the jobs run
+        queue.enqueue("import", "/data/dir3", "/data/dir3/card.toml")
+        dispatcher.notify()
+        assert dispatcher.running == 2
+        run_job.release.set()
+        assert _wait_for(lambda: queue.counts() == {jobs.DONE: 4})
+    finally:
+        run_job.release.set()
+        dispatcher.stop()
+        thread.join(5)
+    assert not thread.is_alive()
+    assert sorted(run_job.started) == [f"/data/dir{i}" for i in range(4)]
+
+
+def test_stop_drains_running_jobs(make_queue):
+    queue = make_queue()
+    run_job = BlockingJobs(queue)
+    dispatcher = JobDispatcher(queue, run_job, worker="worker0")
+    queue.enqueue("import", "/data/dir0", "/data/dir0/card.toml")
+    queue.enqueue("import", "/data/dir1", "/data/dir1/card.toml")
+    thread = _start(dispatcher)
+    assert _wait_for(lambda: run_job.started)
+    dispatcher.stop()
+    thread.join(0.2)
+    assert thread.is_alive()
+    run_job.release.set()
+    thread.join(5)
+    assert not thread.is_alive()
+    # the job not started yet stays queued
+    assert queue.counts() == {jobs.DONE: 1, jobs.PENDING: 1}
+
+
+def test_stop_cancels_running_jobs(make_queue):
+    queue = make_queue()
+    queue.lease = 0.3
+    run_job = BlockingJobs(queue)
+    dispatcher = JobDispatcher(queue, run_job, worker="worker0")
+    job_id = queue.enqueue("import", "/data/dir0", "/data/dir0/card.toml")
+    thread = _start(dispatcher)
+    try:
+        assert _wait_for(lambda: run_job.started)
+        dispatcher.stop(drain=False)
+        assert _wait_for(lambda: run_job.cancels[0].is_set())
+        # the current batch is still imported, the job is not released
+        time.sleep(0.6)
+        assert thread.is_alive()
+        assert queue.claim("worker1") is None
+        run_job.release.set()
+        thread.join(5)
+        assert not thread.is_alive()
+        # another worker resumes the job
+        assert queue.claim("worker1").id == job_id
+    finally:
+        run_job.release.set()
+
+
+def test_leases_are_renewed(make_queue):
+    queue = make_queue()
+    queue.lease = 0.3
+    run_job = BlockingJobs(queue)
+    dispatcher = JobDispatcher(queue, run_job, worker="worker0")
+    assert dispatcher.renew_interval == pytest.approx(0.1)
+    queue.enqueue("import", "/data/dir0", "/data/dir0/card.toml")
+    thread = _start(dispatcher)
+    try:
+        assert _wait_for(lambda: run_job.started)
+        time.sleep(0.6)
+        # the job outlived its first lease, but is still leased to worker0
+        assert queue.claim("worker1") is None
+    finally:
+        run_job.release.set()
+        dispatcher.stop()
+        thread.join(5)
+    assert queue.counts() == {jobs.DONE: 1}
+
+
+def test_lost_lease_cancels_job(make_queue):
+    queue = make_queue()
+    queue.lease = 0.3
+    cancelled = threading.Event()
+
+    def run_job(job, cancel):
+        if cancel.wait(5):
+            cancelled.set()
+            raise jobs.JobCancelled()
+        queue.finish(job)
+
+    dispatcher = JobDispatcher(queue, run_job, worker="worker0")
+    job_id = queue.enqueue("import", "/data/dir0", "/data/dir0/card.toml")
+    thread = _start(dispatcher)
+    try:
+        assert _wait_for(lambda: dispatcher.running)
+        # another worker takes the job over
+        queue.release("worker0")
+        assert queue.claim("worker1").id == job_id
+        assert cancelled.wait(5)
+        assert _wait_for(lambda: not dispatcher.running)
+    finally:
+        dispatcher.stop()
+        thread.join(5)
+    assert queue.get(job_id).worker == "worker1"
@@ -0,0 +1,117 @@
+import os
+import shutil
+from pathlib import Path
+
+import pytest
+
+from impomero.collector import mark_duplicates
+from impomero.db import StateStore
+from impomero.fingerprint import FingerprintIndex, content_digest, fingerprint
+
+
+def test_fingerprint(tmp_path):
+    img = tmp_path / "img0.tif"
+    img.write_bytes(b"a" * 100 + b"b" * 100)
+    before = fingerprint(img, block_size=64)
+    assert before.startswith("200:")
+    # a renamed file keeps its fingerprint
+    moved = tmp_path / "moved.tif"
+    img.rename(moved)
+    assert fingerprint(moved, block_size=64) == before
+    other = tmp_path / "img1.tif"
+    other.write_bytes(b"a" * 100 + b"c" * 100)
+    assert fingerprint(other, block_size=64) != fingerprint(moved, block_size=64)
+
+
+def test_fingerprint_cache(tmp_path):
+    img = tmp_path / "img0.tif"
+    img.write_bytes(b"0" * 1000)
+    with StateStore(tmp_path / "impomero.sql") as store:
+        index = FingerprintIndex(store, block_size=64)
+        missing = tmp_path / "missing.tif"
+        digests = index.fingerprints([img, missing])
+        assert list(digests) == [img]
+        assert index.fingerprints([img]) == digests
+        assert (index.computed, index.cached) == (1, 1)
+
+        img.write_bytes(b"1" * 1001)
+        os.utime(img, ns=(0, 10**9))
+        assert index.fingerprints([img]) != digests
+        assert index.computed == 2
+
+
+def test_mark_duplicates(import_table, tmp_path):
+    with StateStore(tmp_path / "impomero.sql") as store:
+        index = FingerprintIndex(store)
+        row = import_table.iloc[0]
+        digest = fingerprint(row["file_path"])
+        # the file the images were imported from, since moved
+        origin = tmp_path / "origin.tif"
+        shutil.copy(row["file_path"], origin)
+        store.add_annotated(
+            [
+                {
+                    "id": 42,
+                    "user": row["user"],
+                    "file_path": origin.as_posix(),
+                    "fingerprint": digest,
+                }
+            ],
+            "/data/old",
+        )
+        # another user's images are not duplicates
+        store.add_annotated(
+            [
+                {
+                    "id": 43,
+                    "user": "not" + row["user"],
+                    "file_path": origin.as_posix(),
+                    "fingerprint": digest,
+                }
+            ],
+            "/data/old",
+        )
+        duplicated = import_table["file_path"].map(fingerprint) == digest
+        flagged = mark_duplicates(import_table, index, "flag")
+        assert len(flagged) == len(import_table)
+        assert flagged.loc[duplicated, "duplicate_of"].tolist() == [[42]] * sum(
+            duplicated
+        )
+        assert flagged.loc[~duplicated, "duplicate_of"].isna().all()
+
+        dropped = mark_duplicates(import_table, index, "drop")
+        assert len(dropped) == len(import_table) - sum(duplicated)
+
+        linked = mark_duplicates(import_table, index, "link")
+        assert linked["link"].tolist() == duplicated.tolist()
+
+        with pytest.raises(ValueError):
+            mark_duplicates(import_table, index, "ignore")
+
+
+def test_same_fingerprint_other_content(import_table, tmp_path):
+    with StateStore(tmp_path / "impomero.sql") as store:
+        index = FingerprintIndex(store, block_size=64)
+        row = import_table.iloc[0]
+        # same size, header and trailer, another acquisition
+        content = bytearray(Path(row["file_path"]).read_bytes())
+        assert len(content) > 256
+        content[128] = (content[128] + 1) % 256
+        origin = tmp_path / "origin.tif"
+        origin.write_bytes(bytes(content))
+        digest = fingerprint(origin, block_size=64)
+        assert fingerprint(row["file_path"], block_size=64) == digest
+        store.add_annotated(
+            [
+                {
+                    "id": 42,
+                    "user": row["user"],
+                    "file_path": origin.as_posix(),
+                    "fingerprint": digest,
+                }
+            ],
+            "/data/old",
+        )
+        flagged = mark_duplicates(import_table, index, "drop")
+        assert len(flagged) == len(import_table)
+        assert content_digest(origin) != content_digest(row["file_path"])
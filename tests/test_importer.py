@@ -1,6 +1,23 @@
+import threading
 from pathlib import Path
+from types import SimpleNamespace
 
-from impomero.importer_job import auto_import
+import pandas as pd
+import pytest
+
+from impomero import importer_job
+from impomero.db import StateStore
+from impomero.importer_job import (
+    ImportRunner,
+    _attach_image_ids,
+    _import_command,
+    auto_import,
+    iter_import,
+    read_import_output,
+)
+from impomero.jobs import JobCancelled
+from impomero.lookup import FILESET_IMAGES, images_by_client_path
+from impomero.testing import FakeGateway, FakeServer
 
 DATA_PATH = Path(__file__).parent.parent / "data/"
 RAW = DATA_PATH / "raw"
@@ -14,7 +31,8 @@ def test_dry_auto_import(import_table):
         RAW, dry_run=True, import_table=import_table, reset=False, clean=False
     )
     with open(conf["tsv_file"]) as tsv:
-        assert len(tsv.readlines()) == 1
+        # the last (user, group) batch is paul's dir0/sub_dir2 card
+        assert len(tsv.readlines()) == 3
     with open(conf["out_file"]) as out:
         assert not out.readlines()
 
@@ -30,3 +48,348 @@ def test_auto_import(import_table, get_connection):
         assert not out.readlines()  # WHY?
 
     assert len(list(conn.getObjects("Dataset"))) == 2
+
+
+def test_dry_auto_import_batches(import_table):
+    conf, import_table_ = auto_import(
+        RAW, dry_run=True, import_table=import_table, reset=False, clean=True
+    )
+    assert len(conf["batches"]) == 3
+    tsv_files = {batch["tsv_file"] for batch in conf["batches"]}
+    err_files = {batch["err_file"] for batch in conf["batches"]}
+    assert len(tsv_files) == len(err_files) == 3
+    assert set(import_table_["batch"]) == {0, 1, 2}
+    assert (import_table_["import_status"] == "dry_run").all()
+
+
+def test_import_command():
+    conf = {
+        "server": "localhost",
+        "port": "4064",
+        "admin_passwd": "omero",
+        "username": "john",
+        "group": "lab",
+        "out_file": "out.yml",
+        "err_file": "err.txt",
+        "bulk_yml": "bulk.yml",
+    }
+    cmd = _import_command(conf, "ln_s")
+    assert cmd[cmd.index("-u") + 1] == "john"
+    assert cmd[cmd.index("-g") + 1] == "lab"
+    assert cmd[-2:] == ["--transfer", "ln_s"]
+
+    conf["session_key"] = "abcd"
+    cmd = _import_command(conf, None)
+    assert cmd[cmd.index("-k") + 1] == "abcd"
+    assert "omero" not in cmd
+    assert "--sudo" not in cmd
+    assert "--transfer" not in cmd
+
+
+def test_read_import_output(tmp_path):
+    out_file = tmp_path / "out.yml"
+    out_file.write_text(
+        "- Fileset: 3\n  Image: [10, 11]\n---\n- Fileset: 4\n  Image: 12\n"
+    )
+    imported = read_import_output(out_file)
+    assert [entry["images"] for entry in imported] == [[10, 11], [12]]
+
+    import_table = pd.DataFrame(
+        {"file_path": ["/data/a.tif", "/data/b.tif", "/data/c.tif"], "batch": [0, 0, 1]}
+    )
+    import_table["image_ids"] = None
+    _attach_image_ids(import_table, {"out_file": out_file, "batch": 0})
+    assert import_table["image_ids"].tolist() == [[10, 11], [12], None]
+
+    out_file.write_text("- Fileset: 5\n  Image: [13]\n  path: /data/c.tif\n")
+    _attach_image_ids(import_table, {"out_file": out_file, "batch": 1})
+    assert import_table.at[2, "image_ids"] == [13]
+
+
+def test_partially_failed_batch(tmp_path):
+    out_file = tmp_path / "out.yml"
+    out_file.write_text("- Fileset: 3\n  Image: [10]\n  path: /data/b.tif\n")
+    import_table = pd.DataFrame(
+        {"file_path": ["/data/a.tif", "/data/b.tif"], "batch": [0, 0]}
+    )
+    import_table["import_status"] = "failed"
+    import_table["image_ids"] = None
+    conf = {"out_file": out_file, "batch": 0, "import_status": "failed"}
+    _attach_image_ids(import_table, conf)
+    # only the file missing from the output failed
+    assert import_table["import_status"].tolist() == ["failed", "imported"]
+    assert import_table["image_ids"].tolist() == [None, [10]]
+
+
+def test_partially_failed_batch_without_paths(tmp_path):
+    out_file = tmp_path / "out.yml"
+    out_file.write_text("- Fileset: 3\n  Image: [10]\n- Fileset: 4\n  Image: [11]\n")
+    import_table = pd.DataFrame(
+        {"file_path": ["/data/a.tif", "/data/b.tif", "/data/c.tif"], "batch": 0}
+    )
+    import_table["import_status"] = "failed"
+    import_table["image_ids"] = None
+    conf = {"out_file": out_file, "batch": 0, "import_status": "failed"}
+    looked_up = []
+
+    def find_images(conf, file_paths):
+        looked_up.extend(file_paths)
+        return {"/data/a.tif": [10], "/data/c.tif": [11]}
+
+    _attach_image_ids(import_table, conf, find_images=find_images)
+    # the filesets can't be matched by order, their images are looked up
+    assert looked_up == import_table["file_path"].tolist()
+    assert import_table["import_status"].tolist() == ["imported", "failed", "imported"]
+    assert import_table["image_ids"].tolist() == [[10], None, [11]]
+
+
+def test_images_by_client_path():
+    server = FakeServer()
+    # the client paths are stored without their leading slash
+    entries = {"data/a.tif": [10, 11], "data/c.tif": [12]}
+
+    def fileset_images(server, ctx, params):
+        assert params["since"] == 1500
+        return [
+            (path, image_id)
+            for path in params["paths"]
+            for image_id in entries.get(path, [])
+        ]
+
+    server.handlers[FILESET_IMAGES] = fileset_images
+    found = images_by_client_path(
+        FakeGateway(server), ["/data/a.tif", "/data/b.tif", "/data/c.tif"], since=1.5
+    )
+    assert found == {"/data/a.tif": [10, 11], "/data/c.tif": [12]}
+
+
+def test_dry_iter_import(import_table):
+    results = list(iter_import(RAW, dry_run=True, max_files=4, clean=True))
+    assert len(results) == 2
+    imported = [table for _, table in results]
+    assert sum(len(table) for table in imported) == len(import_table)
+    assert all((table["import_status"] == "dry_run").all() for table in imported)
+
+    done = set(imported[0]["file_path"])
+    results = list(iter_import(RAW, dry_run=True, max_files=4, exclude=done))
+    assert sum(len(table) for _, table in results) == len(import_table) - len(done)
+
+
+def _write_output(conf, skip=()):
+    """Writes the import output of conf's batch, without the files in skip"""
+    tsv = pd.read_csv(conf["tsv_file"], sep="\t", header=None)
+    with open(conf["out_file"], "w") as out:
+        for image_id, path in enumerate(tsv[2]):
+            if path not in skip:
+                out.write(f"- Fileset: {image_id}\n  Image: [{image_id}]\n")
+                out.write(f"  path: {path}\n")
+
+
+class FakeRunner:
+    def __init__(self):
+        self.calls = []
+
+    def run(self, batches, dry_run=False, **kwargs):
+        self.calls.append([conf["batch"] for conf in batches])
+        for conf in batches:
+            _write_output(conf)
+        return ["imported"] * len(batches)
+
+    def find_images(self, conf, file_paths):
+        return {}
+
+
+def test_chunked_import_checkpoints(import_table, tmp_path):
+    store = StateStore(tmp_path / "impomero.sql")
+    runner = FakeRunner()
+    conf, table = auto_import(
+        RAW,
+        import_table=import_table.copy(),
+        reset=False,
+        runner=runner,
+        chunk_files=2,
+        checkpoints=store,
+    )
+    n_chunks = len(conf["batches"])
+    assert n_chunks > 3
+    seeds = [c["batch"] for c in conf["batches"] if c["seed"]]
+    # the chunks creating the datasets are imported first
+    assert runner.calls[0] == seeds
+    assert sorted(runner.calls[0] + runner.calls[1]) == list(range(n_chunks))
+    assert (table["import_status"] == "imported").all()
+
+    # after a restart, nothing is imported again
+    runner = FakeRunner()
+    conf, table = auto_import(
+        RAW,
+        import_table=import_table.copy(),
+        reset=False,
+        runner=runner,
+        chunk_files=2,
+        checkpoints=store,
+    )
+    assert runner.calls == []
+    assert (table["import_status"] == "skipped").all()
+
+
+class FakeSessions:
+    def __init__(self):
+        self.checked_out = {}
+
+    def checkout(self, username, group=None):
+        conn = SimpleNamespace(c=SimpleNamespace(getSessionId=lambda: username))
+        self.checked_out[username] = conn
+        return conn
+
+    def checkin(self, conn):
+        del self.checked_out[conn.c.getSessionId()]
+
+
+def test_runner_holds_sessions(monkeypatch):
+    sessions = FakeSessions()
+    imported = []
+
+    def perform_import(conf, **kwargs):
+        # the session is held while it is used by the import
+        assert sessions.checked_out[conf["username"]]
+        imported.append(conf["session_key"])
+        return 0
+
+    monkeypatch.setattr(importer_job, "perform_import", perform_import)
+    runner = ImportRunner(sessions=sessions)
+    batches = [{"username": user, "group": None} for user in ("john", "paul")]
+    assert runner.run(batches) == ["imported", "imported"]
+    assert imported == ["john", "paul"]
+    assert sessions.checked_out == {}
+
+
+def test_cancelled_import(import_table, tmp_path, monkeypatch):
+    store = StateStore(tmp_path / "impomero.sql")
+    cancel = threading.Event()
+    imported = []
+
+    def perform_import(conf, **kwargs):
+        imported.append((conf["batch"], conf["files"]))
+        _write_output(conf)
+        # e.g. the lease of the job was lost during the first chunk
+        cancel.set()
+        return 0
+
+    monkeypatch.setattr(importer_job, "perform_import", perform_import)
+    with pytest.raises(JobCancelled):
+        auto_import(
+            RAW,
+            import_table=import_table.copy(),
+            reset=False,
+            runner=ImportRunner(),
+            chunk_files=2,
+            checkpoints=store,
+            cancel=cancel,
+        )
+    # no other chunk was started, only the first one is recorded
+    assert [batch for batch, _ in imported] == [0]
+    conf, table = auto_import(
+        RAW,
+        import_table=import_table.copy(),
+        reset=False,
+        runner=FakeRunner(),
+        chunk_files=2,
+        checkpoints=store,
+    )
+    assert (table["import_status"] == "skipped").sum() == imported[0][1]
+
+
+def test_partially_failed_import_resumed(import_table, tmp_path, monkeypatch):
+    store = StateStore(tmp_path / "impomero.sql")
+    failed = import_table.at[1, "file_path"]
+
+    def perform_import(conf, **kwargs):
+        # all the files but one are imported
+        tsv = pd.read_csv(conf["tsv_file"], sep="\t", header=None)
+        with open(conf["out_file"], "w") as out:
+            for image_id, path in enumerate(tsv[2]):
+                if path != failed:
+                    out.write(f"- Fileset: {image_id}\n  Image: [{image_id}]\n")
+                    out.write(f"  path: {path}\n")
+        return int(failed in set(tsv[2]))
+
+    monkeypatch.setattr(importer_job, "perform_import", perform_import)
+    conf, table = auto_import(
+        RAW,
+        import_table=import_table.copy(),
+        reset=False,
+        runner=ImportRunner(),
+        chunk_files=3,
+        checkpoints=store,
+    )
+    assert table.loc[table["file_path"] == failed, "import_status"].tolist() == [
+        "failed"
+    ]
+    assert (table["import_status"] == "imported").sum() == len(table) - 1
+    # the other files of its chunk were imported
+    failed_chunks = [c for c in conf["batches"] if c["import_status"] == "failed"]
+    assert failed_chunks[0]["files"] > 1
+
+    # chunked differently, only the failed file is imported again
+    runner = FakeRunner()
+    conf, table = auto_import(
+        RAW,
+        import_table=import_table.copy(),
+        reset=False,
+        runner=runner,
+        chunk_files=2,
+        checkpoints=store,
+    )
+    assert sum(len(call) for call in runner.calls) == 1
+    assert table.loc[table["file_path"] == failed, "import_status"].tolist() == [
+        "imported"
+    ]
+    assert (table["import_status"] == "skipped").sum() == len(table) - 1
+
+
+def test_unknown_images_not_checkpointed(import_table, tmp_path, monkeypatch):
+    store = StateStore(tmp_path / "impomero.sql")
+    missing = import_table.at[1, "file_path"]
+
+    def perform_import(conf, **kwargs):
+        # the import succeeds, but one of the files is not in the output
+        _write_output(conf, skip={missing})
+        return 0
+
+    monkeypatch.setattr(importer_job, "perform_import", perform_import)
+    auto_import(
+        RAW,
+        import_table=import_table.copy(),
+        reset=False,
+        runner=ImportRunner(),
+        chunk_files=3,
+        checkpoints=store,
+    )
+    # the file without images is not checkpointed, it is imported again
+    runner = FakeRunner()
+    conf, table = auto_import(
+        RAW,
+        import_table=import_table.copy(),
+        reset=False,
+        runner=runner,
+        chunk_files=3,
+        checkpoints=store,
+    )
+    assert sum(len(call) for call in runner.calls) == 1
+    assert table.loc[table["import_status"] != "skipped", "file_path"].tolist() == [
+        missing
+    ]
+
+
+def test_linked_duplicates_not_imported(import_table):
+    import_table = import_table.copy()
+    import_table["duplicate_of"] = None
+    import_table["link"] = False
+    import_table.at[0, "duplicate_of"] = [42]
+    import_table.at[0, "link"] = True
+    conf, table = auto_import(
+        RAW, import_table=import_table, reset=False, runner=FakeRunner()
+    )
+    assert table.at[0, "import_status"] == "linked"
+    assert table.at[0, "image_ids"] == [42]
+    assert (table.loc[1:, "import_status"] == "imported").all()
@@ -0,0 +1,117 @@
+import multiprocessing
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from impomero import jobs
+
+
+def test_enqueue_coalesces_pending(make_queue):
+    queue = make_queue()
+    job_id = queue.enqueue("import", "/data/dir0", "/data/dir0/card.toml")
+    assert queue.enqueue("import", "/data/dir0", "/data/dir0/new.toml") == job_id
+    assert queue.get(job_id).toml_path == "/data/dir0/new.toml"
+    assert queue.enqueue("import", "/data/dir1", "/data/dir1/card.toml") != job_id
+    assert queue.counts() == {jobs.PENDING: 2}
+
+
+def test_claim_is_exclusive(make_queue):
+    queue = make_queue()
+    queue.enqueue("import", "/data/dir0", "/data/dir0/card.toml")
+    job = queue.claim("worker0")
+    assert job.attempts == 1
+    # a new event for the same directory waits for the running job
+    queue.enqueue("update", "/data/dir0", "/data/dir0/card.toml")
+    assert queue.claim("worker1") is None
+    queue.finish(job)
+    assert queue.claim("worker1").kind == "update"
+
+
+def test_resume_after_crash(make_queue):
+    queue = make_queue()
+    queue.enqueue("import", "/data/dir0", "/data/dir0/card.toml")
+    job = queue.claim("worker0")
+    job = queue.advance(job, jobs.IMPORTING)
+    queue.advance(job, jobs.ANNOTATING, payload="[]")
+    # worker0 crashes
+    assert queue.claim("worker1") is None
+    assert queue.release() == 1
+    job = queue.claim("worker1")
+    assert job.state == jobs.ANNOTATING
+    assert job.payload == "[]"
+
+
+def test_max_attempts(make_queue):
+    queue = make_queue(max_attempts=2)
+    job_id = queue.enqueue("import", "/data/dir0", "/data/dir0/card.toml")
+    for _ in range(2):
+        job = queue.claim()
+        queue.fail(job, "boom")
+    assert queue.claim() is None
+    assert queue.get(job_id).state == jobs.FAILED
+
+
+def test_lease_expiry(make_queue):
+    queue = make_queue(lease=0.2)
+    job_id = queue.enqueue("import", "/data/dir0", "/data/dir0/card.toml")
+    job = queue.claim("worker0")
+    assert queue.claim("worker1") is None
+    assert queue.renew(job)
+    time.sleep(0.3)
+    # worker0 stopped renewing its lease
+    taken = queue.claim("worker1")
+    assert taken.id == job_id
+    assert taken.attempts == 2
+    assert not queue.renew(job)
+    with pytest.raises(jobs.LeaseLost):
+        queue.advance(job, jobs.IMPORTING)
+    queue.finish(job)
+    assert queue.get(job_id).worker == "worker1"
+    queue.finish(taken)
+    assert queue.get(job_id).state == jobs.DONE
+
+
+def test_release_orphans(make_queue):
+    queue = make_queue()
+    queue.enqueue("import", "/data/dir0", "/data/dir0/card.toml")
+    queue.enqueue("import", "/data/dir1", "/data/dir1/card.toml")
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    # a process of this host that is gone, and a live one
+    queue.claim(f"{socket.gethostname()}:{process.pid}")
+    queue.claim(jobs.default_worker_name())
+    assert queue.release_orphans() == 1
+    assert queue.claim("worker1").base_dir == "/data/dir0"
+
+
+def _work(db_name, worker):
+    queue = jobs.JobQueue(db_name, lease=10)
+    done = []
+    while True:
+        job = queue.claim(worker)
+        if job is None:
+            return done
+        job = queue.advance(job, jobs.IMPORTING)
+        time.sleep(0.02)
+        queue.finish(job)
+        done.append(job.base_dir)
+
+
+def test_several_processes(make_queue):
+    queue = make_queue()
+    base_dirs = [f"/data/dir{i}" for i in range(20)]
+    for base_dir in base_dirs:
+        queue.enqueue("import", base_dir, f"{base_dir}/card.toml")
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(4, mp_context=context) as executor:
+        futures = [
+            executor.submit(_work, queue.store.db_name, f"worker{i}") for i in range(4)
+        ]
+        done = [base_dir for future in futures for base_dir in future.result()]
+    # each directory was imported once
+    assert sorted(done) == sorted(base_dirs)
+    assert queue.counts() == {jobs.DONE: 20}
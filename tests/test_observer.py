@@ -0,0 +1,89 @@
+import os
+import queue
+import time
+
+from watchdog.events import (
+    DirModifiedEvent,
+    FileCreatedEvent,
+    FileDeletedEvent,
+    FileModifiedEvent,
+)
+from watchdog.observers.api import ObservedWatch
+
+from impomero.observer import DirectoryPollingEmitter
+
+
+def _bump(path):
+    # make sure the modification time changes on coarse file systems
+    stamp = max(time.time(), path.stat().st_mtime) + 2
+    os.utime(path, (stamp, stamp))
+
+
+def _touch(path, text=""):
+    path.write_text(text)
+    _bump(path)
+    _bump(path.parent)
+
+
+def _emitter(path, **kwargs):
+    emitter = DirectoryPollingEmitter(
+        queue.Queue(), ObservedWatch(os.fspath(path), recursive=True), **kwargs
+    )
+    emitter.snapshot()
+    return emitter
+
+
+def _events(emitter):
+    return {(type(event), event.src_path) for event in emitter.poll()}
+
+
+def test_poll_tomls(tmp_path):
+    (tmp_path / "sub").mkdir()
+    card = tmp_path / "sub" / "card.toml"
+    emitter = _emitter(tmp_path)
+    assert emitter.n_directories == 2
+    assert not _events(emitter)
+
+    _touch(card)
+    _touch(tmp_path / "sub" / "img.tif")
+    assert _events(emitter) == {(FileCreatedEvent, os.fspath(card))}
+
+    _touch(card, "title = 'modified'")
+    assert _events(emitter) == {(FileModifiedEvent, os.fspath(card))}
+
+    card.unlink()
+    assert _events(emitter) == {(FileDeletedEvent, os.fspath(card))}
+
+
+def test_poll_sub_trees(tmp_path):
+    emitter = _emitter(tmp_path)
+    deep = tmp_path / "a" / "b"
+    deep.mkdir(parents=True)
+    _touch(deep / "card.toml")
+    _bump(tmp_path)
+    assert _events(emitter) == {(FileCreatedEvent, os.fspath(deep / "card.toml"))}
+    assert emitter.n_directories == 3
+
+    (deep / "card.toml").unlink()
+    deep.rmdir()
+    _touch(tmp_path / "a" / "img.tif")
+    assert _events(emitter) == {(FileDeletedEvent, os.fspath(deep / "card.toml"))}
+    assert emitter.n_directories == 2
+
+
+def test_poll_ignore(tmp_path):
+    emitter = _emitter(tmp_path)
+    snapshot = tmp_path / ".snapshot"
+    snapshot.mkdir()
+    _touch(snapshot / "card.toml")
+    _touch(tmp_path / "img.tif")
+    assert not _events(emitter)
+    assert emitter.n_directories == 1
+
+
+def test_poll_dir_events(tmp_path):
+    (tmp_path / "sub").mkdir()
+    emitter = _emitter(tmp_path, dir_events=True)
+    _touch(tmp_path / "sub" / "img.tif")
+    assert _events(emitter) == {(DirModifiedEvent, os.fspath(tmp_path / "sub"))}
+    assert not _events(emitter)
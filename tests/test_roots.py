@@ -0,0 +1,49 @@
+import pytest
+
+from impomero.roots import WatchedRoot, load_roots, watched_roots
+
+
+def test_load_roots(tmp_path):
+    config = tmp_path / "impomero.toml"
+    config.write_text(
+        """interval = 10.0
+
+[[roots]]
+path = "/mnt/confocal"
+
+[[roots]]
+path = "/mnt/lightsheet"
+interval = 60.0
+"""
+    )
+    assert load_roots(config) == [
+        WatchedRoot("/mnt/confocal", 10.0),
+        WatchedRoot("/mnt/lightsheet", 60.0),
+    ]
+    config.write_text("[[roots]]\ninterval = 1.0\n")
+    with pytest.raises(ValueError):
+        load_roots(config)
+
+
+def test_watched_roots(tmp_path):
+    base = tmp_path.resolve()
+    for name in ("share0/sub", "share0-b", "share1"):
+        (base / name).mkdir(parents=True)
+    roots = watched_roots(
+        [
+            base / "share0" / "sub",
+            base / "share0",
+            WatchedRoot(str(base / "share1"), 60.0),
+            base / "share0-b",
+        ],
+        interval=2.0,
+    )
+    # share0/sub is already watched with share0
+    assert roots == [
+        WatchedRoot(str(base / "share0"), 2.0),
+        WatchedRoot(str(base / "share0-b"), 2.0),
+        WatchedRoot(str(base / "share1"), 60.0),
+    ]
+    assert watched_roots(str(base / "share1")) == [WatchedRoot(str(base / "share1"))]
+    with pytest.raises(ValueError):
+        watched_roots(base / "missing")
@@ -0,0 +1,139 @@
+import time
+
+import pytest
+import toml
+from omero.constants.metadata import NSCLIENTMAPANNOTATION
+from omero.gateway import (
+    CommentAnnotationWrapper,
+    MapAnnotationWrapper,
+    TagAnnotationWrapper,
+)
+from omero.sys import ParametersI
+
+from impomero.annotation_job import (
+    CARD_NAMESPACE,
+    annotate,
+    annotate_dataset,
+    auto_annotate,
+    update_annotation,
+    update_dataset_annotations,
+)
+from impomero.lookup import DatasetLookup
+from impomero.testing import FakeGateway, FakeServer
+
+CARD = {
+    "title": "Title 1",
+    "project": "Project Test 1",
+    "user": "john",
+    "comment": "#test comment",
+    "tags": ["test", "new"],
+    "accessed": "2021-04-26 10:23:09.698404",
+    "kv_pairs": {"organism": "Python breitensteini", "channel_0": "Atb2-GFP"},
+}
+
+
+def _dataset(server, n_images, owner="john"):
+    dataset_id = server.add_dataset("dset", project="proj", owner=owner)
+    return [server.add_image(f"img{i}", dataset_id) for i in range(n_images)]
+
+
+def test_annotate(tmp_path):
+    server = FakeServer()
+    (image_id,) = _dataset(server, 1)
+    conn = FakeGateway(server, "john")
+    annotate(conn, image_id, CARD)
+    for tag in ("test", "new"):
+        tag_ann = conn.getObjects("TagAnnotation", attributes={"textValue": tag})
+        assert len(list(tag_ann)) == 1
+    img = conn.getObject("Image", image_id)
+    assert len(list(img.listAnnotations())) == 4
+
+    card_path = tmp_path / "card.toml"
+    with open(card_path, "w") as fh:
+        fh.write("# omero annotation file\n")
+        toml.dump(dict(CARD, comment="#other comment"), fh)
+    server.reset_counts()
+    update_annotation(conn, image_id, card_path)
+    assert server.calls["deleteObjects"] == 1
+    comments = [
+        ann.getValue()
+        for ann in img.listAnnotations()
+        if isinstance(ann, CommentAnnotationWrapper)
+    ]
+    assert comments == ["#other comment"]
+
+
+def test_annotate_dataset_round_trips():
+    round_trips = []
+    for n_images in (10, 100):
+        server = FakeServer()
+        image_ids = _dataset(server, n_images)
+        conn = FakeGateway(server).suConn("john")
+        server.reset_counts()
+        assert annotate_dataset(conn, image_ids, CARD) == 4 * n_images
+        assert len(server.annotation_links) == 4 * n_images
+        round_trips.append(server.round_trips)
+    # the number of round-trips does not depend on the number of images
+    assert round_trips[0] == round_trips[1]
+
+
+def test_auto_annotate(import_table):
+    server = FakeServer()
+    import_table = import_table.copy()
+    image_ids = []
+    for _, row in import_table.iterrows():
+        dataset_ids = server.find("Dataset", name=row["dataset"])
+        if not dataset_ids:
+            dataset_ids = [
+                server.add_dataset(row["dataset"], row["project"], owner=row["user"])
+            ]
+        image_ids.append([server.add_image(row["fileset"], dataset_ids[0])])
+    import_table["image_ids"] = image_ids
+
+    annotated = auto_annotate(FakeGateway(server), import_table)
+    assert sorted(annotated["id"]) == sorted(i for ids in image_ids for i in ids)
+
+    # without the image ids, the images are found in their datasets
+    lookup = DatasetLookup()
+    annotated = auto_annotate(
+        FakeGateway(server), import_table.drop(columns="image_ids"), lookup=lookup
+    )
+    assert sorted(annotated["id"]) == sorted(i for ids in image_ids for i in ids)
+    assert lookup.queries == 2 * import_table["dataset"].nunique()
+
+
+def test_update_dataset_annotations():
+    server = FakeServer()
+    image_ids = _dataset(server, 5)
+    conn = FakeGateway(server, "john")
+    annotate_dataset(conn, image_ids, CARD)
+    # a map added by hand is left as is
+    img = conn.getObject("Image", image_ids[0])
+    user_map = MapAnnotationWrapper(conn)
+    user_map.setNs(NSCLIENTMAPANNOTATION)
+    user_map.setValue([("organism", "H. sapiens")])
+    img.linkAnnotation(user_map)
+    new_card = dict(CARD, tags=["test", "newer"], kv_pairs={"organism": "S. pombe"})
+    update_dataset_annotations(conn, image_ids, new_card, old_card=CARD)
+    anns = list(img.listAnnotations())
+    map_anns = {
+        ann.getNs(): ann.getValue()
+        for ann in anns
+        if isinstance(ann, MapAnnotationWrapper)
+    }
+    assert map_anns == {
+        CARD_NAMESPACE: [("organism", "S. pombe")],
+        NSCLIENTMAPANNOTATION: [("organism", "H. sapiens")],
+    }
+    tags = [ann.getValue() for ann in anns if isinstance(ann, TagAnnotationWrapper)]
+    assert sorted(tags) == ["newer", "test"]
+
+
+def test_latency_and_unknown_queries():
+    server = FakeServer(latency={"projection": 0.01})
+    conn = FakeGateway(server)
+    start = time.perf_counter()
+    with pytest.raises(NotImplementedError):
+        conn.getQueryService().projection("select i.id from Image i", ParametersI())
+    assert time.perf_counter() - start >= 0.01
+    assert server.calls == {"projection": 1}
@@ -0,0 +1,68 @@
+import json
+import logging
+
+import pytest
+
+from impomero import tracing
+from impomero.annotation_job import annotate_dataset
+from impomero.testing import FakeGateway, FakeServer
+
+
+@pytest.fixture
+def trace_file(tmp_path):
+    path = tmp_path / "trace.jsonl"
+    handler = tracing.configure_tracing(path)
+    yield path
+    logging.getLogger("impomero.trace").removeHandler(handler)
+    handler.close()
+
+
+def _spans(path):
+    with open(path) as fh:
+        return {span["span"]: span for span in map(json.loads, fh)}
+
+
+def test_nested_spans(trace_file):
+    with tracing.span("outer", files=3) as outer:
+        with tracing.span("inner") as inner:
+            assert tracing.current_span() is inner
+            tracing.count(server_calls=2)
+        tracing.count(server_calls=1)
+        outer.set(images=6)
+    assert tracing.current_span() is None
+
+    spans = _spans(trace_file)
+    assert spans["inner"]["parent"] == spans["outer"]["id"]
+    assert spans["inner"]["trace"] == spans["outer"]["trace"]
+    assert spans["inner"]["server_calls"] == 2
+    assert spans["outer"]["server_calls"] == 3
+    assert spans["outer"]["files"] == 3
+    assert spans["outer"]["images"] == 6
+    assert spans["outer"]["duration"] >= spans["inner"]["duration"]
+
+
+def test_failed_span(trace_file):
+    with pytest.raises(ValueError):
+        with tracing.span("failing"):
+            raise ValueError("boom")
+    (span,) = _spans(trace_file).values()
+    assert span["status"] == "error"
+    assert "boom" in span["error"]
+
+
+def test_annotate_dataset_server_calls(trace_file):
+    server = FakeServer()
+    dataset_id = server.add_dataset("dset", project="proj", owner="john")
+    image_ids = [server.add_image(f"img{i}", dataset_id) for i in range(5)]
+    conn = FakeGateway(server, "john")
+    card = {
+        "title": "Title",
+        "project": "proj",
+        "comment": "#comment",
+        "tags": ["test"],
+        "kv_pairs": {"organism": "yeast"},
+    }
+    server.reset_counts()
+    with tracing.span("annotate"):
+        annotate_dataset(conn, image_ids, card)
+    assert _spans(trace_file)["annotate"]["server_calls"] == server.round_trips
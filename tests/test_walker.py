@@ -0,0 +1,34 @@
+from pathlib import Path
+
+from impomero import walker
+
+DATA_PATH = Path(__file__).parent.parent / "data/"
+RAW = DATA_PATH / "raw"
+
+
+def test_scan_tree(move_tomls):
+    scan = walker.scan_tree(RAW)
+    assert len(scan.cards) == 3
+    assert len(scan.files) == 7
+    assert all(card.suffix == ".toml" for card in scan.cards)
+
+
+def test_walk_parents_first():
+    seen = set()
+    for listing in walker.walk(RAW, max_workers=2):
+        assert listing.path == RAW or listing.path.parent in seen
+        seen.add(listing.path)
+    assert RAW / "dir1" / "sub_dir1" / "subsub_dir" in seen
+
+
+def test_walk_max_depth():
+    depths = [listing.depth for listing in walker.walk(RAW, max_depth=1)]
+    assert max(depths) == 1
+    scan = walker.scan_tree(RAW, max_depth=1)
+    assert not scan.files
+
+
+def test_walk_ignore():
+    scan = walker.scan_tree(RAW, ignore=("sub_dir2", "img0*"))
+    assert len(scan.files) == 2
+    assert all(path.name in ("img1.tif", "img2.tif") for path in scan.files)